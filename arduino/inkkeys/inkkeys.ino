@@ -99,15 +99,13 @@ void checkKeysAndReportChanges() {
     if (state == LOW && !pressed[i]) {
       if (debounce(i)) {
         pressed[i] = true;
-        Serial.print(i+1);
-        Serial.println("p");
+        reportKey(i+1, 'p');
         executeEvents(assignments[i][0]);
       }
     } else if (state == HIGH && pressed[i]) {
       if (debounce(i)) {
         pressed[i] = false;
-        Serial.print(i+1);
-        Serial.println("r");
+        reportKey(i+1, 'r');
         executeEvents(assignments[i][1]);
       }
     }
@@ -119,8 +117,7 @@ void checkRotaryEncoderAndReportChanges() {
   long rotaryNew = rotary.read();
   if (abs(rotaryNew - rotaryPosition) >= ROT_FACTOR) {
     int report = (rotaryNew-rotaryPosition)/ROT_FACTOR;
-    Serial.print("R");
-    Serial.println(report);
+    reportJog(report);
     rotaryPosition += report*ROT_FACTOR;
     for (int i = 0; i < report; i++)
       executeEvents(assignments[9][0]);
@@ -14,6 +14,94 @@ byte serialBufferCount = 0;
 unsigned short expectingImageData = 0;
 unsigned short imageDataTargetX, imageDataTargetY, imageDataTargetWidth, imageDataCurrentY;
 
+//State while receiving PackBits encoded image data (see python-controller/inkkeys/packbits.py), which is decoded byte by byte
+unsigned short packedRemaining = 0; //Encoded bytes still to be received
+byte packedLiteral = 0;             //Literal bytes still to come in the current packet
+byte packedRepeat = 0;              //Number of times the next byte is repeated
+
+//Acknowledge each row of image data with a "c" line, so the host can send data as fast as we write it (enabled with "C 1")
+bool creditsEnabled = false;
+
+//Binary frames (see python-controller/inkkeys/frames.py): 0xA5, type, length (LE16), payload, CRC-8 (polynomial 0x07)
+const byte FRAME_SYNC = 0xA5;
+const byte FRAME_ASSIGN = 0x01;   //Key index, press/release, then Event structs of 3 bytes
+const byte FRAME_DISPLAY = 0x02;  //x, y, w, h as LE16, followed by the image data as after a "D" command
+const byte FRAME_LED = 0x03;      //R, G, B for each LED
+const byte FRAME_REFRESH = 0x04;  //'p', 'f' or 'o' as for the "R" command
+const byte FRAME_CREDIT = 0x05;   //0 or 1 as for the "C" command
+const byte FRAME_FRAMES = 0x06;   //0 or 1 as for the "B" command
+const byte REPLY_OK = 0x81;
+const byte REPLY_CREDIT = 0x82;   //Number of image rows written
+const byte REPLY_KEY = 0x83;      //Key number and 'p' or 'r'
+const byte REPLY_JOG = 0x84;      //Steps as signed LE16
+
+//Send "ok", credits and key events as frames (enabled with "B 1", disabled by the info command). Errors are always sent as text.
+bool framedReplies = false;
+
+//State while receiving a frame. The payload is collected in serialBuffer.
+const byte FRAME_NONE = 0, FRAME_TYPE = 1, FRAME_LENGTH_LOW = 2, FRAME_LENGTH_HIGH = 3, FRAME_PAYLOAD = 4, FRAME_CRC = 5;
+byte frameState = FRAME_NONE;
+byte frameType;
+unsigned short frameLength, frameReceived;
+byte frameCrc;
+
+byte crc8Update(byte crc, byte data) {
+  crc ^= data;
+  for (byte bit = 0; bit < 8; bit++)
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+  return crc;
+}
+
+void sendFrame(byte type, const byte * payload, unsigned short len) {
+  byte header[] = {type, (byte)(len & 0xff), (byte)(len >> 8)};
+  byte crc = 0;
+  for (byte i = 0; i < 3; i++)
+    crc = crc8Update(crc, header[i]);
+  for (unsigned short i = 0; i < len; i++)
+    crc = crc8Update(crc, payload[i]);
+  Serial.write(FRAME_SYNC);
+  Serial.write(header, 3);
+  if (len > 0)
+    Serial.write(payload, len);
+  Serial.write(crc);
+}
+
+void replyOk() {
+  if (framedReplies)
+    sendFrame(REPLY_OK, NULL, 0);
+  else
+    Serial.println("ok");
+}
+
+void replyCredit() {
+  if (framedReplies) {
+    byte rows = 1;
+    sendFrame(REPLY_CREDIT, &rows, 1);
+  } else
+    Serial.println("c");
+}
+
+//Key n (1-9) has been pressed (c = 'p') or released (c = 'r')
+void reportKey(byte n, char c) {
+  if (framedReplies) {
+    byte payload[] = {n, (byte)c};
+    sendFrame(REPLY_KEY, payload, 2);
+  } else {
+    Serial.print(n);
+    Serial.println(c);
+  }
+}
+
+void reportJog(int steps) {
+  if (framedReplies) {
+    byte payload[] = {(byte)(steps & 0xff), (byte)((steps >> 8) & 0xff)};
+    sendFrame(REPLY_JOG, payload, 2);
+  } else {
+    Serial.print("R");
+    Serial.println(steps);
+  }
+}
+
 //Output an error message with index
 void printErrorWithIndex(const char * msg, byte i) {
   Serial.print("E: ");
@@ -268,6 +356,11 @@ void processDisplayCommand() {
   }
   i++;
   imageDataTargetWidth = atoi(serialBuffer + i);
+  if ((imageDataTargetWidth+7)/8 >= serialBufferSize) {
+    //A row has to fit into the serial buffer (whose count is a byte)
+    Serial.println("E: Bad format.");
+    return;
+  }
   while (i < serialBufferCount && serialBuffer[i] >= '0' && serialBuffer[i] <= '9')
     i++;
   if (i+1 >= serialBufferCount || serialBuffer[i] != ' ') {
@@ -278,6 +371,57 @@ void processDisplayCommand() {
   unsigned short imageDataTargetHeight = atoi(serialBuffer + i);
   expectingImageData = imageDataTargetWidth*imageDataTargetHeight/8;
   imageDataCurrentY = imageDataTargetY;
+  while (i < serialBufferCount && serialBuffer[i] >= '0' && serialBuffer[i] <= '9')
+    i++;
+  if (i+1 < serialBufferCount && serialBuffer[i] == ' ') {
+    //Optional length of PackBits encoded data
+    startPackedImageData(atoi(serialBuffer + i + 1));
+  }
+}
+
+void startPackedImageData(unsigned short length) {
+  packedRemaining = length;
+  packedLiteral = 0;
+  packedRepeat = 0;
+  if (length == 0)
+    expectingImageData = 0;
+}
+
+//Collects a byte of image data and writes the row once it is complete
+void storeImageByte(char c) {
+  serialBuffer[serialBufferCount] = c;
+  serialBufferCount++;
+  expectingImageData--;
+  if (serialBufferCount * 8 >= imageDataTargetWidth) {
+    display.writeImage(serialBuffer, imageDataTargetX, imageDataCurrentY, imageDataTargetWidth, 1, false, false, false);
+    serialBufferCount = 0;
+    imageDataCurrentY++;
+    if (creditsEnabled)
+      replyCredit();
+  }
+}
+
+//Decodes a byte of PackBits encoded image data. Headers 0 to 127 are followed by n+1 literal bytes, 129 to 255 by a byte that is repeated 257-n times.
+void handlePackedInput(byte c) {
+  packedRemaining--;
+  if (packedLiteral > 0) {
+    packedLiteral--;
+    if (expectingImageData > 0)
+      storeImageByte(c);
+  } else if (packedRepeat > 0) {
+    for (; packedRepeat > 0 && expectingImageData > 0; packedRepeat--)
+      storeImageByte(c);
+    packedRepeat = 0;
+  } else if (c < 128) {
+    packedLiteral = c + 1;
+  } else if (c > 128) {
+    packedRepeat = 257 - c;
+  }
+  if (packedRemaining == 0 && expectingImageData > 0) {
+    Serial.println("E: Image data incomplete.");
+    expectingImageData = 0;
+    serialBufferCount = 0;
+  }
 }
 
 void processInfoCommand() {
@@ -285,6 +429,7 @@ void processInfoCommand() {
     Serial.println("E: Bad format.");
     return;
   }
+  framedReplies = false; //The info block is always sent as text, so a host that does not know about frames can connect
   Serial.println("Inkkeys");
   Serial.println("TEST 0");
   Serial.print("N_LED ");
@@ -295,6 +440,9 @@ void processInfoCommand() {
   Serial.println(DISP_H);
   Serial.print("ROT_CIRCLE_STEPS ");
   Serial.println(ROT_CIRCLE_STEPS);
+  Serial.println("CREDIT 1");
+  Serial.println("FRAMES 1");
+  Serial.println("RLE 1");
   Serial.println("Done");
 }
 
@@ -309,12 +457,34 @@ void processLEDCommand() {
   leds.show();
 }
 
+void processCreditCommand() {
+  if (serialBufferCount != 3 || serialBuffer[1] != ' ' || (serialBuffer[2] != '0' && serialBuffer[2] != '1')) {
+    Serial.println("E: Bad format.");
+    return;
+  }
+  creditsEnabled = serialBuffer[2] == '1';
+  replyOk();
+}
+
+void processFramesCommand() {
+  if (serialBufferCount != 3 || serialBuffer[1] != ' ' || (serialBuffer[2] != '0' && serialBuffer[2] != '1')) {
+    Serial.println("E: Bad format.");
+    return;
+  }
+  replyOk(); //Still in the previous format
+  framedReplies = serialBuffer[2] == '1';
+}
+
 void processRefreshCommand() {
   if (serialBufferCount != 3 || serialBuffer[1] != ' ' || (serialBuffer[2] != 'p' && serialBuffer[2] != 'f' && serialBuffer[2] != 'o')) {
     Serial.println("E: Bad format.");
     return;
   }
-  switch (serialBuffer[2]) {
+  refresh(serialBuffer[2]);
+}
+
+void refresh(char type) {
+  switch (type) {
     case 'p':
       display.refresh(true);
       break;
@@ -325,7 +495,117 @@ void processRefreshCommand() {
       display.powerOff();
       break;
   }
-  Serial.println("ok");
+  replyOk();
+}
+
+unsigned short readLE16(byte i) {
+  return (byte)serialBuffer[i] | ((byte)serialBuffer[i+1] << 8);
+}
+
+//Assignment with the events as binary Event structs, so nothing needs to be parsed
+void processAssignFrame() {
+  if (frameLength < 2 || (frameLength - 2) % 3 != 0 || (byte)serialBuffer[0] > 9 || (byte)serialBuffer[1] > 1) {
+    Serial.println("E: Bad format.");
+    return;
+  }
+  byte key = serialBuffer[0];
+  byte pr = serialBuffer[1];
+  byte event = 0;
+  for (unsigned short i = 2; i < frameLength && event < N_EVENTS; i += 3, event++) {
+    assignments[key][pr][event].deviceAndType = serialBuffer[i];
+    assignments[key][pr][event].keycodeOrDelay = readLE16(i+1);
+  }
+  for (; event < N_EVENTS; event++) {
+    assignments[key][pr][event].deviceAndType = DEVICE_NONE;
+  }
+}
+
+void processFrame() {
+  switch (frameType) {
+    case FRAME_ASSIGN:
+      processAssignFrame();
+      return;
+    case FRAME_DISPLAY:
+      if ((frameLength != 8 && frameLength != 10) || (readLE16(4)+7)/8 >= serialBufferSize)
+        break;
+      imageDataTargetX = readLE16(0);
+      imageDataTargetY = readLE16(2);
+      imageDataTargetWidth = readLE16(4);
+      expectingImageData = imageDataTargetWidth*readLE16(6)/8;
+      imageDataCurrentY = imageDataTargetY;
+      if (frameLength == 10) //Length of PackBits encoded data
+        startPackedImageData(readLE16(8));
+      return;
+    case FRAME_LED:
+      if (frameLength != 3*N_LED)
+        break;
+      for (byte i = 0; i < N_LED; i++)
+        leds.setPixelColor(i, serialBuffer[3*i], serialBuffer[3*i+1], serialBuffer[3*i+2]);
+      leds.show();
+      return;
+    case FRAME_REFRESH:
+      if (frameLength != 1 || (serialBuffer[0] != 'p' && serialBuffer[0] != 'f' && serialBuffer[0] != 'o'))
+        break;
+      refresh(serialBuffer[0]);
+      return;
+    case FRAME_CREDIT:
+      if (frameLength != 1 || (byte)serialBuffer[0] > 1)
+        break;
+      creditsEnabled = serialBuffer[0] == 1;
+      replyOk();
+      return;
+    case FRAME_FRAMES:
+      if (frameLength != 1 || (byte)serialBuffer[0] > 1)
+        break;
+      replyOk();
+      framedReplies = serialBuffer[0] == 1;
+      return;
+    default:
+      Serial.print("E: Unknown frame type ");
+      Serial.print(frameType);
+      Serial.println(".");
+      return;
+  }
+  Serial.println("E: Bad format.");
+}
+
+//Handles a byte of a frame, which arrives byte by byte just like text commands
+void handleFrameInput(byte c) {
+  switch (frameState) {
+    case FRAME_TYPE:
+      frameType = c;
+      frameCrc = crc8Update(0, c);
+      frameState = FRAME_LENGTH_LOW;
+      break;
+    case FRAME_LENGTH_LOW:
+      frameLength = c;
+      frameCrc = crc8Update(frameCrc, c);
+      frameState = FRAME_LENGTH_HIGH;
+      break;
+    case FRAME_LENGTH_HIGH:
+      frameLength |= c << 8;
+      frameCrc = crc8Update(frameCrc, c);
+      frameReceived = 0;
+      frameState = frameLength > 0 ? FRAME_PAYLOAD : FRAME_CRC;
+      break;
+    case FRAME_PAYLOAD:
+      frameCrc = crc8Update(frameCrc, c);
+      if (frameReceived < serialBufferSize)
+        serialBuffer[frameReceived] = c;
+      frameReceived++;
+      if (frameReceived == frameLength)
+        frameState = FRAME_CRC;
+      break;
+    case FRAME_CRC:
+      frameState = FRAME_NONE;
+      if (c != frameCrc)
+        Serial.println("E: Bad checksum.");
+      else if (frameLength > serialBufferSize)
+        Serial.println("E: Command too long.");
+      else
+        processFrame();
+      break;
+  }
 }
 
 //Read from Serial in and react to enter (carriage return)
@@ -333,7 +613,14 @@ void handleSerialInput() {
   if (Serial.available() > 0) {
     char c = Serial.read();
 
-    if (expectingImageData == 0 && c == '\n') {
+    if (packedRemaining > 0) {
+      handlePackedInput(c);
+    } else if (frameState != FRAME_NONE) {
+      handleFrameInput(c);
+    } else if (expectingImageData == 0 && serialBufferCount == 0 && (byte)c == FRAME_SYNC) {
+      //Start of a binary frame, text commands never start with this byte
+      frameState = FRAME_TYPE;
+    } else if (expectingImageData == 0 && c == '\n') {
       //Carriage return. Command ends and needs to be processed
       if (serialBufferCount == serialBufferSize) {
         Serial.println("E: Command too long.");
@@ -355,6 +642,12 @@ void handleSerialInput() {
           case 'R': //Trigger refresh
             processRefreshCommand();
             break;
+          case 'C': //Enable or disable credits for image data
+            processCreditCommand();
+            break;
+          case 'B': //Enable or disable binary frames for replies
+            processFramesCommand();
+            break;
           default:  //Inknown command
             Serial.print("E: Unknown command: ");
             Serial.println(serialBuffer);
@@ -369,16 +662,11 @@ void handleSerialInput() {
     } else {
       //Just a normal character or part of a transferred image. Store it in the buffer.
       if (serialBufferCount < serialBufferSize) {
-        serialBuffer[serialBufferCount] = c;
-        serialBufferCount++;
-
         if (expectingImageData > 0) {
-          expectingImageData--;
-          if (serialBufferCount * 8 >= imageDataTargetWidth) {
-            display.writeImage(serialBuffer, imageDataTargetX, imageDataCurrentY, imageDataTargetWidth, 1, false, false, false);
-            serialBufferCount = 0;
-            imageDataCurrentY++;
-          }
+          storeImageByte(c);
+        } else {
+          serialBuffer[serialBufferCount] = c;
+          serialBufferCount++;
         }
       }
     }
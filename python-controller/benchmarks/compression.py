@@ -0,0 +1,123 @@
+#Benchmark of the PackBits compression of image data (see inkkeys/packbits.py). It renders every icon in icons/ for a
+#button area like Device.sendIconFor and reports the compression ratio of the display commands, i.e. including the
+#header and the fallback to raw data if compression does not help. It then cycles through ModeBlender, ModeGimp and
+#ModeFallback against the firmware emulator with and without compression and reports the bytes and the modeled
+#transfer time per mode switch as JSON.
+#
+#Run from the python-controller directory:
+#   python3 benchmarks/compression.py --output compression.json
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import time
+from contextlib import redirect_stdout
+from statistics import mean, median
+
+from inkkeys import *
+from inkkeys.packbits import packRows, unpack
+from modes import ModeBlender, ModeGimp, ModeFallback
+from mqtt import InkkeysMqtt
+
+def transferTime(n, baudrate):
+    return n * 10 / baudrate #8N1
+
+def compressIcons(iconDir, function, baudrate):
+    device = Device()
+    device.dispW, device.dispH = Emulator.dispW, Emulator.dispH
+    x, y, w, h = device.getAreaFor(function)
+    ratios = []
+    rawBytes = 0
+    encodedBytes = 0
+    fallbacks = 0
+    for name in sorted(os.listdir(iconDir)):
+        if not name.endswith(".png"):
+            continue
+        data = device.packImage(device.renderIcon(function, os.path.join(iconDir, name)))
+        device.compressing = False
+        raw = device.encodeImage(x, y, w, h, data)
+        device.compressing = True
+        encoded = device.encodeImage(x, y, w, h, data)
+        if len(encoded) == len(raw):
+            fallbacks += 1
+        elif unpack(packRows(data, w//8)) != data:
+            raise RuntimeError("Decoding " + name + " does not restore the image.")
+        rawBytes += len(raw)
+        encodedBytes += len(encoded)
+        ratios.append(len(encoded) / len(raw))
+    return {
+        "icons": len(ratios),
+        "area": [x, y, w, h],
+        "rawBytes": rawBytes,
+        "compressedBytes": encodedBytes,
+        "ratio": encodedBytes / rawBytes,
+        "ratioPerIcon": {"mean": mean(ratios), "median": median(ratios), "min": min(ratios), "max": max(ratios)},
+        "rawFallbacks": fallbacks,
+        "transferTimePerIcon": {"raw": transferTime(rawBytes / len(ratios), baudrate), "compressed": transferTime(encodedBytes / len(ratios), baudrate)},
+    }
+
+#Bytes written for each mode switch, with the first activation of each mode sent entirely
+def modeSwitches(cycles, compression, emulatorSettings):
+    emulator = Emulator(**emulatorSettings)
+    ser = EmulatedSerial(emulator)
+    device = Device()
+    device.useCompression = compression
+    if not device.connect(ser):
+        raise RuntimeError("Could not connect to the emulator.")
+    modes = [("Blender", ModeBlender()), ("Gimp", ModeGimp()), ("Fallback", ModeFallback(InkkeysMqtt(None)))]
+    switches = []
+    previous = None
+    for cycle in range(cycles):
+        for name, mode in modes:
+            before = ser.bytesWritten
+            if previous != None:
+                previous[1].deactivate(device)
+            mode.activate(device)
+            device.waitForRefresh()
+            device.flush()
+            switches.append({"cycle": cycle, "to": name, "bytesWritten": ser.bytesWritten - before})
+            previous = (name, mode)
+    previous[1].deactivate(device)
+    device.disconnect()
+    if len(emulator.errors) > 0:
+        raise RuntimeError("The emulator reported errors: " + str(emulator.errors))
+    return switches
+
+def run(cycles, baudrate, emulatorSettings):
+    icons = compressIcons(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "icons"), 2, baudrate)
+    raw = modeSwitches(cycles, False, emulatorSettings)
+    compressed = modeSwitches(cycles, True, emulatorSettings)
+    summary = {}
+    for name in ["Blender", "Gimp", "Fallback"]:
+        rawBytes = mean(s["bytesWritten"] for s in raw if s["to"] == name)
+        compressedBytes = mean(s["bytesWritten"] for s in compressed if s["to"] == name)
+        summary[name] = {
+            "rawBytes": rawBytes,
+            "compressedBytes": compressedBytes,
+            "ratio": compressedBytes / rawBytes,
+            "rawTransferTime": transferTime(rawBytes, baudrate),
+            "compressedTransferTime": transferTime(compressedBytes, baudrate),
+            "savedTransferTime": transferTime(rawBytes - compressedBytes, baudrate),
+        }
+    return {"icons": icons, "modeSwitches": summary, "switches": {"raw": raw, "compressed": compressed}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the compression of icons and mode switches against the inkkeys firmware emulator.")
+    parser.add_argument("--cycles", type=int, default=3, help="Number of times to cycle through all modes")
+    parser.add_argument("--baudrate", type=int, default=Emulator.baudrate, help="Serial transfer rate used to calculate transfer times")
+    parser.add_argument("--no-frames", action="store_true", help="Emulate firmware without binary frames, so the text protocol is used")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    settings = {"baudrate": args.baudrate, "timeScale": 0.0, "frameSupport": not args.no_frames} #Transfer times are calculated, so the emulator runs as fast as possible
+    with redirect_stdout(sys.stderr): #Keep the output of the device and modes out of the JSON
+        result = run(args.cycles, args.baudrate, settings)
+    result = dict({"benchmark": "compression", "timestamp": time.time(), "cycles": args.cycles, "emulator": settings}, **result)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
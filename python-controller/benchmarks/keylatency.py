@@ -0,0 +1,67 @@
+#Benchmark of the latency from a key press to its effect. It activates ModeBlender, ModeGimp and ModeFallback on the
+#firmware emulator, triggers every key and jog event that has a callback in the mode and reports the p50/p99 latency
+#per key and per mode as JSON: until the callback returned and until the first command of each priority class it
+#caused (control, led, image) has been written to the serial port (see inkkeys/latency.py).
+#
+#Run from the python-controller directory:
+#   python3 benchmarks/keylatency.py --presses 20 --output keylatency.json
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import time
+from contextlib import redirect_stdout
+
+from inkkeys import *
+from modes import ModeBlender, ModeGimp, ModeFallback
+from mqtt import InkkeysMqtt
+
+#Lets the emulator report the event for the callback key. Keys are pressed and released, so callbacks for either work.
+def trigger(emulator, key, i):
+    if key == KeyCode.JOG.value:
+        emulator.rotate(1 if i % 2 == 0 else -1)
+    else:
+        emulator.pressKey(int(key[0]))
+        emulator.releaseKey(int(key[0]))
+
+def run(presses, interval, emulatorSettings):
+    emulator = Emulator(**emulatorSettings)
+    device = Device()
+    if not device.connect(EmulatedSerial(emulator)):
+        raise RuntimeError("Could not connect to the emulator.")
+
+    for mode in [ModeBlender(), ModeGimp(), ModeFallback(InkkeysMqtt(None))]:
+        device.latency.mode = type(mode).__name__ #Same names as used by the controller
+        mode.activate(device)
+        device.waitForRefresh()
+        for key in sorted(device.callbacks.keys()):
+            for i in range(presses):
+                trigger(emulator, key, i)
+                time.sleep(interval) #Give the callback and the refresh it requested time to finish
+                device.waitForRefresh()
+                device.flush()
+        mode.deactivate(device)
+    device.disconnect()
+    return device.latency.stats()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the latency from key events to their effect against the inkkeys firmware emulator.")
+    parser.add_argument("--presses", type=int, default=20, help="Number of events per key with a callback")
+    parser.add_argument("--interval", type=float, default=0.1, help="Seconds between two events")
+    parser.add_argument("--baudrate", type=int, default=Emulator.baudrate, help="Modeled serial transfer rate")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="Factor applied to all modeled delays (0 = as fast as possible)")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    settings = {"baudrate": args.baudrate, "timeScale": args.time_scale}
+    with redirect_stdout(sys.stderr): #Keep the output of the device and modes out of the JSON
+        stats = run(args.presses, args.interval, settings)
+    result = {"benchmark": "keylatency", "timestamp": time.time(), "presses": args.presses, "interval": args.interval, "emulator": settings, "latency": stats}
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
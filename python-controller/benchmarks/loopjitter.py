@@ -0,0 +1,86 @@
+#Benchmark of the frame times of the main loop. It runs a loop like controller.work() with ModeFallback against the
+#firmware emulator, once with the context (process list) retrieved inline as the controller used to do and once from
+#a ContextWorker in the background, and reports the frame times as JSON. A delay can be added to each scan to model a
+#slow process list or a hanging window system.
+#
+#Run from the python-controller directory:
+#   python3 benchmarks/loopjitter.py --duration 10 --scan-delay 0.1 --output loopjitter.json
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import time
+from contextlib import redirect_stdout
+from statistics import mean
+
+from inkkeys import *
+from modes import ModeFallback
+from mqtt import InkkeysMqtt
+from processchecks import getActiveProcesses
+from windowfocus import FakeFocusSource
+from contextworker import ContextWorker
+
+def frameStats(frameTimes):
+    ordered = sorted(frameTimes)
+    return {"frames": len(ordered), "mean": mean(ordered), "p99": ordered[int(0.99*(len(ordered)-1))], "max": ordered[-1]}
+
+def run(duration, scanInterval, scanDelay, background):
+    def scan():
+        time.sleep(scanDelay)
+        return getActiveProcesses()
+
+    device = Device()
+    if not device.connect(EmulatedSerial(Emulator(timeScale=0))):
+        raise RuntimeError("Could not connect to the emulator.")
+    mode = ModeFallback(InkkeysMqtt(None))
+    mode.activate(device)
+    device.waitForRefresh()
+
+    worker = None
+    if background:
+        worker = ContextWorker(FakeFocusSource(), scan)
+        worker.processInterval = scanInterval
+        worker.start()
+
+    frameTimes = []
+    lastScan = 0
+    end = time.time() + duration
+    while time.time() < end:
+        now = time.time()
+        if worker != None:
+            processes = worker.snapshot.processes
+        elif now - lastScan > scanInterval:
+            processes = scan()
+            lastScan = now
+        mode.animate(device)
+        device.poll()
+        frameTime = time.time() - now
+        frameTimes.append(frameTime)
+        if frameTime < 0.0333:
+            time.sleep(0.0333 - frameTime)
+
+    if worker != None:
+        worker.stop()
+    mode.deactivate(device)
+    device.disconnect()
+    return frameStats(frameTimes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure frame times of the main loop with inline and background context detection.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run each variant")
+    parser.add_argument("--scan-interval", type=float, default=1.0, help="Seconds between two scans of the process list")
+    parser.add_argument("--scan-delay", type=float, default=0.1, help="Additional time in seconds each scan takes, modeling a slow system")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with redirect_stdout(sys.stderr): #Keep the output of the device and modes out of the JSON
+        results = {"inline": run(args.duration, args.scan_interval, args.scan_delay, False), "background": run(args.duration, args.scan_interval, args.scan_delay, True)}
+    result = {"benchmark": "loopjitter", "timestamp": time.time(), "duration": args.duration, "scanInterval": args.scan_interval, "scanDelay": args.scan_delay, "results": results}
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
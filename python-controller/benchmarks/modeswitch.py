@@ -0,0 +1,95 @@
+#Benchmark of the latency of mode switches. It cycles through ModeBlender, ModeGimp and ModeFallback against the
+#firmware emulator and reports for each switch the wall time, the bytes and number of writes sent to the serial port
+#and the time spent blocked in updateDisplay() as JSON.
+#
+#Run from the python-controller directory:
+#   python3 benchmarks/modeswitch.py --cycles 5 --output modeswitch.json
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import time
+from contextlib import redirect_stdout
+from statistics import mean
+
+from inkkeys import *
+from modes import ModeBlender, ModeGimp, ModeFallback
+from mqtt import InkkeysMqtt
+
+#Wraps updateDisplay of the device instance to keep track of the time spent waiting for the refresh
+def instrumentUpdateDisplay(device):
+    originalUpdateDisplay = device.updateDisplay
+    device.blockedInUpdateDisplay = 0.0
+
+    def updateDisplay(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return originalUpdateDisplay(*args, **kwargs)
+        finally:
+            device.blockedInUpdateDisplay += time.perf_counter() - start
+
+    device.updateDisplay = updateDisplay
+
+def run(cycles, emulatorSettings):
+    ser = EmulatedSerial(Emulator(**emulatorSettings))
+    device = Device()
+    if not device.connect(ser):
+        raise RuntimeError("Could not connect to the emulator.")
+    instrumentUpdateDisplay(device)
+
+    modes = [("Blender", ModeBlender()), ("Gimp", ModeGimp()), ("Fallback", ModeFallback(InkkeysMqtt(None)))]
+    switches = []
+    previous = None
+    for cycle in range(cycles):
+        for name, mode in modes:
+            bytesBefore = ser.bytesWritten
+            writesBefore = ser.writeCalls
+            device.blockedInUpdateDisplay = 0.0
+            start = time.perf_counter()
+            if previous != None:
+                previous[1].deactivate(device)
+            mode.activate(device)
+            device.waitForRefresh() #Refreshs run in the background, but a switch is only done once the display shows the new mode
+            wallTime = time.perf_counter() - start
+            switches.append({
+                "cycle": cycle,
+                "from": previous[0] if previous != None else None,
+                "to": name,
+                "wallTime": wallTime,
+                "bytesWritten": ser.bytesWritten - bytesBefore,
+                "writeCalls": ser.writeCalls - writesBefore,
+                "updateDisplayTime": device.blockedInUpdateDisplay,
+            })
+            previous = (name, mode)
+    previous[1].deactivate(device)
+    device.disconnect()
+
+    summary = {}
+    for name, mode in modes:
+        results = [s for s in switches if s["to"] == name]
+        summary[name] = {key: {"mean": mean(s[key] for s in results), "min": min(s[key] for s in results), "max": max(s[key] for s in results)} for key in ["wallTime", "bytesWritten", "writeCalls", "updateDisplayTime"]}
+
+    return {"benchmark": "modeswitch", "timestamp": time.time(), "cycles": cycles, "emulator": emulatorSettings, "summary": summary, "switches": switches}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure mode switch latency against the inkkeys firmware emulator.")
+    parser.add_argument("--cycles", type=int, default=3, help="Number of times to cycle through all modes")
+    parser.add_argument("--baudrate", type=int, default=Emulator.baudrate, help="Modeled serial transfer rate")
+    parser.add_argument("--partial-refresh", type=float, default=Emulator.partialRefreshTime, help="Modeled duration of a partial refresh in seconds")
+    parser.add_argument("--full-refresh", type=float, default=Emulator.fullRefreshTime, help="Modeled duration of a full refresh in seconds")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Factor applied to all modeled delays (0 = as fast as possible)")
+    parser.add_argument("--no-frames", action="store_true", help="Emulate firmware without binary frames, so the text protocol is used")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    settings = {"baudrate": args.baudrate, "partialRefreshTime": args.partial_refresh, "fullRefreshTime": args.full_refresh, "timeScale": args.time_scale, "frameSupport": not args.no_frames}
+    with redirect_stdout(sys.stderr): #Keep the output of the device and modes out of the JSON
+        result = run(args.cycles, settings)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
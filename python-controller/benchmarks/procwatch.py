@@ -0,0 +1,139 @@
+#Benchmark of the process list. It creates a synthetic /proc with thousands of processes and compares a full scan
+#(reading the name of every process, which is what psutil.process_iter() does at least) with an update of ProcWatcher,
+#which only reads the names of new processes. Between two scans, a few processes are stopped and started. For
+#reference, psutil.process_iter() on the real system is measured as well. Finally, some processes call exec and some
+#PIDs are reused between two scans, which ProcWatcher has to notice within 2*recheckRounds updates. Results are reported
+#as JSON.
+#
+#Run from the python-controller directory:
+#   python3 benchmarks/procwatch.py --processes 5000 --churn 10 --output procwatch.json
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+from statistics import mean
+
+import psutil
+from processchecks import ProcWatcher
+
+names = ["bash", "python3", "obs", "gimp-2.10", "blender", "firefox", "kworker/0:1", "systemd", "sshd", "Xorg"]
+
+#Writes comm and stat like an exec does. The start time is field 22 of stat.
+def execProcess(root, pid, rng, startTime):
+    name = rng.choice(names)
+    with open(os.path.join(root, str(pid), "comm"), "w") as f:
+        f.write(name + "\n")
+    with open(os.path.join(root, str(pid), "stat"), "w") as f:
+        f.write(str(pid) + " (" + name + ") S " + "0 "*18 + str(startTime) + " 0 0\n")
+
+def startProcess(root, pid, rng, startTime):
+    os.mkdir(os.path.join(root, str(pid)))
+    execProcess(root, pid, rng, startTime)
+
+def stopProcess(root, pid):
+    shutil.rmtree(os.path.join(root, str(pid)))
+
+def fullScan(root):
+    result = set()
+    for entry in os.listdir(root):
+        if entry.isdigit():
+            try:
+                with open(os.path.join(root, entry, "comm")) as f:
+                    result.add(f.read().rstrip("\n"))
+            except OSError:
+                pass
+    return result
+
+def fullCounts(root):
+    result = {}
+    for entry in os.listdir(root):
+        if entry.isdigit():
+            with open(os.path.join(root, entry, "comm")) as f:
+                name = f.read().rstrip("\n")
+            result[name] = result.get(name, 0) + 1
+    return result
+
+def run(processes, churn, scans):
+    rng = random.Random(0)
+    root = tempfile.mkdtemp(prefix="inkkeys-proc-")
+    try:
+        pids = list(range(1, processes+1))
+        for pid in pids:
+            startProcess(root, pid, rng, pid)
+        nextPid = processes+1
+        startTimes = {pid: pid for pid in pids}
+
+        watcher = ProcWatcher(root)
+        start = time.perf_counter()
+        watcher.update()
+        initialUpdate = time.perf_counter() - start
+
+        fullTimes = []
+        watcherTimes = []
+        for scan in range(scans):
+            for i in range(churn):
+                stopProcess(root, pids.pop(rng.randrange(len(pids))))
+                startProcess(root, nextPid, rng, nextPid)
+                startTimes[nextPid] = nextPid
+                pids.append(nextPid)
+                nextPid += 1
+
+            start = time.perf_counter()
+            expected = fullScan(root)
+            fullTimes.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            watcher.update()
+            watcherTimes.append(time.perf_counter() - start)
+
+            if watcher.names() != expected:
+                raise RuntimeError("ProcWatcher does not match the full scan.")
+
+        for i in range(churn):
+            pid = rng.choice(pids)
+            execProcess(root, pid, rng, startTimes[pid]) #Same process, different program
+            pid = rng.choice(pids)
+            stopProcess(root, pid)
+            startProcess(root, pid, rng, nextPid) #Reused PID, different start time
+            startTimes[pid] = nextPid
+            nextPid += 1
+        expected = fullScan(root)
+        for i in range(2*watcher.recheckRounds):
+            watcher.update()
+        if watcher.names() != expected or watcher.counts != fullCounts(root):
+            raise RuntimeError("ProcWatcher does not notice exec and reused PIDs.")
+    finally:
+        shutil.rmtree(root)
+
+    start = time.perf_counter()
+    {p.name() for p in psutil.process_iter(["name"])}
+    psutilTime = time.perf_counter() - start
+
+    return {
+        "fullScan": {"mean": mean(fullTimes), "max": max(fullTimes)},
+        "procWatcher": {"mean": mean(watcherTimes), "max": max(watcherTimes), "initial": initialUpdate},
+        "speedup": mean(fullTimes) / mean(watcherTimes),
+        "psutilOnThisSystem": {"time": psutilTime, "processes": len(psutil.pids())},
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full process scans with the incremental ProcWatcher.")
+    parser.add_argument("--processes", type=int, default=5000, help="Number of synthetic processes")
+    parser.add_argument("--churn", type=int, default=10, help="Processes stopped and started between two scans")
+    parser.add_argument("--scans", type=int, default=20, help="Number of scans")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    result = {"benchmark": "procwatch", "timestamp": time.time(), "processes": args.processes, "churn": args.churn, "scans": args.scans, "results": run(args.processes, args.churn, args.scans)}
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
@@ -0,0 +1,71 @@
+#Benchmark of the image transfer rate. It sends full-screen images to the firmware emulator with and without the credit
+#handshake and reports the achieved bytes per second of image data, compared to the modeled rate of the serial link,
+#as JSON.
+#
+#Run from the python-controller directory:
+#   python3 benchmarks/throughput.py --images 5 --output throughput.json
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import random
+import time
+from contextlib import redirect_stdout
+
+from inkkeys import *
+
+def run(images, credits, emulatorSettings):
+    ser = EmulatedSerial(Emulator(**emulatorSettings))
+    device = Device()
+    device.useCredits = credits
+    if not device.connect(ser):
+        raise RuntimeError("Could not connect to the emulator.")
+
+    rng = random.Random(0)
+    size = device.dispW*device.dispH//8
+    bytesBefore = ser.bytesWritten
+    start = time.perf_counter()
+    for i in range(images):
+        device.sendPackedImage(0, 0, device.dispW, device.dispH, bytes(rng.getrandbits(8) for j in range(size)))
+        device.flush()
+        ser.drain() #Wait until the emulator has written the last row
+    wallTime = time.perf_counter() - start
+    bytesWritten = ser.bytesWritten - bytesBefore
+    writer = device.writer.stats()
+    device.disconnect()
+
+    linkRate = emulatorSettings["baudrate"] / 10 / emulatorSettings["timeScale"] if emulatorSettings["timeScale"] > 0 else None
+    rate = bytesWritten / wallTime
+    return {
+        "credits": writer["credits"],
+        "wallTime": wallTime,
+        "bytesWritten": bytesWritten,
+        "rate": rate,
+        "writerRate": writer["rate"],
+        "linkRate": linkRate,
+        "utilization": rate / linkRate if linkRate != None else None,
+        "creditWaitTime": writer["creditWaitTime"],
+        "creditTimeouts": writer["creditTimeouts"],
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the image transfer rate against the inkkeys firmware emulator.")
+    parser.add_argument("--images", type=int, default=3, help="Number of full-screen images to send")
+    parser.add_argument("--baudrate", type=int, default=Emulator.baudrate, help="Modeled serial transfer rate")
+    parser.add_argument("--row-write", type=float, default=Emulator.rowWriteTime, help="Modeled time in seconds the firmware needs to write a row to the display")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Factor applied to all modeled delays (0 = as fast as possible)")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    settings = {"baudrate": args.baudrate, "rowWriteTime": args.row_write, "timeScale": args.time_scale}
+    with redirect_stdout(sys.stderr): #Keep the output of the device out of the JSON
+        results = {"paced": run(args.images, False, settings), "credits": run(args.images, True, settings)}
+    result = {"benchmark": "throughput", "timestamp": time.time(), "images": args.images, "emulator": settings, "results": results}
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
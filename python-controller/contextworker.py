@@ -0,0 +1,77 @@
+#Detection of the context (active window and running processes) in a background thread. The main loop only reads the
+#latest snapshot, so a slow process scan or a hanging call to the window system cannot delay LED animations or the
+#handling of the device.
+
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from processchecks import getActiveProcesses
+from inkkeys.trace import tracer
+
+#The version is incremented whenever the window or the set of processes changes, processVersion only for the latter
+ContextSnapshot = namedtuple("ContextSnapshot", ["window", "processes", "version", "processVersion"])
+
+class ContextWorker:
+    processInterval = 5.0   #Seconds between two scans of the process list
+    activityCallback = None #Called whenever a new snapshot has been published
+
+    def __init__(self, focusSource, getProcesses=getActiveProcesses):
+        self.focusSource = focusSource
+        self.getProcesses = getProcesses
+        self.lock = threading.Lock()
+        self.snapshot = ContextSnapshot(None, frozenset(), 0, 0)
+        self.stopped = threading.Event()
+        self.thread = None
+
+        #Statistics
+        self.scans = 0
+        self.scanTime = 0.0
+        self.maxScanTime = 0.0
+
+    def start(self):
+        self.focusSource.addListener(self.onFocus)
+        self.onFocus(self.focusSource.window)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="inkkeys-context", daemon=True)
+        self.thread.start()
+
+    def publish(self, window=None, processes=None):
+        with self.lock:
+            current = self.snapshot
+            window = window if window != None else current.window #If no window has the focus, we stay with the last one
+            processes = processes if processes != None else current.processes
+            if window == current.window and processes == current.processes:
+                return
+            processVersion = current.processVersion if processes == current.processes else current.processVersion + 1
+            self.snapshot = ContextSnapshot(window, processes, current.version + 1, processVersion)
+        if self.activityCallback != None:
+            self.activityCallback()
+
+    #Called by the focus source
+    def onFocus(self, window):
+        with tracer.span("focus change", "context", window=window):
+            self.publish(window=window)
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            try:
+                with tracer.span("process scan", "context"):
+                    processes = frozenset(self.getProcesses())
+            except Exception:
+                print("Could not get the process list:")
+                traceback.print_exc()
+                processes = None
+            t = time.perf_counter() - start
+            self.scans += 1
+            self.scanTime += t
+            self.maxScanTime = max(self.maxScanTime, t)
+            self.publish(processes=processes)
+            self.stopped.wait(self.processInterval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join(2)
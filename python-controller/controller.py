@@ -2,18 +2,34 @@ SERIALPORT = None #None = Auto-detect, to specify a specific serial port, you ca
 VID = 0x1b4f      #USB Vendor ID for a Pro Micro
 PID = 0x9206      #USB Product ID for a Pro Micro
 DEBUG = False     #More output on the command line
+METRICS_PORT = None #Set to a port (like 9464) to serve metrics in the Prometheus format on http://127.0.0.1:<port>/metrics
+METRICS_FILE = None #Set to a file name to rewrite the metrics to this file every 15 seconds instead (e.g. for the textfile collector of the node exporter)
 
 from inkkeys import *        #Inkkeys module
 from processchecks import *  #Functions to check for active processes and windows
+from windowfocus import createFocusSource #Reports changes of the active window as they happen
+from contextworker import ContextWorker   #Keeps track of the active window and the processes in the background
+from moderesolver import ModeResolver     #Finds the mode for the active window and processes
+from loopscheduler import LoopScheduler   #Timers of the main loop
+from inkkeys.metrics import registry, LoopMetrics, MetricsServer, MetricsFileWriter #Counters and histograms about the device and the main loop
+from inkkeys.trace import tracer #Records spans of the main loop and the device as Chrome trace
 from modes import *          #Definitions of the hotkey functions in different "modes"
 from mqtt import InkkeysMqtt #A small class to encapsule MQTT specific functions. You will need to adapt this to your needs if you want to use this.
 
+import argparse                     #Command line options
 import time                         #Time functions
+import threading                    #Wake up the main loop from other threads
 from serial import SerialException  #Serial functions
 import serial.tools.list_ports      #Function to iterate over serial ports
 import re                           #Regular expressions process name matching
 import traceback                    #Print tracebacks if an error is thrown and caught
 
+parser = argparse.ArgumentParser(description="Controller for the inkkeys macro keyboard.")
+parser.add_argument("--trace", metavar="FILE", help="Record what the controller does and write it to FILE when quitting. The file is in the Chrome trace format and can be opened in chrome://tracing or https://ui.perfetto.dev")
+args = parser.parse_args()
+if args.trace != None:
+    tracer.enable()
+
 print("https://there.oughta.be/a/macro-keyboard")
 print('I will try to stay connected. Press Ctrl+c to quit.')
 
@@ -41,64 +57,113 @@ modes = [\
 
 # Usually there should not be anything to be customized below this point
 
+modeResolver = ModeResolver(modes) #Combines the window patterns of all modes and remembers its decisions
+loopMetrics = LoopMetrics(registry) #Frame times and overruns of the main loop
+
+############################################################################################################
+
+#Prints the p50 and p99 latency from key events to their callbacks and resulting commands (see inkkeys/latency.py)
+def printLatencies(stats):
+    for name, title in (("byKey", "key"), ("byMode", "mode")):
+        for kind, summaries in sorted(stats[name].items()):
+            print("Latency to {} by {} (p50/p99 ms): ".format(kind, title) + ", ".join("{} {:.1f}/{:.1f}".format(label, s["p50"]*1000, s["p99"]*1000) for label, s in sorted(summaries.items())))
+
 ############################################################################################################
 
 #If we found the device, successfully connected and retreived its information, we enter this work function,
 #which primarily consists of an infinite loop that only returns if we hit Ctrl+C (or kill the process).
 
+#The loop does not run at a fixed rate. It sleeps until the next timer (mode.poll, mode.animate) is due or until something
+#happens (the context changes, a key is pressed or LEDs are set), so it hardly uses any CPU while nothing is animated.
+
 def work():
     mode = None             #Current mode of the device (i.e. key mappings for specific process).
-    pollInterval = 0        #Polling interval as requested by the module when the last call to "poll" was made
-    lastPoll = 0            #Keeps track of the last time the poll function of the mode instance was called
-    lastProcessList = 0     #Keeps track of the last time the list of processes was retrieved
-    lastModeCheck = 0       #Keeps track of the last time the current window was checked and a decision about the mode was made
+    pollTimer = None        #Timer calling mode.poll() in the interval it requests
+    animationTimer = None   #Timer calling mode.animate() while it animates something
+    contextVersion = -1     #Version of the context snapshot when the mode was last decided (-1 to decide right away)
+    maxFrameTime = 0        #Longest iteration of the main loop since the last report
+    lastFrameReport = time.time()
+    scheduler = LoopScheduler()
+    loopThread = threading.current_thread()
+    restartAnimation = threading.Event() #Something happened that might need an animation (LEDs set, key pressed...)
+
+    def wake():
+        if threading.current_thread() is not loopThread: #Changes made by the loop itself are handled without waking it up
+            restartAnimation.set()
+            scheduler.wake()
+
+    def poll():
+        with tracer.span("mode.poll", "loop", mode=type(mode).__name__):
+            interval = mode.poll(device)
+        restartAnimation.set() #The mode might have set the LEDs
+        return interval
+
+    def animate(mode):
+        with tracer.span("mode.animate", "loop", mode=type(mode).__name__):
+            return mode.animate(device)
+
+    device.activityCallback = wake
+    contextWorker.activityCallback = wake
+    scheduler.schedule(1.0, lambda: 1.0) #Wake up at least once per second, so device.poll() notices a lost connection
     mqtt.connect()          #Connect to the MQTT server (if used)
     try:
         while True:     #Now we are in our main, infinite loop -------------------
+            scheduler.runOnce()     #Sleep until something happens and run the timers that are due
             now = time.time() #Time of this iteration
 
-            if now - lastProcessList > 5.0:      # Only check the process list every 5 seconds.
-                processes = getActiveProcesses() # This is a surprisingly expensive and slow call, so don't overdo as it might prevent smooth LED animation (fixable by implementing a second thread) and burn more CPU resources than you might want from a background process
-                lastProcessList = now
-
-            if now - lastModeCheck > 0.5:       # Check active window and decide which mode to use. This can be done more regularly, but since the e-ink screen takes a moment to update, it does not make sense to check more frequently
-                window = getActiveWindow()      # Get the currently active window
-                if window != None:              # Sometime getting the active window fails, then ignore it. (Some window managers allow having no window in focus)
-                    activeWindow = window
-                    if DEBUG:                   #Enable DEBUG to see the actual name of the current window if you need it to match your modules
-                        print("Active window: " + str(activeWindow))
-
-                for i in modes:                 #Iterate over modes and use the first one that matches
-                    if ("process" in i and i["process"] in processes) or ("activeWindow" in i and i["activeWindow"].match(activeWindow)) or not ("process" in i or "activeWindow" in i):
-                        #Either the process for this mode is running or the active window matches the regular expression. This is the mode we will set now.
-                        if i["mode"] != mode:           # Do not set the mode again if we already have this one
-                            if mode != None:            
+            with tracer.span("window check", "loop"):
+                context = contextWorker.snapshot     # The latest active window and process list. Both are retrieved in a background thread, as the process list is a surprisingly expensive and slow call on some platforms and would prevent smooth LED animation.
+            if context.version != contextVersion: # Decide which mode to use if the active window or the processes have changed
+                contextVersion = context.version
+                activeWindow = context.window if context.window != None else ""
+                if DEBUG:                       #Enable DEBUG to see the actual name of the current window if you need it to match your modules
+                    print("Active window: " + str(activeWindow))
+
+                with tracer.span("mode resolution", "loop", window=activeWindow):
+                    i = modeResolver.resolve(activeWindow, context.processes, context.processVersion) #The first mode in the list with a running process or matching active window
+                if i != None and i["mode"] != mode:     # Do not set the mode again if we already have this one
+                    with device.modeLock:               # Callbacks run in the background, so wait for a running one and keep the others until the new mode is set up
+                        if mode != None:
+                            with tracer.span("mode.deactivate", "loop", mode=type(mode).__name__):
                                 mode.deactivate(device) # If there was a previous mode, call its deactivate function
-                            mode = i["mode"]            # Set new mode
+                        mode = i["mode"]                # Set new mode
+                        loopMetrics.modeSwitches.inc(1, type(mode).__name__)
+                        device.latency.mode = type(mode).__name__ #Key latencies are also collected per mode
+                        with tracer.span("mode.activate", "loop", mode=type(mode).__name__):
                             mode.activate(device)       # ...and call its activate function
-                            pollInterval = 0            # Reset the poll intervall to call mode.poll() at least once (see below)
-                        break
-                lastModeCheck = now
-
-            if pollInterval >= 0 and now - lastPoll > pollInterval:    #Regularly call the poll function of the mode if it requires regular polling
-                #The poll function returns the desired interval when it should be called next - or False if polling is not required in this mode
-                pollInterval = mode.poll(device)
-                lastPoll = now
-
-            #Now for the functions that need to be called very often and fast:
-            mode.animate(device)    #Used for LED animations
-            device.poll()           #Required for the callbacks that are associated with key presses reported via serial
-
-            #If the actions so far did take less than 1/30 seconds, sleep until 1/30s have passed as there is no need to exceed 30fps
-            timeTo30fps = time.time() - now + 0.0333
-            if timeTo30fps > 0:
-                time.sleep(timeTo30fps)
+                    #The poll function returns the desired interval when it should be called next - or False if polling is not required in this mode
+                    scheduler.cancel(pollTimer)
+                    pollTimer = scheduler.schedule(0, poll)
+                    restartAnimation.set()
+
+            #The animate function also returns an interval or False. It is started again after anything happened that might need an animation.
+            if mode != None and restartAnimation.is_set():
+                restartAnimation.clear()
+                scheduler.cancel(animationTimer)
+                animationTimer = scheduler.schedule(0, lambda mode=mode: animate(mode))
+
+            with tracer.span("device.poll", "loop"):
+                device.poll()       #Key presses are handled by a background thread of the device, but this raises an exception if the connection has been lost
+
+            frameTime = time.time() - scheduler.wokenAt #Including the timers that have been run by runOnce()
+            loopMetrics.observeFrame(frameTime)
+            tracer.complete("frame", "loop", frameTime, overrun=frameTime > loopMetrics.frameBudget)
+            maxFrameTime = max(maxFrameTime, frameTime)
+            if DEBUG and now - lastFrameReport > 10.0:    #Report the longest frame, which should stay well below 1/30s for smooth animations, and how often the loop wakes up
+                print("Max frame time: {:.1f} ms, wakeups per second: {:.1f}".format(maxFrameTime*1000, scheduler.wakeupsPerSecond()))
+                printLatencies(device.latency.stats())
+                maxFrameTime = 0
+                lastFrameReport = now
+                scheduler.resetStats()
                     #End of main loop -------------------------------------------
 
 
     except KeyboardInterrupt:       #User pressed Ctrl+c
         mqtt.disconnect()
         print('Disconnected from device. Hit Ctrl+c again to quit before reconnect.')
+    finally:
+        device.activityCallback = None
+        contextWorker.activityCallback = None
 
 
 #Try connecting on the given port and work with it.
@@ -108,7 +173,6 @@ def tryUsingPort(port):
     try:
         if device.connect(port):
             work()  #Success, enter main loop
-            device.disconnect()
             return True
     except SerialException as e:
         print("Serial error: ", e)
@@ -117,11 +181,25 @@ def tryUsingPort(port):
         if DEBUG:
             print(traceback.format_exc())
         print("Error: ", sys.exc_info()[0])
+    finally:
+        device.disconnect() #Also after a lost connection, so the background threads of the device stop and the port is closed
     return False
 
 # Instantiate the device
 device = Device()
 device.debug = DEBUG
+
+# Export metrics if configured
+if METRICS_PORT != None:
+    MetricsServer(registry, METRICS_PORT).start()
+if METRICS_FILE != None:
+    MetricsFileWriter(registry, METRICS_FILE).start()
+
+# Start watching the active window and the processes
+focusSource = createFocusSource()
+focusSource.start()
+contextWorker = ContextWorker(focusSource)
+contextWorker.start()
 try:
     while True:
         if SERIALPORT != None:  #Explicit port has been defined
@@ -136,5 +214,8 @@ try:
         time.sleep(3)
 except KeyboardInterrupt:       #User pressed Ctrl+c
     print('Ok, bye.')
+finally:
+    if args.trace != None:
+        tracer.save(args.trace)
 
 
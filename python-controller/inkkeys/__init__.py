@@ -1,3 +1,7 @@
 from .protocol import *
 from .device import *
+from .asyncdevice import *
+from .scene import *
+from .leds import *
+from .emulator import *
 
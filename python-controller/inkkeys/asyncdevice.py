@@ -0,0 +1,347 @@
+#Asyncio variant of Device. Replies of the device are delivered as futures, so a single event loop can serve the
+#serial link together with other asynchronous connections (OBS websockets, MQTT...). Rendering, the shadow framebuffer
+#and the caches are shared with the regular Device class, which is used internally.
+#
+#Example:
+#   device = AsyncDevice()
+#   await device.connect("/dev/ttyACM0")
+#   await device.sendIconFor(2, "icons/play.png")
+#   await device.updateDisplay(timeout=5)
+
+from .protocol import *
+from .device import Device
+from .trace import tracer
+from .latency import currentEvent
+from .frames import FrameDecoder
+import asyncio
+import serial
+import time
+import traceback
+from collections import deque
+
+#Device that hands received lines to an AsyncDevice instead of queueing them for threads
+class _LoopDevice(Device):
+    dispatchInBackground = False
+
+    def __init__(self, owner):
+        super().__init__()
+        self.owner = owner
+
+    #Uses the event loop to watch the serial port if it has a file descriptor. Otherwise (Windows or EmulatedSerial) a reader thread hands the data to the loop.
+    def startReader(self):
+        self.decoder = FrameDecoder()
+        self.readerError = None
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, OSError, serial.SerialException):
+            fd = None
+        if fd != None:
+            self.owner.loop.add_reader(fd, self.readAvailable, self.ser, fd)
+            self.owner.readerFd = fd
+        else:
+            super().startReader()
+
+    def readAvailable(self, ser, fd):
+        try:
+            data = ser.read(max(1, ser.in_waiting))
+        except Exception as e:
+            self.owner.loop.remove_reader(fd)
+            self.owner.connectionLost(e)
+            return
+        self.receive(data)
+
+    def readLoop(self, ser):
+        super().readLoop(ser)
+        if self.readerError != None:
+            self.owner.loop.call_soon_threadsafe(self.owner.connectionLost, self.readerError)
+
+    def onEvent(self, line, arrival):
+        self.owner.callFromReader(self.owner.handleEvent, line, arrival)
+
+    def onResponse(self, line):
+        self.owner.callFromReader(self.owner.handleResponse, line)
+
+
+#Collects the reply to a command. feed() is called for each line and returns True once the reply is complete.
+class _Waiter:
+    def __init__(self, future, feed):
+        self.future = future
+        self.feed = feed
+        self.expires = None     #Once the command timed out, the waiter consumes a late reply until then, so the reply cannot complete the next command
+
+
+class AsyncDevice:
+    latencyHistory = 100    #Number of latency measurements kept per command
+    lateReplyTimeout = 5.0  #Seconds a reply to a command that timed out or was cancelled is still expected
+
+    def __init__(self, device=None):
+        self.device = device if device != None else _LoopDevice(self)
+        self.loop = None
+        self.readerFd = None
+        self.waiters = deque()  #Commands waiting for their reply, in the order they were sent
+        self.commandLock = None
+        self.latency = {}       #Round trip times by CommandCode
+
+    #Properties of the connected device
+    @property
+    def nLeds(self):
+        return self.device.nLeds
+
+    @property
+    def dispW(self):
+        return self.device.dispW
+
+    @property
+    def dispH(self):
+        return self.device.dispH
+
+    @property
+    def rotCircleSteps(self):
+        return self.device.rotCircleSteps
+
+    @property
+    def debug(self):
+        return self.device.debug
+
+    @debug.setter
+    def debug(self, value):
+        self.device.debug = value
+
+    #Connect to the device on the serial port "dev" or an already opened serial port object. Returns False if the device does not answer within timeout seconds.
+    async def connect(self, dev, timeout=3):
+        self.loop = asyncio.get_running_loop()
+        self.commandLock = asyncio.Lock()
+        print("Connecting to ", dev, ".")
+        if isinstance(dev, str):
+            self.device.ser = serial.Serial(dev, 115200, timeout=0)
+        else:
+            self.device.ser = dev
+        self.device.startTransmitter()
+        self.device.startReader()
+        try:
+            await self.requestInfo(timeout)
+        except asyncio.TimeoutError:
+            await self.disconnect()
+            return False
+        if self.device.testmode:
+            print("Connection to ", self.device.ser.name, " was successfull, but the device is running the hardware test firmware, which cannot be used for anything but testing. Please flash the proper inkkeys firmware to use it.")
+            return False
+        if self.device.creditSupport and self.device.useCredits:
+            try:
+                await self.enableCredits(timeout)
+            except asyncio.TimeoutError:
+                print("The device did not confirm the credit handshake, sending images without it.")
+        if self.device.frameSupport and self.device.useFrames:
+            try:
+                await self.enableFrames(timeout)
+            except asyncio.TimeoutError:
+                print("The device did not confirm binary frames, using text commands.")
+        self.device.compressing = self.device.rleSupport and self.device.useCompression
+        self.device.resetState()
+        print("Connected to ", self.device.ser.name, ".")
+        return True
+
+    async def disconnect(self):
+        if self.readerFd != None:
+            self.loop.remove_reader(self.readerFd)
+            self.readerFd = None
+        self.device.disconnect()
+        self.failWaiters(ConnectionError("Disconnected."))
+
+    def callFromReader(self, function, *args):
+        if self.readerFd != None:
+            function(*args) #Already running in the event loop
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def connectionLost(self, e):
+        print("Serial error: ", e)
+        self.device.readerError = e
+        self.failWaiters(serial.SerialException(e))
+
+    def failWaiters(self, e):
+        while len(self.waiters) > 0:
+            waiter = self.waiters.popleft()
+            if not waiter.future.done():
+                waiter.future.set_exception(e)
+
+    def handleResponse(self, line):
+        now = time.perf_counter()
+        while len(self.waiters) > 0 and self.waiters[0].expires != None and now > self.waiters[0].expires:
+            self.waiters.popleft() #The device will not answer that command anymore
+        if len(self.waiters) == 0:
+            if self.device.debug:
+                print("Unexpected reply: " + line)
+            return
+        waiter = self.waiters[0]
+        if waiter.feed(line):
+            self.waiters.popleft()
+            if not waiter.future.done():
+                waiter.future.set_result(True)
+
+    def handleEvent(self, line, arrival=None):
+        if line[0] == KeyCode.JOG.value:
+            callback = self.device.callbacks.get(KeyCode.JOG.value)
+            args = (int(line[1:]),)
+        else:
+            callback = self.device.callbacks.get(line)
+            args = ()
+        if callback == None:
+            return
+        key = line if len(args) == 0 else KeyCode.JOG.value
+        event = self.device.latency.event(line, arrival)
+        token = currentEvent.set(event) #Also copied into the context of the task of a coroutine, so its commands carry the event as well
+        try:
+            with self.device.metrics.callbackTime.time(key), tracer.span("callback " + key, "device", input=line): #Coroutines are only started here, their time is not included
+                result = callback(*args)
+            if asyncio.iscoroutine(result):
+                task = self.loop.create_task(result)
+                task.add_done_callback(lambda task: self.callbackDone(task, line, key, event))
+            else:
+                self.device.latency.record(event, "callback")
+        except Exception:
+            #A broken callback should neither stop other keys from working nor the handling of the rest of the data that has been read with the event
+            self.callbackFailed(line, key)
+            self.device.latency.record(event, "callback")
+        finally:
+            currentEvent.reset(token)
+
+    def callbackDone(self, task, line, key, event):
+        self.device.latency.record(event, "callback")
+        if not task.cancelled() and task.exception() != None:
+            self.callbackFailed(line, key, task.exception())
+
+    def callbackFailed(self, line, key, e=None):
+        print("Error in callback for ", line, ":")
+        if e != None:
+            traceback.print_exception(type(e), e, e.__traceback__)
+        else:
+            traceback.print_exc()
+        self.device.metrics.callbackErrors.inc(1, key)
+
+    #Sends a command and waits until feed() reports its reply to be complete. Raises asyncio.TimeoutError if this takes longer than timeout seconds.
+    async def command(self, code, command, feed, timeout):
+        waiter = _Waiter(self.loop.create_future(), feed)
+        self.waiters.append(waiter)
+        start = time.perf_counter()
+        self.device.sendToDevice(command)
+        try:
+            with tracer.asyncSpan("wait " + code.name, "device", command=command): #Other tasks run while waiting, so this is not a span of the thread
+                done, pending = await asyncio.wait({waiter.future}, timeout=timeout)
+        except asyncio.CancelledError:
+            #The device will probably still answer, so the waiter stays in the queue for a while to consume the reply
+            waiter.expires = time.perf_counter() + self.lateReplyTimeout
+            waiter.future.cancel()
+            raise
+        if not done:
+            #The device did not answer in time. The waiter stays in the queue for a while to consume a late reply, which would otherwise complete the next command.
+            waiter.expires = time.perf_counter() + self.lateReplyTimeout
+            waiter.future.cancel()
+            raise asyncio.TimeoutError(command + " timed out after " + str(timeout) + " seconds.")
+        waiter.future.result() #Raises if the connection has been lost
+        self.recordLatency(code, time.perf_counter() - start)
+
+    def recordLatency(self, code, t):
+        if code not in self.latency:
+            self.latency[code] = deque(maxlen=self.latencyHistory)
+        self.latency[code].append(t)
+
+    #Returns the last, mean and maximum round trip time per command name
+    def latencyStats(self):
+        return {code.name: {"last": times[-1], "mean": sum(times)/len(times), "max": max(times), "count": len(times)} for code, times in self.latency.items()}
+
+    async def requestInfo(self, timeout=3):
+        async with self.commandLock:
+            print("Requesting device info...")
+            state = {"header": False}
+
+            def feed(line):
+                if not state["header"]:
+                    if line == "Inkkeys":
+                        state["header"] = True
+                    else:
+                        print("Skipping: ", line)
+                    return False
+                if line == "Done":
+                    return True
+                if not self.device.parseInfo(line):
+                    print("Skipping: ", line)
+                return False
+
+            start = time.perf_counter()
+            await self.command(CommandCode.INFO, CommandCode.INFO.value, feed, timeout)
+            self.device.metrics.infoTime.observe(time.perf_counter() - start)
+            print("End of info received.")
+            self.device.printInfo()
+            return True
+
+    async def enableCredits(self, timeout=3):
+        async with self.commandLock:
+            await self.command(CommandCode.CREDIT, CommandCode.CREDIT.value + " 1", lambda line: line == "ok", timeout)
+            self.device.writer.enableCredits()
+
+    async def enableFrames(self, timeout=3):
+        async with self.commandLock:
+            await self.command(CommandCode.FRAMES, CommandCode.FRAMES.value + " 1", lambda line: line == "ok", timeout)
+            self.device.framing = True
+
+    async def assignKey(self, key, sequence):
+        self.device.assignKey(key, sequence)
+
+    async def setLeds(self, leds):
+        self.device.setLeds(leds)
+
+    async def sendImage(self, x, y, image):
+        return self.device.sendImage(x, y, image)
+
+    async def sendImageFor(self, function, image):
+        self.device.sendImageFor(function, image)
+
+    async def sendTextFor(self, function, text, subtext="", inverted=False):
+        self.device.sendTextFor(function, text, subtext, inverted)
+
+    async def sendIconFor(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
+        self.device.sendIconFor(function, icon, inverted, centered, marked, crossed)
+
+    #Refreshes the display. Unlike Device.updateDisplay, this raises asyncio.TimeoutError if the device does not confirm the refresh in time.
+    async def updateDisplay(self, fullRefresh=False, timeout=5):
+        isOk = lambda line: line == "ok"
+        refreshType = RefreshTypeCode.FULL if fullRefresh else RefreshTypeCode.PARTIAL
+        async with self.commandLock:
+            parts = self.device.takeImageBuffer()
+            if not fullRefresh and len(parts) == 0:
+                return True #Nothing has changed since the last refresh
+            start = time.perf_counter()
+            deadline = start + timeout
+            try:
+                await self.flush(timeout) #Refresh commands would overtake images that are still queued
+                await self.command(CommandCode.REFRESH, CommandCode.REFRESH.value + " " + refreshType.value, isOk, max(0, deadline - time.perf_counter()))
+                self.device.resendImageData(parts)
+                await self.flush(max(0, deadline - time.perf_counter()))
+                await self.command(CommandCode.REFRESH, CommandCode.REFRESH.value + " " + RefreshTypeCode.OFF.value, isOk, max(0, deadline - time.perf_counter()))
+            except BaseException:
+                #Also if cancelled or disconnected, so the images taken for this refresh are sent with the next one
+                self.device.refreshFailed(parts)
+                raise
+            self.device.metrics.refreshTime.observe(time.perf_counter() - start, refreshType.name.lower())
+            return True
+
+    #Waits until all queued commands have been written. Raises asyncio.TimeoutError if this takes longer than timeout seconds.
+    async def flush(self, timeout=None):
+        if not await self.loop.run_in_executor(None, self.device.flush, timeout):
+            raise asyncio.TimeoutError("Writing to the device timed out after " + str(timeout) + " seconds.")
+
+    def fadeLeds(self):
+        return self.device.fadeLeds()
+
+    def getAreaFor(self, function):
+        return self.device.getAreaFor(function)
+
+    def registerCallback(self, cb, key):
+        self.device.registerCallback(cb, key)
+
+    def clearCallback(self, key):
+        self.device.clearCallback(key)
+
+    def clearCallbacks(self):
+        self.device.clearCallbacks()
@@ -0,0 +1,129 @@
+#Caches for rendered display content, so icons and labels that are shown again and again do not need to be decoded and
+#rendered each time.
+
+import os
+import mmap
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+#Directory for cached data of the controller, following the XDG base directory specification
+def cacheDirectory(name):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "inkkeys", name)
+
+#Returns modification time and size of the given files, used to notice if a cached file has changed on disk
+def fileStamps(files):
+    stamps = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            stamps.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+#A bounded least-recently-used cache. Entries can depend on files and are rendered again if any of them has been modified.
+#With a DiskCache attached, rendered data (bytes) also survives a restart of the controller.
+class RenderCache:
+    def __init__(self, maxSize=128, disk=None):
+        self.maxSize = maxSize
+        self.disk = disk
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.diskHits = 0
+
+    #Returns the cached value for key or calls render() to create it if it is missing or any of the files has changed.
+    #The entry on disk is identified by key and the content of the files (or of diskFiles if given), so key must have a stable repr().
+    def lookup(self, key, render, files=(), diskFiles=None):
+        stamps = fileStamps(files)
+        entry = self.entries.get(key)
+        if entry != None and entry[0] == stamps:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = None
+        if self.disk != None:
+            diskKey = self.disk.key(key, files if diskFiles == None else diskFiles)
+            value = self.disk.get(diskKey)
+            if value != None:
+                self.diskHits += 1
+            else:
+                value = render()
+                self.disk.put(diskKey, value)
+        else:
+            value = render()
+        self.entries[key] = (stamps, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"size": len(self.entries), "maxSize": self.maxSize, "hits": self.hits, "misses": self.misses, "diskHits": self.diskHits}
+
+
+#Directory of rendered data, so a fresh process can show icons and labels without decoding or rendering anything.
+#Entries are named after a hash of the render parameters and the content of the files they depend on.
+class DiskCache:
+    def __init__(self, directory, salt=""):
+        self.directory = directory
+        self.salt = salt            #Anything else the rendered data depends on (like the version of the render library)
+        self.enabled = True
+        self.contentHashes = {}     #Content hashes of files by (path, modification time, size)
+
+    def fileHash(self, f):
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        stamp = (f, st.st_mtime_ns, st.st_size)
+        if stamp not in self.contentHashes:
+            with open(f, "rb") as fd:
+                self.contentHashes[stamp] = hashlib.sha256(fd.read()).hexdigest()
+        return self.contentHashes[stamp]
+
+    def key(self, params, files=()):
+        h = hashlib.sha256()
+        h.update(self.salt.encode())
+        h.update(repr(params).encode())
+        for f in files:
+            h.update(str(self.fileHash(f)).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        try:
+            with open(os.path.join(self.directory, key), "rb") as fd:
+                if os.fstat(fd.fileno()).st_size == 0:
+                    return b""
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return m[:]
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, data):
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(self.directory, key)) #Atomic, so other processes never see partial entries
+        except OSError as e:
+            print("Disabling render cache in ", self.directory, ": ", e)
+            self.enabled = False
+
+    def clear(self):
+        try:
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
@@ -1,14 +1,52 @@
 from .protocol import *
+from .cache import RenderCache, DiskCache, cacheDirectory
+from .refresh import RefreshScheduler
+from .scene import SceneRecorder
+from .leds import LedEngine, toFrame, fade, solid, encodeFrame
+from .transmit import TransmitScheduler, PacedWriter
+from .metrics import DeviceMetrics, registry
+from .trace import tracer
+from .latency import LatencyTracker, currentEvent
+from .frames import FrameDecoder, encodeCommand, encodeDisplayHeader, encodeLeds
+from .packbits import packRows
 import serial
 import time
-from threading import Lock
+import PIL
+import queue
+import threading
+import traceback
+from threading import Lock, RLock
 from PIL import Image, ImageDraw, ImageOps, ImageFont
+from functools import lru_cache
+
+#Fonts are only loaded once per process
+@lru_cache(maxsize=None)
+def loadFont(font, size):
+    return ImageFont.truetype(font, size)
 
 class Device:
     ser = None
-    inbuffer = ""
+    decoder = None              #FrameDecoder splitting the received data into lines and reply frames
 
     awaitingResponseLock = Lock()
+    displayLock = RLock()       #Held while images are sent and while a refresh takes or resends the image buffer, so no image gets lost between refresh and resend
+
+    transmitter = None          #TransmitScheduler that writes everything to the serial port
+    writer = None               #PacedWriter that writes image data for the transmitter
+    readerThread = None         #Thread reading from the serial port
+    readerError = None          #Exception that stopped the reader thread, raised again by poll()
+    responses = None            #Queue of replies to commands
+    events = None               #Queue of key and jog events waiting for their callbacks
+    dispatcherThread = None     #Thread calling the callbacks for events
+    dispatchInBackground = True #Call callbacks from the dispatcher thread instead of poll()
+    modeLock = None             #Held while a callback runs and while the controller switches modes, so a callback of the previous mode cannot overwrite the setup of the new one
+
+    refreshScheduler = None     #Combines refresh requests, see requestRefresh()
+
+    assignments = {}            #Last assignment command sent for each key (by KeyCode value), mirroring the assignments of the firmware
+    assignmentLock = None       #Held while the mirror is compared, updated and the command is queued, as callbacks, the main loop and the reader thread all change it
+
+    recorder = None             #Collects assignments and images instead of sending them while a scene is compiled
 
     testmode = False
     nLeds = 0
@@ -16,66 +54,324 @@ class Device:
     dispH = 0
     rotFactor = 0
     rotCircleSteps = 0
+    creditSupport = False   #The firmware can acknowledge image rows (see PacedWriter)
+    useCredits = True       #Enable the credit handshake if the firmware supports it
+    frameSupport = False    #The firmware accepts binary frames (see frames.py)
+    useFrames = True        #Send binary frames instead of text commands if the firmware supports them
+    framing = False         #Binary frames have been enabled
+    rleSupport = False      #The firmware accepts PackBits encoded image data (see packbits.py)
+    useCompression = True   #Compress image data if the firmware supports it
+    compressing = False     #Image data is compressed whenever that makes the display command shorter
 
     bannerHeight = 12 #Defines the height of top and bottom banner
 
     imageBuffer = []
 
+    shadow = None           #Shadow copy of the display content in the packed format of the display command (None if unknown)
+    shadowKnown = None      #Marks bytes of the shadow copy that are known to match the display
+    bandMergeBytes = 16     #Unchanged bytes we rather send along than starting a new display command
+    imageChunkBytes = 512   #Image data per display command, larger images are split so more urgent commands can be sent in between
+
+    renderCache = None      #Rendered icons and labels on disk for a quick start, see createRenderCaches
+    iconCache = None        #Packed icons by icon file and render parameters, see sendIconFor (shared by all devices)
+    labelCache = None       #Packed labels by text and render parameters, see sendTextFor (shared by all devices)
+    labelFonts = ("font/Munro.ttf", "font/MunroSmall.ttf") #Fonts for the label and the subtext of sendTextFor
+
     callbacks = {} #This object stores callback functions that react directly to a keypress reported via serial
+    activityCallback = None #Called (possibly from a background thread) after events, LED changes or a lost connection, so a sleeping main loop can react
 
-    ledState = None         #Current LED status, so we can animate them over time
+    ledState = None         #Current LED status as frame (see leds.py), so we can animate them over time
     ledTime = None          #Last time LEDs were set
 
     debug = False;
 
+    def __init__(self):
+        self.callbacks = {}
+        self.imageBuffer = []
+        self.assignments = {}
+        self.assignmentLock = Lock()
+        self.modeLock = RLock()
+        self.leds = LedEngine(self)
+        self.metrics = DeviceMetrics(registry)
+        self.latency = LatencyTracker(self.metrics)
+        if Device.renderCache == None:
+            Device.createRenderCaches()
+
+    #Creates the render caches shared by all devices. This happens with the first device instead of on import, so the
+    #cache directory follows XDG_CACHE_HOME as set by then.
+    @staticmethod
+    def createRenderCaches():
+        Device.renderCache = DiskCache(cacheDirectory("render"), "Pillow " + PIL.__version__)
+        Device.iconCache = RenderCache(256, Device.renderCache)
+        Device.labelCache = RenderCache(256, Device.renderCache)
+
+    #Connect to the device on the serial port "dev". Instead of a port name, an already opened serial port object can be passed (for example an EmulatedSerial instance)
     def connect(self, dev):
         print("Connecting to ", dev, ".")
-        self.ser = serial.Serial(dev, 115200, timeout=1)
+        if isinstance(dev, str):
+            self.ser = serial.Serial(dev, 115200, timeout=1)
+        else:
+            self.ser = dev
+        self.startTransmitter()
+        self.startReader()
         if not self.requestInfo(3):
             self.disconnect()
             return False
         if self.testmode:
             print("Connection to ", self.ser.name, " was successfull, but the device is running the hardware test firmware, which cannot be used for anything but testing. Please flash the proper inkkeys firmware to use it.")
             return False
+        if self.creditSupport and self.useCredits and not self.enableCredits(3):
+            print("The device did not confirm the credit handshake, sending images without it.")
+        if self.frameSupport and self.useFrames and not self.enableFrames(3):
+            print("The device did not confirm binary frames, using text commands.")
+        self.compressing = self.rleSupport and self.useCompression
+        self.resetState()
         print("Connected to ", self.ser.name, ".")
         return True
 
     def disconnect(self):
+        if self.refreshScheduler != None:
+            self.refreshScheduler.stop()
+            self.refreshScheduler = None
+        if self.transmitter != None:
+            self.transmitter.stop()
         if self.ser != None:
-            self.ser.close()
-            self.ser = None
-
-    def sendToDevice(self, command):
+            ser = self.ser
+            self.ser = None #Tells the reader thread to stop
+            ser.close()
+        if self.events != None:
+            self.events.put(None) #Tells the dispatcher thread to stop
+        for thread in [self.readerThread, self.dispatcherThread]:
+            if thread != None and thread != threading.current_thread():
+                thread.join(2)
+        self.readerThread = None
+        self.dispatcherThread = None
+
+    #Commands are queued and written in the background, see transmit.py for the priorities
+    def sendToDevice(self, command, priority=TransmitScheduler.CONTROL):
         if self.debug:
             print("Sending: " + command)
-        self.ser.write((command + "\n").encode())
+        self.metrics.countCommand(command)
+        with tracer.span("send " + command[:1], "device", command=command[:40], priority=priority):
+            self.transmitter.send(priority, self.encodeCommand(command), currentEvent.get())
 
-    def sendBinaryToDevice(self, data):
+    #Bytes to send for a text command, which is converted into a binary frame if frames are enabled
+    def encodeCommand(self, command):
+        return encodeCommand(command, self.framing)
+
+    #Data is either raw bytes or a list of complete commands, which more urgent commands may be sent in between
+    def sendBinaryToDevice(self, data, priority=TransmitScheduler.IMAGE):
         if self.debug:
-            print("Sending " + str(len(data)) + " bytes of binary data.")
-        self.ser.write(data)
-
-    def readFromDevice(self):
-        if self.ser.in_waiting > 0:
-            self.inbuffer += self.ser.read(self.ser.in_waiting).decode().replace("\r", "")
-        chunks = self.inbuffer.split("\n", 1)
-        if len(chunks) > 1:
-            cmd = chunks[0]
-            self.inbuffer = chunks[1]
+            print("Sending " + str(sum(len(part) for part in data) if isinstance(data, list) else len(data)) + " bytes of binary data.")
+        if isinstance(data, list):
+            for part in data:
+                self.metrics.countCommand(part)
+        self.transmitter.send(priority, data, currentEvent.get())
+
+    #Waits until everything that has been queued is written to the port
+    def flush(self, timeout=None):
+        if self.transmitter == None:
+            return True
+        with tracer.span("flush", "device"):
+            return self.transmitter.flush(timeout)
+
+    def startTransmitter(self):
+        self.creditSupport = False #Until the info block tells otherwise
+        self.frameSupport = False
+        self.framing = False
+        self.rleSupport = False
+        self.compressing = False
+        self.writer = PacedWriter(self.writeToPort, self.drainPort)
+        self.transmitter = TransmitScheduler(self.writeToPort, self.writer.writeImage)
+        self.transmitter.writtenCallback = self.onWritten
+
+    #Asks the device to acknowledge each row of image data, so the PacedWriter can keep its receive buffer filled without overrunning it
+    def enableCredits(self, timeout):
+        with self.awaitingResponseLock, tracer.span("enableCredits", "device"):
+            deadline = time.time() + timeout
+            self.clearResponses()
+            self.sendToDevice(CommandCode.CREDIT.value + " 1")
+            if not self.waitForResponse("ok", deadline):
+                return False
+            self.writer.enableCredits()
+            return True
+
+    #Switches to binary frames. The command itself is still sent as text and the reply tells whether the device understood it.
+    def enableFrames(self, timeout):
+        with self.awaitingResponseLock, tracer.span("enableFrames", "device"):
+            deadline = time.time() + timeout
+            self.clearResponses()
+            self.sendToDevice(CommandCode.FRAMES.value + " 1")
+            if not self.waitForResponse("ok", deadline):
+                return False
+            self.framing = True
+            return True
+
+    def writeToPort(self, data):
+        ser = self.ser
+        if ser == None:
+            raise serial.SerialException("Not connected.")
+        ser.write(data)
+        self.metrics.bytesWritten.inc(len(data))
+
+    def drainPort(self):
+        ser = self.ser
+        if ser != None:
+            ser.flush()
+
+    #Starts a thread that reads from the serial port as soon as data arrives and a thread that calls the callbacks of key and jog events
+    def startReader(self):
+        self.decoder = FrameDecoder()
+        self.readerError = None
+        self.responses = queue.Queue()
+        self.events = queue.Queue()
+        self.readerThread = threading.Thread(target=self.readLoop, args=(self.ser,), name="inkkeys-reader", daemon=True)
+        self.readerThread.start()
+        if self.dispatchInBackground:
+            self.dispatcherThread = threading.Thread(target=self.dispatchLoop, args=(self.events,), name="inkkeys-dispatcher", daemon=True)
+            self.dispatcherThread.start()
+
+    def readLoop(self, ser):
+        while self.ser is ser:
+            try:
+                data = ser.read(max(1, ser.in_waiting))
+            except Exception as e:
+                if self.ser is ser: #Otherwise the port has just been closed by disconnect()
+                    print("Serial error: ", e)
+                    self.readerError = e
+                    self.notifyActivity()
+                break
+            if len(data) > 0:
+                self.receive(data)
+
+    #Splits received data into lines (reply frames are converted into the lines of the text protocol) and routes them either to the event queue (keys and jog dial) or to the response queue (replies to commands)
+    def receive(self, data):
+        arrival = time.perf_counter()
+        self.metrics.bytesRead.inc(len(data))
+        for line in self.decoder.feedLines(data):
             if self.debug:
-                print("Received: " + cmd)
-            return cmd
-        return None
+                print("Received: " + line)
+            if self.isEvent(line):
+                tracer.instant("event " + line, "device")
+                self.onEvent(line, arrival)
+            elif line == "c":
+                self.onCredit()
+            elif len(line) > 0:
+                if line.startswith("E: "):
+                    print("Device reported an error: " + line)
+                    with self.assignmentLock:
+                        self.assignments = {} #The error might be a rejected assignment or LED command, so we do not know the state anymore
+                    self.leds.invalidate()
+                    if self.shadow != None:
+                        with self.displayLock:
+                            self.invalidateShadow() #Image data might have been rejected as well, so areas we think are up to date have to be sent again
+                self.onResponse(line)
+
+    def onEvent(self, line, arrival):
+        self.events.put(self.latency.event(line, arrival))
+        if not self.dispatchInBackground:
+            self.notifyActivity() #poll() has to dispatch it
+
+    def notifyActivity(self):
+        if self.activityCallback != None:
+            self.activityCallback()
+
+    def onResponse(self, line):
+        self.responses.put(line)
+
+    #Called by the transmit thread after a command has been written that was queued while the callback of event was running
+    def onWritten(self, event, priority):
+        self.latency.record(event, ("control", "led", "image")[priority])
+
+    def onCredit(self):
+        if self.writer != None:
+            self.writer.acknowledge()
+
+    def isEvent(self, line):
+        if len(line) == 2 and line[0] in "123456789" and line[1] in "pr":
+            return True
+        return len(line) > 1 and line[0] == KeyCode.JOG.value and (line[1:].isdecimal() or (line[1] == '-' and line[2:].isdecimal()))
+
+    def dispatchLoop(self, events):
+        while True:
+            event = events.get()
+            if event == None:
+                return
+            try:
+                self.dispatch(event.input, event)
+            except Exception:
+                #A broken callback should not stop all other keys from working
+                print("Error in callback for ", event.input, ":")
+                traceback.print_exc()
+            self.notifyActivity()
+
+    #Calls the callback for an event line. event is the KeyEvent with its arrival time, dispatching a line without it counts the latency from now.
+    def dispatch(self, input, event=None):
+        if input[0] == KeyCode.JOG.value:
+            key = KeyCode.JOG.value
+            args = (int(input[1:]),)
+        else:
+            key = input
+            args = ()
+        with self.modeLock: #Callbacks that have been cleared by a mode switch while waiting for the lock are not called anymore
+            callback = self.callbacks.get(key)
+            if callback == None:
+                return
+            if event == None:
+                event = self.latency.event(input)
+            start = time.perf_counter()
+            token = currentEvent.set(event) #Commands queued by the callback carry the event
+            try:
+                with tracer.span("callback " + key, "device", input=input):
+                    callback(*args)
+            except Exception:
+                self.metrics.callbackErrors.inc(1, key)
+                raise
+            finally:
+                currentEvent.reset(token)
+                self.metrics.callbackTime.observe(time.perf_counter() - start, key)
+                self.latency.record(event, "callback")
+
+    #Waits for the next reply from the device until deadline (as time.time()) and returns None if there is none
+    def readResponse(self, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        try:
+            return self.responses.get(timeout=remaining)
+        except queue.Empty:
+            return None
+
+    def waitForResponse(self, expected, deadline):
+        with tracer.span("wait " + expected, "device"):
+            line = self.readResponse(deadline)
+            while line != expected:
+                if line == None:
+                    return False
+                line = self.readResponse(deadline)
+            return True
+
+    def clearResponses(self):
+        try:
+            while True:
+                self.responses.get_nowait()
+        except queue.Empty:
+            pass
 
+    #Key and jog events are handled in the background as soon as they arrive. poll() only needs to be called regularly to notice a lost connection or if dispatchInBackground is disabled.
     def poll(self):
-        with self.awaitingResponseLock:
-            input = self.readFromDevice()
-        if input != None:
-            if input[0] == KeyCode.JOG.value and (input[1:].isdecimal() or (input[1] == '-' and input[2:].isdecimal())):
-                if KeyCode.JOG.value in self.callbacks:
-                    self.callbacks[KeyCode.JOG.value](int(input[1:]))
-            elif input in self.callbacks:
-                self.callbacks[input]()
+        if self.readerError != None:
+            raise serial.SerialException(self.readerError)
+        if self.transmitter != None:
+            self.transmitter.checkError()
+        if self.dispatchInBackground:
+            return
+        try:
+            while True:
+                event = self.events.get_nowait()
+                self.dispatch(event.input, event)
+        except queue.Empty:
+            pass
 
     def registerCallback(self, cb, key):
         self.callbacks[key.value] = cb
@@ -87,100 +383,352 @@ class Device:
     def clearCallbacks(self):
         self.callbacks = {}
 
+    #Forget everything we assumed about the state of the device (after connecting or if the device might have been reset)
+    def resetState(self):
+        self.imageBuffer = []
+        self.invalidateShadow()
+        with self.assignmentLock:
+            self.assignments = {}
+        self.leds.invalidate()
+
+    #Assigns a sequence of events to a key. The command is only sent if the device does not already have the same assignment.
     def assignKey(self, key, sequence):
-        self.sendToDevice(CommandCode.ASSIGN.value + " " + key.value + (" " + " ".join(sequence) if len(sequence) > 0 else ""))
+        command = CommandCode.ASSIGN.value + " " + key.value + (" " + " ".join(sequence) if len(sequence) > 0 else "")
+        if self.recorder != None:
+            self.recorder.assign(key.value, command)
+            return
+        with self.assignmentLock:
+            if self.assignments.get(key.value) == command:
+                return
+            self.assignments[key.value] = command
+            self.sendToDevice(command)
 
     def sendLed(self, colors):
-        self.sendToDevice(CommandCode.LED.value + " " + " ".join(colors))
+        self.sendToDevice(CommandCode.LED.value + " " + " ".join(colors), TransmitScheduler.LED)
+
+    #Sends a frame as created by the functions in leds.py, which is passed on as raw bytes if binary frames are enabled
+    def sendLedFrame(self, frame):
+        if not self.framing:
+            self.sendLed(encodeFrame(frame))
+            return
+        if self.debug:
+            print("Sending: LED frame with " + str(len(frame)) + " LEDs.")
+        self.metrics.countCommand(CommandCode.LED.value)
+        self.transmitter.send(TransmitScheduler.LED, encodeLeds(frame.tobytes()), currentEvent.get())
 
     def requestInfo(self, timeout):
-        with self.awaitingResponseLock:
+        with self.awaitingResponseLock, tracer.span("requestInfo", "device"):
             print("Requesting device info...")
-            start = time.time()
+            start = time.perf_counter()
+            deadline = time.time() + timeout
+            self.clearResponses()
             self.sendToDevice(CommandCode.INFO.value)
-            line = self.readFromDevice()
+            line = self.readResponse(deadline)
             while line != "Inkkeys":
-                if time.time() - start > timeout:
-                    return False
                 if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
-                    continue
+                    return False
                 print("Skipping: ", line)
-                line = self.readFromDevice()
+                line = self.readResponse(deadline)
             print("Header found. Waiting for infos...")
-            line = self.readFromDevice()
+            line = self.readResponse(deadline)
             while line != "Done":
-                if time.time() - start > timeout:
-                    return False
                 if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
-                    continue
-                if line.startswith("TEST "):
-                    self.testmode = line[5] != "0"
-                elif line.startswith("N_LED "):
-                    self.nLeds = int(line[6:])
-                elif line.startswith("DISP_W "):
-                    self.dispW = int(line[7:])
-                elif line.startswith("DISP_H "):
-                    self.dispH = int(line[7:])
-                elif line.startswith("ROT_CIRCLE_STEPS "):
-                    self.rotCircleSteps = int(line[17:])
-                else:
+                    return False
+                if not self.parseInfo(line):
                     print("Skipping: ", line)
-                line = self.readFromDevice()
+                line = self.readResponse(deadline)
             print("End of info received.")
-            print("Testmode: ", self.testmode)
-            print("Number of LEDs: ", self.nLeds)
-            print("Display width: ", self.dispW)
-            print("Display height: ", self.dispH)
-            print("Rotation circle steps: ", self.rotCircleSteps)
+            self.metrics.infoTime.observe(time.perf_counter() - start)
+            self.printInfo()
             return True
 
+    #Parses a line of the info block and returns False if it is unknown
+    def parseInfo(self, line):
+        if line.startswith("TEST "):
+            self.testmode = line[5] != "0"
+        elif line.startswith("N_LED "):
+            self.nLeds = int(line[6:])
+        elif line.startswith("DISP_W "):
+            self.dispW = int(line[7:])
+        elif line.startswith("DISP_H "):
+            self.dispH = int(line[7:])
+        elif line.startswith("ROT_CIRCLE_STEPS "):
+            self.rotCircleSteps = int(line[17:])
+        elif line.startswith("CREDIT "):
+            self.creditSupport = line[7:] != "0"
+        elif line.startswith("FRAMES "):
+            self.frameSupport = line[7:] != "0"
+        elif line.startswith("RLE "):
+            self.rleSupport = line[4:] != "0"
+        else:
+            return False
+        return True
+
+    def printInfo(self):
+        print("Testmode: ", self.testmode)
+        print("Number of LEDs: ", self.nLeds)
+        print("Display width: ", self.dispW)
+        print("Display height: ", self.dispH)
+        print("Rotation circle steps: ", self.rotCircleSteps)
+        print("Credit handshake: ", self.creditSupport)
+        print("Binary frames: ", self.frameSupport)
+        print("Compressed images: ", self.rleSupport)
+
+    #Converts an image to the packed 1bit format expected by the display command
+    def packImage(self, image):
+        return image.convert("1").rotate(180).tobytes()
+
     def sendImage(self, x, y, image):
-        self.imageBuffer.append({"x": x, "y": y, "image": image.copy()})
         w, h = image.size
-        data = image.convert("1").rotate(180).tobytes()
-        self.sendToDevice(CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h))
-        self.sendBinaryToDevice(data)
+        return self.sendPackedImage(x, y, w, h, self.packImage(image))
+
+    #Forget what we know about the display content, so the next images are transmitted entirely
+    def invalidateShadow(self):
+        self.shadow = bytearray(self.dispW*self.dispH//8)
+        self.shadowKnown = bytearray(self.dispW*self.dispH//8)
+
+    #Sends packed image data for the area x, y, w, h. The data is compared to the shadow copy of the display content and only rectangles that actually changed are transmitted.
+    def sendPackedImage(self, x, y, w, h, data):
+        if self.recorder != None:
+            self.recorder.image(x, y, w, h, data)
+            return True
+        with self.displayLock:
+            return self.transmitChanges(x, y, w, h, data)
+
+    #If a list is passed as "parts", the encoded commands are appended to it instead of being sent
+    def transmitChanges(self, x, y, w, h, data, parts=None):
+        if not self.isTrackable(x, y, w, h):
+            #We cannot track this area (not byte-aligned or outside the display), so just send it and forget what we knew about it
+            self.forgetShadow(x, y, w, h)
+            self.transmitImage(x, y, w, h, data, parts)
+            return True
+
+        stride = self.dispW//8
+        rowBytes = w//8
+        allKnown = b"\x01" * rowBytes
+        bands = [] #Changed areas as [firstRow, lastRow, firstColumn, lastColumn] with columns in bytes
+        for row in range(h):
+            offset = (y+row)*stride + x//8
+            new = data[row*rowBytes:(row+1)*rowBytes]
+            if new == self.shadow[offset:offset+rowBytes] and self.shadowKnown[offset:offset+rowBytes] == allKnown:
+                continue
+            changed = [i for i in range(rowBytes) if new[i] != self.shadow[offset+i] or not self.shadowKnown[offset+i]]
+            first, last = changed[0], changed[-1]
+            if len(bands) > 0:
+                band = bands[-1]
+                #Extend the previous rectangle if the unchanged rows in between are cheaper than the header of another display command
+                if (row - band[1] - 1) * (max(last, band[3]) - min(first, band[2]) + 1) <= self.bandMergeBytes:
+                    band[1] = row
+                    band[2] = min(first, band[2])
+                    band[3] = max(last, band[3])
+                    continue
+            bands.append([row, row, first, last])
+
+        self.writeShadow(x, y, w, h, data)
+
+        if self.debug and len(bands) == 0:
+            print("Skipping unchanged image at " + str((x, y, w, h)) + ".")
+        for firstRow, lastRow, firstColumn, lastColumn in bands:
+            part = b"".join(data[row*rowBytes+firstColumn:row*rowBytes+lastColumn+1] for row in range(firstRow, lastRow+1))
+            self.transmitImage(x+8*firstColumn, y+firstRow, 8*(lastColumn-firstColumn+1), lastRow-firstRow+1, part, parts)
         return True
 
-    def resendImageData(self):
-        for part in self.imageBuffer:
-            image = part["image"]
-            x = part["x"]
-            y = part["y"]
-            w, h = image.size
-            data = image.convert("1").rotate(180).tobytes()
-            self.sendToDevice(CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h))
-            self.sendBinaryToDevice(data)
-        self.imageBuffer = []
+    #Returns True if the shadow framebuffer can keep track of the area x, y, w, h
+    def isTrackable(self, x, y, w, h):
+        return self.shadow != None and x % 8 == 0 and w % 8 == 0 and x + w <= self.dispW and y + h <= self.dispH
 
+    def forgetShadow(self, x, y, w, h):
+        if self.shadow == None:
+            return
+        stride = self.dispW//8
+        for row in range(y, min(y+h, self.dispH)):
+            self.shadowKnown[row*stride + x//8:row*stride + min((x+w+7)//8, stride)] = bytes(max(0, min((x+w+7)//8, stride) - x//8))
+
+    def writeShadow(self, x, y, w, h, data):
+        stride = self.dispW//8
+        rowBytes = w//8
+        allKnown = b"\x01" * rowBytes
+        for row in range(h):
+            offset = (y+row)*stride + x//8
+            self.shadow[offset:offset+rowBytes] = data[row*rowBytes:(row+1)*rowBytes]
+            self.shadowKnown[offset:offset+rowBytes] = allKnown
+
+    #Returns True if every byte of the area x, y, w, h is known in the shadow framebuffer
+    def shadowKnownFor(self, x, y, w, h):
+        if not self.isTrackable(x, y, w, h):
+            return False
+        stride = self.dispW//8
+        allKnown = b"\x01" * (w//8)
+        return all(self.shadowKnown[(y+row)*stride + x//8:(y+row)*stride + (x+w)//8] == allKnown for row in range(h))
+
+    #Returns True if the display is known to show exactly this data in the area x, y, w, h
+    def shadowMatches(self, x, y, w, h, data):
+        if not self.isTrackable(x, y, w, h):
+            return False
+        stride = self.dispW//8
+        rowBytes = w//8
+        allKnown = b"\x01" * rowBytes
+        for row in range(h):
+            offset = (y+row)*stride + x//8
+            if data[row*rowBytes:(row+1)*rowBytes] != self.shadow[offset:offset+rowBytes] or self.shadowKnown[offset:offset+rowBytes] != allKnown:
+                return False
+        return True
+
+    #Returns the display command including the image data, which is PackBits encoded if that makes the command shorter
+    def encodeImage(self, x, y, w, h, data):
+        command = self.encodeImageHeader(x, y, w, h) + data
+        if self.compressing:
+            packed = packRows(data, (w+7)//8)
+            compressed = self.encodeImageHeader(x, y, w, h, len(packed)) + packed
+            if len(compressed) < len(command):
+                return compressed
+        return command
+
+    #Header of the display command, with the length of the encoded data as fifth field for compressed images
+    def encodeImageHeader(self, x, y, w, h, packedLength=None):
+        if self.framing:
+            return encodeDisplayHeader(x, y, w, h, packedLength)
+        return (CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h) + (" " + str(packedLength) if packedLength != None else "") + "\n").encode()
+
+    #Returns a list of display commands for chunks of whole rows with up to imageChunkBytes of image data each
+    def encodeImageChunks(self, x, y, w, h, data):
+        rowBytes = (w+7)//8
+        rows = max(1, self.imageChunkBytes // max(1, rowBytes))
+        return [self.encodeImage(x, y+row, w, min(rows, h-row), data[row*rowBytes:(row+rows)*rowBytes]) for row in range(0, h, rows)]
+
+    #Keeps encoded display commands in the image buffer, so they can be sent again after the next refresh
+    def bufferImage(self, x, y, w, h, chunks):
+        #Parts that are entirely overwritten by this one do not need to be sent again
+        self.imageBuffer = [part for part in self.imageBuffer if not (part["x"] >= x and part["y"] >= y and part["x"] + part["w"] <= x + w and part["y"] + part["h"] <= y + h)]
+        self.imageBuffer.append({"x": x, "y": y, "w": w, "h": h, "chunks": chunks})
+
+    #Sends packed image data to the device (or appends its commands to "parts") and keeps it in the image buffer
+    def transmitImage(self, x, y, w, h, data, parts=None):
+        chunks = self.encodeImageChunks(x, y, w, h, data)
+        self.bufferImage(x, y, w, h, chunks)
+        if parts != None:
+            parts.extend(chunks)
+            return
+        if self.debug:
+            print("Sending: " + CommandCode.DISPLAY.value + " " + str((x, y, w, h)) + " with " + str(len(data)) + " bytes of image data.")
+        self.sendBinaryToDevice(chunks)
+
+    #Runs setup(device), which should only set static content (images, labels and key assignments), and returns a Scene with the resulting commands instead of sending them
+    def compileScene(self, setup):
+        self.recorder = SceneRecorder(self)
+        try:
+            setup(self)
+            return self.recorder.compile()
+        finally:
+            self.recorder = None
+
+    #Queues a scene. Unless the shadow framebuffer knows every area of the scene, its precompiled assignments and
+    #display commands are sent as one payload each. Otherwise only what differs from the known state of the device is sent.
+    def playScene(self, scene):
+        if not scene.fits(self):
+            raise ValueError("The scene has been compiled for a different display size or protocol.")
+        with self.displayLock, tracer.span("playScene", "device"):
+            if not all(self.shadowKnownFor(x, y, w, h) for x, y, w, h, data, chunks in scene.images):
+                self.sendScene(scene)
+                return
+            with self.assignmentLock:
+                commands = []
+                for key, command in scene.assignments:
+                    if self.assignments.get(key) != command:
+                        self.assignments[key] = command
+                        commands.append(self.encodeCommand(command))
+                if len(commands) > 0:
+                    self.metrics.commandsSent.inc(len(commands), CommandCode.ASSIGN.value)
+                    self.sendBinaryToDevice(b"".join(commands), TransmitScheduler.CONTROL)
+            parts = []
+            for x, y, w, h, data, chunks in scene.images:
+                if not self.shadowMatches(x, y, w, h, data):
+                    self.transmitChanges(x, y, w, h, data, parts) #Only parts of the area might have changed
+            if self.debug:
+                print("Sending " + str(len(commands) + len(parts)) + " commands for the scene.")
+            if len(parts) > 0:
+                self.sendBinaryToDevice(parts)
+
+    #Sends the entire scene. Needs to hold displayLock.
+    def sendScene(self, scene):
+        with self.assignmentLock:
+            for key, command in scene.assignments:
+                self.assignments[key] = command
+            if len(scene.assignments) > 0:
+                self.metrics.commandsSent.inc(len(scene.assignments), CommandCode.ASSIGN.value)
+                self.sendBinaryToDevice(scene.assignData, TransmitScheduler.CONTROL)
+        for x, y, w, h, data, chunks in scene.images:
+            self.forgetShadow(x, y, w, h)
+            if self.isTrackable(x, y, w, h):
+                self.writeShadow(x, y, w, h, data)
+            self.bufferImage(x, y, w, h, chunks)
+            self.metrics.commandsSent.inc(len(chunks), CommandCode.DISPLAY.value)
+        if self.debug:
+            print("Sending the scene with " + str(len(scene.assignData) + len(scene.blob)) + " bytes.")
+        if len(scene.blob) > 0:
+            self.sendBinaryToDevice(scene.blob)
+
+    #Takes the buffered images for a refresh. Images sent while the refresh is running are buffered for the next one.
+    def takeImageBuffer(self):
+        with self.displayLock:
+            parts = self.imageBuffer
+            self.imageBuffer = []
+            return parts
+
+    #Puts the images of a failed refresh back, unless newer images cover them
+    def restoreImageBuffer(self, parts):
+        with self.displayLock:
+            newer = self.imageBuffer
+            self.imageBuffer = [part for part in parts if not any(part["x"] >= n["x"] and part["y"] >= n["y"] and part["x"] + part["w"] <= n["x"] + n["w"] and part["y"] + part["h"] <= n["y"] + n["h"] for n in newer)] + newer
+
+    #Sends the images taken for the refresh again. Images sent since then follow once more, so they are not overwritten by older data in the display RAM.
+    def resendImageData(self, parts):
+        with self.displayLock:
+            chunks = [chunk for part in parts + self.imageBuffer for chunk in part["chunks"]]
+            if len(chunks) > 0:
+                self.sendBinaryToDevice(chunks)
+
+    def refreshFailed(self, parts):
+        self.metrics.refreshFailures.inc()
+        self.restoreImageBuffer(parts)
+        return False
+
+    #Only holds displayLock to take and resend the image buffer, so callbacks can send images while the refresh is running
     def updateDisplay(self, fullRefresh=False, timeout=5):
-        with self.awaitingResponseLock:
-            start = time.time()
-            self.sendToDevice(CommandCode.REFRESH.value + " " + (RefreshTypeCode.FULL.value if fullRefresh else RefreshTypeCode.PARTIAL.value))
-            line = self.readFromDevice()
-            while line != "ok":
-                if time.time() - start > timeout:
-                    return False
-                if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
-                    continue
-                line = self.readFromDevice()
-            self.resendImageData()
+        with self.awaitingResponseLock, tracer.span("updateDisplay", "device", full=fullRefresh):
+            parts = self.takeImageBuffer()
+            if not fullRefresh and len(parts) == 0:
+                return True #Nothing has changed since the last refresh
+            refreshType = RefreshTypeCode.FULL if fullRefresh else RefreshTypeCode.PARTIAL
+            start = time.perf_counter()
+            deadline = time.time() + timeout
+            self.clearResponses()
+            #Refresh commands would overtake images that are still queued
+            if not self.flush(timeout):
+                return self.refreshFailed(parts)
+            self.sendToDevice(CommandCode.REFRESH.value + " " + refreshType.value)
+            if not self.waitForResponse("ok", deadline):
+                return self.refreshFailed(parts)
+            self.resendImageData(parts)
+            if not self.flush(max(0, deadline - time.time())):
+                return self.refreshFailed(parts)
             self.sendToDevice(CommandCode.REFRESH.value + " " + RefreshTypeCode.OFF.value)
-            line = self.readFromDevice()
-            while line != "ok":
-                if time.time() - start > timeout:
-                    return False
-                if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
-                    continue
-                line = self.readFromDevice()
+            if not self.waitForResponse("ok", deadline):
+                return self.refreshFailed(parts)
+            self.metrics.refreshTime.observe(time.perf_counter() - start, refreshType.name.lower())
+            return True
+
+    #Requests a refresh of the display without waiting for it. Requests that arrive in quick succession or while a refresh is running are combined into a single refresh, which is a full refresh if any of them asked for it.
+    def requestRefresh(self, fullRefresh=False):
+        if self.refreshScheduler == None:
+            self.refreshScheduler = RefreshScheduler(self)
+        self.refreshScheduler.request(fullRefresh)
+
+    #Waits until all requested refreshs have been done
+    def waitForRefresh(self, timeout=None):
+        if self.refreshScheduler == None:
+            return True
+        return self.refreshScheduler.wait(timeout)
 
     def getAreaFor(self, function):
         if function == "title":
@@ -201,12 +749,19 @@ class Device:
         self.sendImage(x, y, image)
 
     def sendTextFor(self, function, text, subtext="", inverted=False):
+        x, y, w, h = self.getAreaFor(function)
+        key = ("label", function, text, subtext, inverted, (w, h))
+        with tracer.span("sendTextFor", "device", function=function, text=text):
+            data = self.labelCache.lookup(key, lambda: self.packImage(self.renderText(function, text, subtext, inverted)), diskFiles=self.labelFonts)
+            self.sendPackedImage(x, y, w, h, data)
+
+    def renderText(self, function, text, subtext="", inverted=False):
         x, y, w, h = self.getAreaFor(function)
         img = Image.new("1", (w, h), color=(0 if inverted else 1))
         d = ImageDraw.Draw(img)
-        font1 = ImageFont.truetype("font/Munro.ttf", 10)
+        font1 = loadFont(self.labelFonts[0], 10)
         wt1, ht1 = font1.getsize(text);
-        font2 = ImageFont.truetype("font/MunroSmall.ttf", 10)
+        font2 = loadFont(self.labelFonts[1], 10)
         wt2, ht2 = font2.getsize_multiline(subtext);
         if function == 1 or function == "title":
             position1 = ((w-wt1)/2,(h-ht1-(0.5 if function == "title" else 0))/2) #Center jog wheel and title label (the title get's small -0.5 nudge for rounding to prefer a top alignment)
@@ -224,9 +779,20 @@ class Device:
         d.text(position1, text, font=font1, fill=(1 if inverted else 0))
         if position2 != None and subtext != None:
             d.multiline_text(position2, subtext, font=font2, align=align, spacing=-2, fill=(1 if inverted else 0))
-        self.sendImageFor(function, img)
+        return img
 
     def sendIconFor(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
+        x, y, w, h = self.getAreaFor(function)
+        files = (icon, self.getMarkerFor(function)) if marked else (icon,)
+        key = ("icon", icon, function, inverted, centered, marked, crossed, (w, h))
+        with tracer.span("sendIconFor", "device", function=function, icon=icon):
+            data = self.iconCache.lookup(key, lambda: self.packImage(self.renderIcon(function, icon, inverted, centered, marked, crossed)), files)
+            self.sendPackedImage(x, y, w, h, data)
+
+    def getMarkerFor(self, function):
+        return "icons/chevron-compact-right.png" if function < 6 else "icons/chevron-compact-left.png"
+
+    def renderIcon(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
         x, y, w, h = self.getAreaFor(function)
         img = Image.new("1", (w, h), color=(0 if inverted else 1))
         imgIcon = Image.open(icon).convert("RGB")
@@ -240,7 +806,7 @@ class Device:
         img.paste(imgIcon, pos)
 
         if marked:
-            imgMarker = Image.open("icons/chevron-compact-right.png" if function < 6 else "icons/chevron-compact-left.png")
+            imgMarker = Image.open(self.getMarkerFor(function))
             wm, hm = imgMarker.size
             img.paste(imgMarker, (-16,(h - hm)//2) if function < 6 else (w-wm+16,(h - hm)//2), mask=ImageOps.invert(imgMarker.convert("RGB")).convert("1"))
 
@@ -249,25 +815,27 @@ class Device:
             d.line([pos[0]+5, pos[1]+5, pos[0]+wi-5, pos[1]+hi-5], width=3)
             d.line([pos[0]+5, pos[1]+hi-5, pos[0]+wi-5, pos[1]+5], width=3)
 
-        self.sendImage(x, y, img)
+        return img
 
+    #Sets the LEDs to a list of 0xRRGGBB colors or a frame as created by the functions in leds.py. Frames that are already shown are not sent again.
     def setLeds(self, leds):
-        ledStr = ['{:06x}'.format(i) for i in leds]
+        frame = toFrame(leds)
         self.ledTime = time.time()
-        self.ledState = leds
-        self.sendLed(ledStr)
+        self.ledState = frame
+        self.leds.show(frame)
+        self.notifyActivity()
 
+    #Fades out the LEDs some time after they have been set. Returns the seconds until it needs to be called again or False if the LEDs are off.
     def fadeLeds(self):
-        if self.ledState == None:
-            return
+        if self.ledState is None:
+            return False
         p = (3.5 - (time.time() - self.ledTime))/0.5 #Stay on for 3 seconds and then fade out over 0.5 seconds
         if p >= 1:
-            return
+            return (p - 1) * 0.5 #Nothing to do until the fade starts
         if p <= 0:
             self.ledState = None
-            self.sendLed(["000000" for i in range(self.nLeds)])
-            return
-        dimmedLeds = [(int((i & 0xff0000) * p) & 0xff0000) | (int((i & 0xff00) * p) & 0xff00) | (int((i & 0xff) * p) & 0xff) for i in self.ledState]
-        ledStr = ['{:06x}'.format(i) for i in dimmedLeds]
-        self.sendLed(ledStr)
+            self.leds.show(solid(self.nLeds, 0x000000))
+            return False
+        self.leds.show(fade(self.ledState, p))
+        return 1/30
 
@@ -0,0 +1,514 @@
+#A pure Python emulation of the inkkeys firmware (see arduino/inkkeys/serialinput.ino), so the controller, the modes and
+#benchmarks can be run without an actual device. The emulator can either be attached directly to a Device by passing an
+#EmulatedSerial instance to Device.connect() or it can be exposed on a pseudo terminal (Linux/macOS) with openPty(), so
+#any program can connect to it like to the real device.
+
+import os
+import time
+import struct
+import threading
+from collections import deque
+
+#The frame format and the parser of events are shared with the encoder in frames.py
+from .frames import SYNC, FRAME_ASSIGN, FRAME_DISPLAY, FRAME_LED, FRAME_REFRESH, FRAME_CREDIT, FRAME_FRAMES, frameCommands
+from .frames import parseEvent, crc8, crcTable, encodeReply
+from .packbits import PackBitsDecoder
+
+class Emulator:
+    #Device properties as reported by the info command (see settings.h)
+    nLeds = 12
+    dispW = 128
+    dispH = 296
+    rotCircleSteps = 20
+    nEvents = 10                #Maximum number of events per assignment (N_EVENTS)
+    serialBufferSize = 256      #Size of the line buffer of the firmware
+    creditSupport = True        #Support the credit handshake ("C" command). Disable to emulate older firmware.
+    frameSupport = True         #Support binary frames ("B" command and frames.py). Disable to emulate older firmware.
+    rleSupport = True           #Support PackBits encoded image data (packbits.py). Disable to emulate older firmware.
+
+    #Timing model. All delays are multiplied by timeScale, so 0 runs the emulator as fast as possible.
+    baudrate = 115200           #Modeled transfer rate (8N1, so 10 bits per byte). None disables the transfer delay.
+    partialRefreshTime = 0.3    #Time in seconds that display.refresh(true) blocks the firmware
+    fullRefreshTime = 2.0       #Time in seconds that display.refresh(false) blocks the firmware
+    powerOffTime = 0.0          #Time in seconds that display.powerOff() blocks the firmware
+    rowWriteTime = 0.0          #Time in seconds that display.writeImage() takes for a row of image data
+    timeScale = 1.0
+
+    def __init__(self, **settings):
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise AttributeError("Unknown emulator setting: " + key)
+            setattr(self, key, value)
+
+        self.output = None          #Function that receives the bytes the firmware sends back to the host
+
+        self.serialBuffer = bytearray()
+        self.expectingImageData = 0
+        self.imageDataTargetX = 0
+        self.imageDataTargetY = 0
+        self.imageDataTargetWidth = 0
+        self.imageDataCurrentY = 0
+        self.packedRemaining = 0    #Bytes of PackBits encoded image data still to be received
+        self.unpacker = None
+        self.credits = False        #Acknowledge each image row with a "c" line
+        self.framedReplies = False  #Send replies and events as frames
+        self.frameHeader = None     #Type and length of the frame that is being received (None while no frame is received)
+        self.frameRemaining = 0     #Bytes of payload and CRC still to be received
+        self.frameCrc = 0
+
+        self.framebuffer = bytearray(b"\xff" * (self.dispW*self.dispH//8)) #Display RAM, white after initDisplay()
+        self.shown = bytes(self.framebuffer)                                  #Content visible on the panel after the last refresh
+        self.assignments = [[[] for pr in range(2)] for key in range(10)]     #Parsed events as tuples (deviceAndType, keycodeOrDelay)
+        self.leds = [0 for i in range(self.nLeds)]
+
+        #Statistics
+        self.bytesReceived = 0
+        self.bytesSent = 0
+        self.commands = {}          #Number of processed commands by command letter
+        self.refreshes = 0
+        self.errors = []
+
+        self.lock = threading.RLock()
+
+    def transferDelay(self, n):
+        if self.baudrate == None or self.timeScale == 0:
+            return 0
+        return n * 10 / self.baudrate * self.timeScale
+
+    def println(self, line):
+        data = encodeReply(line) if self.framedReplies else None
+        if data == None:
+            data = (line + "\r\n").encode()
+        self.bytesSent += len(data)
+        if line.startswith("E: "):
+            self.errors.append(line)
+        if self.output != None:
+            self.output(data)
+
+    def printErrorWithIndex(self, msg, i):
+        self.println("E: " + msg + " at index " + str(i) + ":")
+        self.println(self.serialBuffer.decode(errors="replace"))
+
+    #Feed bytes received from the host. Like the firmware, the data is handled one byte at a time. The call blocks for the modeled transfer time and display refreshs.
+    def receive(self, data):
+        delay = self.transferDelay(len(data))
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.bytesReceived += len(data)
+            for c in data:
+                self.handleSerialInput(c)
+
+    def handleSerialInput(self, c):
+        if self.packedRemaining > 0:
+            self.handlePackedInput(c)
+        elif self.frameHeader != None:
+            self.handleFrameInput(c)
+        elif self.frameSupport and self.expectingImageData == 0 and len(self.serialBuffer) == 0 and c == SYNC:
+            #Start of a frame, as text commands never start with this byte
+            self.frameHeader = bytearray()
+        elif self.expectingImageData == 0 and c == 0x0a:
+            #Carriage return. Command ends and needs to be processed
+            if len(self.serialBuffer) == self.serialBufferSize:
+                self.println("E: Command too long.")
+            elif len(self.serialBuffer) > 0:
+                command = chr(self.serialBuffer[0])
+                self.commands[command] = self.commands.get(command, 0) + 1
+                if command == "A":
+                    self.processAssignCommand()
+                elif command == "D":
+                    self.processDisplayCommand()
+                elif command == "I":
+                    self.processInfoCommand()
+                elif command == "L":
+                    self.processLEDCommand()
+                elif command == "R":
+                    self.processRefreshCommand()
+                elif command == "C" and self.creditSupport:
+                    self.processCreditCommand()
+                elif command == "B" and self.frameSupport:
+                    self.processFramesCommand()
+                else:
+                    self.println("E: Unknown command: " + self.serialBuffer.decode(errors="replace"))
+            #Command was handled. Reset buffer
+            self.serialBuffer = bytearray()
+        elif len(self.serialBuffer) < self.serialBufferSize:
+            #Just a normal character or part of a transferred image. Store it in the buffer.
+            if self.expectingImageData > 0:
+                self.storeImageByte(c)
+            else:
+                self.serialBuffer.append(c)
+
+    #Collects a byte of image data and writes the row once it is complete
+    def storeImageByte(self, c):
+        self.serialBuffer.append(c)
+        self.expectingImageData -= 1
+        if len(self.serialBuffer) * 8 >= self.imageDataTargetWidth:
+            self.writeImageRow(self.serialBuffer, self.imageDataTargetX, self.imageDataCurrentY, self.imageDataTargetWidth)
+            self.serialBuffer = bytearray()
+            self.imageDataCurrentY += 1
+            if self.rowWriteTime * self.timeScale > 0:
+                time.sleep(self.rowWriteTime * self.timeScale)
+            if self.credits:
+                self.println("c")
+
+    #Encoded image data is decoded as it arrives, so it never needs more than the row in the serial buffer
+    def handlePackedInput(self, c):
+        self.packedRemaining -= 1
+        for b in self.unpacker.feed(c):
+            if self.expectingImageData > 0:
+                self.storeImageByte(b)
+        if self.packedRemaining == 0 and self.expectingImageData > 0:
+            self.println("E: Image data incomplete.")
+            self.expectingImageData = 0
+            self.serialBuffer = bytearray()
+
+    #The payload of a frame is collected in the serial buffer just like a text command
+    def handleFrameInput(self, c):
+        if len(self.frameHeader) < 3:
+            self.frameHeader.append(c)
+            if len(self.frameHeader) == 3:
+                self.frameRemaining = (self.frameHeader[1] | self.frameHeader[2] << 8) + 1
+                self.frameCrc = crc8(self.frameHeader)
+            return
+        self.frameRemaining -= 1
+        if self.frameRemaining > 0:
+            self.frameCrc = crcTable[self.frameCrc ^ c]
+            if len(self.serialBuffer) < self.serialBufferSize:
+                self.serialBuffer.append(c)
+            return
+        header = self.frameHeader
+        payload = bytes(self.serialBuffer)
+        self.frameHeader = None
+        self.serialBuffer = bytearray()
+        if c != self.frameCrc:
+            self.println("E: Bad checksum.")
+        elif (header[1] | header[2] << 8) > self.serialBufferSize:
+            self.println("E: Command too long.")
+        else:
+            self.processFrame(header[0], payload)
+
+    def processFrame(self, frameType, payload):
+        command = frameCommands.get(frameType, "?")
+        self.commands[command] = self.commands.get(command, 0) + 1
+        if frameType == FRAME_ASSIGN:
+            self.processAssignFrame(payload)
+        elif frameType == FRAME_DISPLAY and len(payload) == 8:
+            self.startImage(*struct.unpack("<4H", payload))
+        elif frameType == FRAME_DISPLAY and len(payload) == 10 and self.rleSupport:
+            self.startImage(*struct.unpack("<5H", payload))
+        elif frameType == FRAME_LED and len(payload) == 3*self.nLeds:
+            self.leds = [int.from_bytes(payload[3*i:3*i+3], "big") for i in range(self.nLeds)]
+        elif frameType == FRAME_REFRESH and len(payload) == 1 and chr(payload[0]) in "pfo":
+            self.refresh(chr(payload[0]))
+        elif frameType == FRAME_CREDIT and self.creditSupport and len(payload) == 1 and payload[0] <= 1:
+            self.setCredits(payload[0] == 1)
+        elif frameType == FRAME_FRAMES and len(payload) == 1 and payload[0] <= 1:
+            self.setFramedReplies(payload[0] == 1)
+        elif frameType in frameCommands:
+            self.println("E: Bad format.")
+        else:
+            self.println("E: Unknown frame type " + str(frameType) + ".")
+
+    def processAssignFrame(self, payload):
+        if len(payload) < 2 or (len(payload) - 2) % 3 != 0 or payload[0] > 9 or payload[1] > 1:
+            self.println("E: Bad format.")
+            return
+        self.assignments[payload[0]][payload[1]] = list(struct.iter_unpack("<BH", payload[2:2+3*self.nEvents]))
+
+    #Equivalent of display.writeImage() for a single row
+    def writeImageRow(self, data, x, y, w):
+        if y >= self.dispH or x >= self.dispW:
+            return
+        n = min((w+7)//8, (self.dispW - x)//8)
+        offset = y*self.dispW//8 + x//8
+        self.framebuffer[offset:offset+n] = data[:n]
+
+    def processAssignCommand(self):
+        line = self.serialBuffer.decode(errors="replace")
+        if len(line) < 4 or line[1] != " ":
+            self.printErrorWithIndex("Bad format", 1)
+            return
+        if line[2] >= "1" and line[2] <= "9":
+            key = ord(line[2]) - ord("1")
+        elif line[2] == "R":
+            key = 9
+        else:
+            self.printErrorWithIndex("Bad format", 2)
+            return
+        if line[3] in "p+":
+            pr = 0
+        elif line[3] in "r-":
+            pr = 1
+        else:
+            self.printErrorWithIndex("Bad format", 3)
+            return
+
+        events = []
+        i = 4
+        while i < len(line) and len(events) < self.nEvents:
+            if line[i] != " ":
+                self.printErrorWithIndex("Event not separated by white-space", i)
+                return
+            i += 1
+            if i+1 >= len(line):
+                self.printErrorWithIndex("Sudden end", i)
+                return
+            token = line[i:].split(" ", 1)[0]
+            event = parseEvent(token)
+            if event == None:
+                self.printErrorWithIndex("Bad event", i)
+                break
+            events.append(event)
+            i += len(token)
+        self.assignments[key][pr] = events
+
+    def processDisplayCommand(self):
+        fields = self.serialBuffer.decode(errors="replace").split(" ")
+        if len(fields) not in ((5, 6) if self.rleSupport else (5,)) or not all(f.isdecimal() for f in fields[1:]):
+            self.println("E: Bad format.")
+            return
+        self.startImage(*[int(f) for f in fields[1:]])
+
+    #If packedLength is given, that many bytes of PackBits encoded data follow instead of the raw image data
+    def startImage(self, x, y, w, h, packedLength=None):
+        if (w+7)//8 >= self.serialBufferSize:
+            self.println("E: Bad format.") #A row has to fit into the serial buffer
+            return
+        self.imageDataTargetX, self.imageDataTargetY, self.imageDataTargetWidth = x, y, w
+        self.expectingImageData = w*h//8
+        self.imageDataCurrentY = y
+        if packedLength != None:
+            self.packedRemaining = packedLength
+            self.unpacker = PackBitsDecoder()
+            if packedLength == 0:
+                self.expectingImageData = 0
+
+    def processInfoCommand(self):
+        if len(self.serialBuffer) > 1:
+            self.println("E: Bad format.")
+            return
+        self.framedReplies = False #The info block is always sent as text, so a host that does not know about frames can connect
+        self.println("Inkkeys")
+        self.println("TEST 0")
+        self.println("N_LED " + str(self.nLeds))
+        self.println("DISP_W " + str(self.dispW))
+        self.println("DISP_H " + str(self.dispH))
+        self.println("ROT_CIRCLE_STEPS " + str(self.rotCircleSteps))
+        if self.creditSupport:
+            self.println("CREDIT 1")
+        if self.frameSupport:
+            self.println("FRAMES 1")
+        if self.rleSupport:
+            self.println("RLE 1")
+        self.println("Done")
+
+    def processLEDCommand(self):
+        if len(self.serialBuffer) != 7*self.nLeds+1:
+            self.println("E: Bad format.")
+            return
+        line = self.serialBuffer.decode(errors="replace")
+        try:
+            self.leds = [int(line[7*i+2:7*i+8], 16) for i in range(self.nLeds)]
+        except ValueError:
+            self.println("E: Bad format.")
+
+    def processCreditCommand(self):
+        line = self.serialBuffer.decode(errors="replace")
+        if len(line) != 3 or line[1] != " " or line[2] not in "01":
+            self.println("E: Bad format.")
+            return
+        self.setCredits(line[2] == "1")
+
+    def setCredits(self, enabled):
+        self.credits = enabled
+        self.println("ok")
+
+    def processFramesCommand(self):
+        line = self.serialBuffer.decode(errors="replace")
+        if len(line) != 3 or line[1] != " " or line[2] not in "01":
+            self.println("E: Bad format.")
+            return
+        self.setFramedReplies(line[2] == "1")
+
+    #The reply is still sent in the previous format
+    def setFramedReplies(self, enabled):
+        self.println("ok")
+        self.framedReplies = enabled
+
+    def processRefreshCommand(self):
+        line = self.serialBuffer.decode(errors="replace")
+        if len(line) != 3 or line[1] != " " or line[2] not in "pfo":
+            self.println("E: Bad format.")
+            return
+        self.refresh(line[2])
+
+    def refresh(self, refreshType):
+        if refreshType == "o":
+            delay = self.powerOffTime
+        else:
+            delay = self.partialRefreshTime if refreshType == "p" else self.fullRefreshTime
+            self.shown = bytes(self.framebuffer)
+            self.refreshes += 1
+        if delay * self.timeScale > 0:
+            time.sleep(delay * self.timeScale)
+        self.println("ok")
+
+    #Simulate user input. These report the event to the host just like checkKeysAndReportChanges() and checkRotaryEncoderAndReportChanges()
+    def pressKey(self, n):
+        with self.lock:
+            self.println(str(n) + "p")
+
+    def releaseKey(self, n):
+        with self.lock:
+            self.println(str(n) + "r")
+
+    def rotate(self, steps):
+        with self.lock:
+            self.println("R" + str(steps))
+
+    #Returns the bytes of the rectangle x, y, w, h of the display RAM (or the visible content if shown is set) in the same layout as sent by Device.sendImage
+    def getRegion(self, x, y, w, h, shown=False):
+        fb = self.shown if shown else self.framebuffer
+        stride = self.dispW//8
+        return b"".join(bytes(fb[(y+row)*stride + x//8:(y+row)*stride + (x+w)//8]) for row in range(h))
+
+    #Exposes the emulator on a new pseudo terminal and returns its device path, which can be passed to Device.connect()
+    def openPty(self):
+        import pty, tty #Not available on Windows
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        link = _PtyLink(self, master, slave)
+        link.start()
+        return os.ttyname(slave)
+
+
+#Runs the emulator in its own thread, so a slow refresh blocks the "device" just like the real firmware without blocking the host.
+class _EmulatorLink:
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.emulator.output = self.sendToHost
+        self.incoming = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.busy = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def receiveFromHost(self, data):
+        with self.condition:
+            self.incoming.append(bytes(data))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.incoming) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                data = b"".join(self.incoming)
+                self.incoming.clear()
+                self.busy = True
+            try:
+                self.emulator.receive(data)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    #Blocks until the emulator has processed everything received so far
+    def drain(self):
+        with self.condition:
+            while self.running and (len(self.incoming) > 0 or self.busy):
+                self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+class _PtyLink(_EmulatorLink):
+    def __init__(self, emulator, master, slave):
+        super().__init__(emulator)
+        self.master = master
+        self.slave = slave
+        threading.Thread(target=self.readFromHost, daemon=True).start()
+
+    def readFromHost(self):
+        while self.running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            self.receiveFromHost(data)
+
+    def sendToHost(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+
+#A stand-in for serial.Serial that is directly connected to an Emulator. It can be passed to Device.connect() instead of a port name.
+class EmulatedSerial(_EmulatorLink):
+    name = "emulator"
+
+    def __init__(self, emulator=None, timeout=1):
+        super().__init__(emulator if emulator != None else Emulator())
+        self.timeout = timeout
+        self.outgoing = bytearray()
+        self.outgoingCondition = threading.Condition()
+        self.is_open = True
+
+        #Statistics of the host side
+        self.bytesWritten = 0
+        self.writeCalls = 0
+        self.bytesRead = 0
+        self.start()
+
+    def __str__(self):
+        return self.name
+
+    def sendToHost(self, data):
+        with self.outgoingCondition:
+            self.outgoing += data
+            self.outgoingCondition.notify_all()
+
+    def write(self, data):
+        self.writeCalls += 1
+        self.bytesWritten += len(data)
+        self.receiveFromHost(data)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.outgoing)
+
+    def read(self, size=1):
+        with self.outgoingCondition:
+            deadline = None if self.timeout == None else time.time() + self.timeout
+            while len(self.outgoing) < size and self.is_open:
+                remaining = None if deadline == None else deadline - time.time()
+                if remaining != None and remaining <= 0:
+                    break
+                self.outgoingCondition.wait(remaining)
+            data = bytes(self.outgoing[:size])
+            del self.outgoing[:size]
+            self.bytesRead += len(data)
+            return data
+
+    #Like serial.Serial.flush(), this waits until all data has been transmitted
+    def flush(self):
+        self.drain()
+
+    def close(self):
+        self.is_open = False
+        self.stop()
+        with self.outgoingCondition:
+            self.outgoingCondition.notify_all()
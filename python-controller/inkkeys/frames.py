@@ -0,0 +1,243 @@
+#Framed binary variant of the serial protocol. Instead of text lines, commands are sent as frames
+#
+#   0xA5 | type | length (LE16) | payload | CRC-8 of type, length and payload (polynomial 0x07)
+#
+#which the firmware can parse without scanning for numbers: LED frames carry 3 bytes per LED, assignments carry the
+#Event structs of eventsequence.h and display headers carry x, y, w and h as LE16 (followed by the raw image data just
+#like after a text "D" command). Firmware that reports "FRAMES 1" in its info block accepts frames at any point where
+#it would accept a text command, as text commands never start with 0xA5. After "B 1", it also sends "ok", credits and
+#key events as frames until the next info request, while errors and the info block stay text lines. FrameDecoder takes
+#care of both and replyLines() turns reply frames back into the lines of the text protocol.
+
+import re
+import struct
+from .protocol import CommandCode, KeyCode
+
+SYNC = 0xA5
+
+#Frames from the host
+FRAME_ASSIGN = 0x01     #Key index (0-8 keys, 9 jog), 0 for press/+ or 1 for release/-, then up to N_EVENTS Event structs
+FRAME_DISPLAY = 0x02    #x, y, w, h (LE16), followed by w*h/8 bytes of raw image data outside the frame. A fifth field is the length of PackBits encoded data instead (see packbits.py).
+FRAME_LED = 0x03        #R, G, B for each LED
+FRAME_REFRESH = 0x04    #RefreshTypeCode as character
+FRAME_CREDIT = 0x05     #0 or 1, as "C" command
+FRAME_FRAMES = 0x06     #0 or 1, as "B" command
+
+#Frames from the device
+REPLY_OK = 0x81
+REPLY_CREDIT = 0x82     #A row of image data has been written
+REPLY_KEY = 0x83        #Key number (1-9) and "p" or "r"
+REPLY_JOG = 0x84        #Steps as signed LE16
+
+maxPayload = 1024       #Longer frames from the device are considered garbage
+
+#Command letters of the frame types, e.g. for statistics
+frameCommands = {FRAME_ASSIGN: CommandCode.ASSIGN.value, FRAME_DISPLAY: CommandCode.DISPLAY.value, FRAME_LED: CommandCode.LED.value, FRAME_REFRESH: CommandCode.REFRESH.value, FRAME_CREDIT: CommandCode.CREDIT.value, FRAME_FRAMES: CommandCode.FRAMES.value}
+
+#Constants from eventsequence.ino
+DEVICE_NONE = 0x00
+DEVICE_DELAY = 0x01
+DEVICE_CONSUMER = 0x02
+DEVICE_KEYBOARD = 0x03
+DEVICE_MOUSE = 0x04
+
+TYPE_NONE = 0x00
+TYPE_PRESS = 0x10
+TYPE_RELEASE = 0x20
+TYPE_INCREMENT = 0x30
+TYPE_STROKE = 0x40
+
+MOUSEAXIS_BUTTON = 0x00
+MOUSEAXIS_X = 0x01
+MOUSEAXIS_Y = 0x02
+MOUSEAXIS_WHEEL = 0x03
+
+N_EVENTS = 10
+
+eventPattern = re.compile(r"^(?:d(?P<delay>\d+)|(?P<dev>[ck])(?P<code>\d+)(?P<type>[pr]?)|m(?P<axis>[xyw]|\d+)(?:(?P<mtype>[pr])|i(?P<inc>-?\d+))?)$")
+
+def makeCrcTable():
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table.append(crc)
+    return bytes(table)
+
+crcTable = makeCrcTable()
+
+def crc8(data, crc=0):
+    for b in data:
+        crc = crcTable[crc ^ b]
+    return crc
+
+def encodeFrame(frameType, payload=b""):
+    if len(payload) > 0xffff:
+        raise ValueError("Frame payload too long.")
+    body = bytes((frameType, len(payload) & 0xff, len(payload) >> 8)) + payload
+    return bytes((SYNC,)) + body + bytes((crc8(body),))
+
+#Parses an event of an assign command (like "k39p", see protocol.event()) into (deviceAndType, keycodeOrDelay) as in the Event struct or returns None if it is invalid
+def parseEvent(token):
+    m = eventPattern.match(token)
+    if m == None:
+        return None
+    if m.group("delay") != None:
+        return (DEVICE_DELAY, int(m.group("delay")) & 0xffff)
+    types = {"": TYPE_STROKE, "p": TYPE_PRESS, "r": TYPE_RELEASE}
+    if m.group("dev") != None:
+        device = DEVICE_CONSUMER if m.group("dev") == "c" else DEVICE_KEYBOARD
+        return (device | types[m.group("type")], int(m.group("code")) & 0xffff)
+    axis = m.group("axis")
+    if axis in "xyw":
+        code = {"x": MOUSEAXIS_X, "y": MOUSEAXIS_Y, "w": MOUSEAXIS_WHEEL}[axis] << 8
+    else:
+        code = (MOUSEAXIS_BUTTON << 8) | (int(axis) & 0xff)
+    if m.group("inc") != None:
+        return (DEVICE_MOUSE | TYPE_INCREMENT, code | (int(m.group("inc")) & 0xff))
+    return (DEVICE_MOUSE | types[m.group("mtype") or ""], code)
+
+def encodeAssign(key, sequence):
+    if key[0] == KeyCode.JOG.value:
+        index = 9
+    elif key[0] in "123456789":
+        index = int(key[0]) - 1
+    else:
+        raise ValueError("Unknown key: " + key)
+    if key[1] not in "pr+-":
+        raise ValueError("Unknown key action: " + key)
+    payload = bytearray((index, 0 if key[1] in "p+" else 1))
+    for token in sequence[:N_EVENTS]:
+        event = parseEvent(token)
+        if event == None:
+            raise ValueError("Invalid event: " + token)
+        payload += struct.pack("<BH", *event)
+    return encodeFrame(FRAME_ASSIGN, bytes(payload))
+
+def encodeDisplayHeader(x, y, w, h, packedLength=None):
+    if packedLength != None:
+        return encodeFrame(FRAME_DISPLAY, struct.pack("<5H", x, y, w, h, packedLength))
+    return encodeFrame(FRAME_DISPLAY, struct.pack("<4H", x, y, w, h))
+
+#Colors as bytes with R, G and B of each LED, like the frames of leds.py
+def encodeLeds(rgb):
+    return encodeFrame(FRAME_LED, bytes(rgb))
+
+#Converts a command of the text protocol (without the line break) into a frame. Commands without a binary variant (info) stay text.
+def encodeTextCommand(command):
+    code = command[:1]
+    args = command[2:]
+    if code == CommandCode.ASSIGN.value:
+        fields = args.split(" ")
+        return encodeAssign(fields[0], fields[1:])
+    if code == CommandCode.LED.value:
+        return encodeLeds(b"".join(bytes.fromhex(color) for color in args.split(" ")))
+    if code == CommandCode.REFRESH.value:
+        return encodeFrame(FRAME_REFRESH, args.encode())
+    if code == CommandCode.CREDIT.value:
+        return encodeFrame(FRAME_CREDIT, bytes((int(args),)))
+    if code == CommandCode.FRAMES.value:
+        return encodeFrame(FRAME_FRAMES, bytes((int(args),)))
+    if code == CommandCode.DISPLAY.value:
+        return encodeDisplayHeader(*[int(f) for f in args.split(" ")])
+    return (command + "\n").encode()
+
+#Bytes to send for a text command in either protocol
+def encodeCommand(command, framed):
+    return encodeTextCommand(command) if framed else (command + "\n").encode()
+
+#Command letter of encoded text commands and frames
+def commandCode(data):
+    if len(data) > 1 and data[0] == SYNC:
+        return frameCommands.get(data[1], "?")
+    return chr(data[0]) if len(data) > 0 else ""
+
+#Splits encoded display commands (one or several in a row, like the blob of a scene) into tuples of the header, the width of the image, the image data and whether the data is PackBits encoded
+def splitImageCommands(commands):
+    result = []
+    offset = 0
+    while offset < len(commands):
+        if commands[offset] == SYNC:
+            length = commands[offset+2] | commands[offset+3] << 8
+            fields = struct.unpack_from("<" + str(length//2) + "H", commands, offset+4)
+            start = offset + 5 + length
+        else:
+            end = commands.index(b"\n", offset)
+            fields = [int(f) for f in commands[offset+2:end].split(b" ")]
+            start = end + 1
+        w, h = fields[2], fields[3]
+        end = start + (fields[4] if len(fields) > 4 else (w+7)//8*h)
+        result.append((commands[offset:start], w, commands[start:end], len(fields) > 4))
+        offset = end
+    return result
+
+#Lines of the text protocol equivalent to a reply frame
+def replyLines(frameType, payload):
+    if frameType == REPLY_OK:
+        return ["ok"]
+    if frameType == REPLY_CREDIT:
+        return ["c"] * max(1, payload[0] if len(payload) > 0 else 1)
+    if frameType == REPLY_KEY and len(payload) == 2:
+        return [str(payload[0]) + chr(payload[1])]
+    if frameType == REPLY_JOG and len(payload) == 2:
+        return [KeyCode.JOG.value + str(struct.unpack("<h", payload)[0])]
+    return ["E: Unknown reply frame " + hex(frameType) + "."]
+
+#Counterpart of replyLines() for the emulator. Returns None for lines that are sent as text anyway.
+def encodeReply(line):
+    if line == "ok":
+        return encodeFrame(REPLY_OK)
+    if line == "c":
+        return encodeFrame(REPLY_CREDIT, b"\x01")
+    if len(line) == 2 and line[0] in "123456789" and line[1] in "pr":
+        return encodeFrame(REPLY_KEY, bytes((int(line[0]), ord(line[1]))))
+    if line[:1] == KeyCode.JOG.value and len(line) > 1 and line[1:].lstrip("-").isdecimal():
+        return encodeFrame(REPLY_JOG, struct.pack("<h", int(line[1:])))
+    return None
+
+
+#Incremental decoder for the data received from the device, which may mix text lines and frames. feed() returns a list of (frame type, payload) tuples, where the frame type is None for text lines.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crcErrors = 0
+
+    def feed(self, data):
+        self.buffer += data
+        result = []
+        while len(self.buffer) > 0:
+            if self.buffer[0] == SYNC:
+                if len(self.buffer) < 4:
+                    break
+                length = self.buffer[2] | self.buffer[3] << 8
+                if length > maxPayload:
+                    del self.buffer[0] #Not a frame, look for the next start
+                    continue
+                if len(self.buffer) < 5 + length:
+                    break
+                body = bytes(self.buffer[1:4+length])
+                crc = self.buffer[4+length]
+                del self.buffer[:5+length]
+                if crc8(body) != crc:
+                    self.crcErrors += 1
+                    result.append((None, b"E: Bad checksum."))
+                    continue
+                result.append((body[0], body[3:]))
+            else:
+                end = self.buffer.find(b"\n")
+                if end < 0:
+                    break
+                result.append((None, bytes(self.buffer[:end]).replace(b"\r", b"")))
+                del self.buffer[:end+1]
+        return result
+
+    #Like feed(), but returns everything as lines of the text protocol
+    def feedLines(self, data):
+        lines = []
+        for frameType, payload in self.feed(data):
+            if frameType == None:
+                lines.append(payload.decode(errors="replace"))
+            else:
+                lines.extend(replyLines(frameType, payload))
+        return lines
@@ -0,0 +1,76 @@
+#Latency from a key or jog event arriving on the serial port to what the controller does about it. Each event gets
+#its arrival time when it is read. While its callback runs, the event is the current event (a context variable), so
+#every command the callback queues carries it to the transmit thread - also via display refreshs and asyncio tasks,
+#which copy the context. The latency is recorded when the callback returns and when the first command of each
+#priority class caused by the event has been written to the port (e.g. the LEDs of showVolume or the refresh after
+#toggleLight).
+#
+#Percentiles are kept per key and per mode:
+#   device.latency.stats()["byKey"]["led"]["R"]["p99"]
+
+from .protocol import KeyCode
+import threading
+import time
+import contextvars
+from collections import deque
+
+currentEvent = contextvars.ContextVar("inkkeysCurrentEvent", default=None) #KeyEvent whose callback is running
+
+class KeyEvent:
+    __slots__ = ("input", "key", "arrival", "mode", "recorded")
+
+    def __init__(self, input, arrival, mode=None):
+        self.input = input          #Line from the device, e.g. "2p" or "R-1"
+        self.key = input if input[0] != KeyCode.JOG.value else KeyCode.JOG.value #Callback key, so all jog events are collected together
+        self.arrival = arrival      #time.perf_counter() when it has been read
+        self.mode = mode            #Mode that was active when the event arrived
+        self.recorded = set()       #Kinds of latency that have been recorded for this event
+
+
+class LatencyTracker:
+    historySize = 1000      #Latencies kept per key and mode (and per kind)
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics  #DeviceMetrics that also receive the latencies as histogram
+        self.mode = None        #Name of the current mode, set by the controller
+        self.lock = threading.Lock()
+        self.byKey = {}         #Deque of latencies by (kind, key)
+        self.byMode = {}        #Deque of latencies by (kind, mode)
+
+    def event(self, input, arrival=None):
+        return KeyEvent(input, arrival if arrival != None else time.perf_counter(), self.mode)
+
+    #Records the time since the event arrived as latency of the given kind ("callback", "control", "led" or "image"), but only once per event and kind
+    def record(self, event, kind):
+        t = time.perf_counter() - event.arrival
+        mode = event.mode if event.mode != None else "none"
+        with self.lock:
+            if kind in event.recorded:
+                return
+            event.recorded.add(kind)
+            for samples, label in ((self.byKey, event.key), (self.byMode, mode)):
+                if (kind, label) not in samples:
+                    samples[(kind, label)] = deque(maxlen=self.historySize)
+                samples[(kind, label)].append(t)
+        if self.metrics != None:
+            self.metrics.keyLatency.observe(t, kind, event.key, mode)
+
+    @staticmethod
+    def summarize(samples):
+        ordered = sorted(samples)
+        n = len(ordered)
+        return {"count": n, "p50": ordered[(n-1)//2], "p99": ordered[int(0.99*(n-1))], "max": ordered[-1]}
+
+    #Percentiles in seconds as {"byKey": {kind: {key: summary}}, "byMode": {kind: {mode: summary}}}
+    def stats(self):
+        result = {"byKey": {}, "byMode": {}}
+        with self.lock:
+            for name, samples in (("byKey", self.byKey), ("byMode", self.byMode)):
+                for (kind, label), times in samples.items():
+                    result[name].setdefault(kind, {})[label] = self.summarize(times)
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.byKey = {}
+            self.byMode = {}
@@ -0,0 +1,79 @@
+#LED frames as NumPy arrays with one row of (red, green, blue) per LED. Animations like fades, hue cycles and level
+#meters are calculated for all LEDs at once and the LedEngine only sends frames to the device if they actually differ
+#from the last one that has been sent.
+
+import numpy as np
+import time
+from collections import deque
+
+#Converts a list of 0xRRGGBB colors (as used by Device.setLeds) into a frame. Frames are passed through unchanged.
+def toFrame(leds):
+    if isinstance(leds, np.ndarray) and leds.dtype == np.uint8 and leds.ndim == 2:
+        return leds
+    c = np.asarray(leds, dtype=np.uint32)
+    return np.stack(((c >> 16) & 0xff, (c >> 8) & 0xff, c & 0xff), axis=-1).astype(np.uint8)
+
+#Hex colors as expected by the LED command
+def encodeFrame(frame):
+    h = frame.tobytes().hex()
+    return [h[i:i+6] for i in range(0, len(h), 6)]
+
+#Frame with all LEDs set to the same 0xRRGGBB color
+def solid(n, color):
+    return np.tile(toFrame([color]), (n, 1))
+
+#Dims a frame to the fraction p of its brightness
+def fade(frame, p):
+    return (frame * np.float32(p)).astype(np.uint8)
+
+#Rainbow around the LED ring, that completes one turn of the color wheel every "period" seconds
+def hueCycle(n, t, period=1.0):
+    h = (t/period + np.arange(n)/n) % 1.0
+    i = (h*6.0).astype(np.int32) % 6
+    f = h*6.0 - np.floor(h*6.0)
+    #Same as colorsys.hsv_to_rgb with full saturation and value: Each sector is a combination of 1, 1-f, 0 and f
+    channels = np.stack((np.ones(n), 1.0 - f, np.zeros(n), f))
+    sectors = np.array([[0, 3, 2], [1, 0, 2], [2, 0, 3], [2, 1, 0], [3, 2, 0], [0, 2, 1]])
+    rgb = channels[sectors[i], np.arange(n)[:, None]]
+    return (rgb * 255).astype(np.uint8)
+
+#LEDs in the "on" color up to the given level (0 to 1) and in the "off" color above it
+def levelMeter(n, level, on, off):
+    lit = level > np.arange(n)/max(1, n-1)
+    return np.where(lit[:, None], toFrame([on]), toFrame([off])).astype(np.uint8)
+
+
+class LedEngine:
+    historySize = 100   #Number of frames kept in computedFrames and sentFrames
+
+    def __init__(self, device):
+        self.device = device
+        self.lastSent = None                                #Last frame sent to the device (None if unknown)
+        self.computedFrames = deque(maxlen=self.historySize) #Tuples of (time, frame) of all frames passed to show()
+        self.sentFrames = deque(maxlen=self.historySize)     #Tuples of (time, frame) of frames that actually have been sent
+
+        #Statistics
+        self.computed = 0
+        self.sent = 0
+        self.skipped = 0
+
+    #Sends a frame to the device unless the LEDs already show it. Returns True if the frame has been sent.
+    def show(self, frame):
+        now = time.time()
+        self.computed += 1
+        self.computedFrames.append((now, frame))
+        if self.lastSent is not None and np.array_equal(frame, self.lastSent):
+            self.skipped += 1
+            return False
+        self.device.sendLedFrame(frame)
+        self.lastSent = frame.copy()
+        self.sent += 1
+        self.sentFrames.append((now, self.lastSent))
+        return True
+
+    #The LEDs of the device are in an unknown state (reconnected or device reset), so the next frame is sent in any case
+    def invalidate(self):
+        self.lastSent = None
+
+    def stats(self):
+        return {"computed": self.computed, "sent": self.sent, "skipped": self.skipped}
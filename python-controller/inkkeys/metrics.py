@@ -0,0 +1,261 @@
+#Counters and histograms about the device I/O and the main loop. They are collected in a registry and can be exported
+#in the Prometheus text format, either on a local HTTP endpoint (MetricsServer) or by rewriting a file periodically
+#(MetricsFileWriter), which can for example be picked up by the textfile collector of the node exporter.
+#
+#Example:
+#   MetricsServer(registry, 9464).start()     #Then visit http://127.0.0.1:9464/metrics
+
+import os
+import threading
+import time
+import tempfile
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .frames import commandCode
+
+def formatLabels(labelNames, labelValues, extra=()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in pairs) + "}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.values = {}    #Value by tuple of label values
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labelValues):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def get(self, *labelValues):
+        return self.values.get(labelValues, 0)
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " counter"]
+        with self.lock:
+            values = self.values if len(self.values) > 0 or len(self.labelNames) > 0 else {(): 0} #Without labels, the metric is reported even before it has been counted
+            for labelValues, value in sorted(values.items()):
+                lines.append(self.name + formatLabels(self.labelNames, labelValues) + " " + formatValue(value))
+        return lines
+
+
+#Timer for the with statement, see Histogram.time()
+class _HistogramTimer:
+    def __init__(self, histogram, labelValues):
+        self.histogram = histogram
+        self.labelValues = labelValues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelValues)
+        return False
+
+
+class Histogram:
+    defaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) #Seconds
+
+    def __init__(self, name, help, labelNames=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(buckets if buckets != None else self.defaultBuckets)
+        self.values = {}    #[bucket counts, sum, count] by tuple of label values
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelValues):
+        with self.lock:
+            entry = self.values.get(labelValues)
+            if entry == None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[labelValues] = entry
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    #Measures the time of a with block
+    def time(self, *labelValues):
+        return _HistogramTimer(self, labelValues)
+
+    def count(self, *labelValues):
+        entry = self.values.get(labelValues)
+        return entry[2] if entry != None else 0
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " histogram"]
+        with self.lock:
+            values = self.values if len(self.values) > 0 or len(self.labelNames) > 0 else {(): [[0] * len(self.buckets), 0.0, 0]}
+            for labelValues, (counts, total, count) in sorted(values.items()):
+                cumulative = 0
+                for bucket, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(self.name + "_bucket" + formatLabels(self.labelNames, labelValues, [("le", formatValue(float(bucket)))]) + " " + str(cumulative))
+                lines.append(self.name + "_bucket" + formatLabels(self.labelNames, labelValues, [("le", "+Inf")]) + " " + str(count))
+                lines.append(self.name + "_sum" + formatLabels(self.labelNames, labelValues) + " " + formatValue(total))
+                lines.append(self.name + "_count" + formatLabels(self.labelNames, labelValues) + " " + str(count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing != None:
+                if type(existing) != type(metric):
+                    raise ValueError("Metric " + metric.name + " already exists with a different type.")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    #Returns the counter with this name, which is created if it does not exist yet
+    def counter(self, name, help, labelNames=()):
+        return self.add(Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=None):
+        return self.add(Histogram(name, help, labelNames, buckets))
+
+    #The Prometheus text format of all metrics
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+registry = MetricsRegistry() #Default registry used by Device and the controller
+
+
+#Metrics of the serial link recorded by Device (and AsyncDevice). All devices using the same registry share them.
+class DeviceMetrics:
+    def __init__(self, registry):
+        self.commandsSent = registry.counter("inkkeys_commands_sent_total", "Commands queued for the device by command code.", ["command"])
+        self.bytesWritten = registry.counter("inkkeys_bytes_written_total", "Bytes written to the serial port.")
+        self.bytesRead = registry.counter("inkkeys_bytes_read_total", "Bytes read from the serial port.")
+        self.refreshTime = registry.histogram("inkkeys_refresh_seconds", "Time from requesting a display refresh until the device confirmed it.", ["type"])
+        self.refreshFailures = registry.counter("inkkeys_refresh_failures_total", "Display refreshs the device did not confirm in time.")
+        self.infoTime = registry.histogram("inkkeys_info_seconds", "Time of the info handshake when connecting.")
+        self.callbackTime = registry.histogram("inkkeys_callback_seconds", "Execution time of the callbacks by key code.", ["key"])
+        self.keyLatency = registry.histogram("inkkeys_key_latency_seconds", "Time from a key event arriving until its callback returned (kind callback) or the first command of a priority class it caused has been written (kinds control, led and image).", ["kind", "key", "mode"], (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+        self.callbackErrors = registry.counter("inkkeys_callback_errors_total", "Callbacks that raised an exception by key code.", ["key"])
+
+    #Command is either a text command or an encoded command (text or frame, see frames.py)
+    def countCommand(self, command):
+        self.commandsSent.inc(1, commandCode(command) if isinstance(command, bytes) else command[:1])
+
+
+#Metrics of the main loop in controller.py
+class LoopMetrics:
+    frameBudget = 1/30      #Frames taking longer than this are counted as overruns, as they make LED animations stutter
+
+    def __init__(self, registry):
+        self.frameTime = registry.histogram("inkkeys_loop_frame_seconds", "Time the main loop spent on each wakeup.", buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 1/30, 0.05, 0.1, 0.25, 1.0))
+        self.overruns = registry.counter("inkkeys_loop_overruns_total", "Iterations of the main loop that took longer than the frame budget.")
+        self.wakeups = registry.counter("inkkeys_loop_wakeups_total", "Wakeups of the main loop.")
+        self.modeSwitches = registry.counter("inkkeys_mode_switches_total", "Activations of a mode by mode name.", ["mode"])
+
+    def observeFrame(self, t):
+        self.wakeups.inc()
+        self.frameTime.observe(t)
+        if t > self.frameBudget:
+            self.overruns.inc()
+
+
+class MetricsServer:
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self.registry = registry
+        self.port = port
+        self.host = host        #Only reachable locally unless another address is given
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass #No output for each scrape
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="inkkeys-metrics", daemon=True)
+        self.thread.start()
+        print("Serving metrics on http://" + self.host + ":" + str(self.server.server_address[1]) + "/metrics")
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsFileWriter:
+    def __init__(self, registry, path, interval=15.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="inkkeys-metrics", daemon=True)
+        self.thread.start()
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.registry.render())
+            os.chmod(tmp, 0o644) #mkstemp only lets the owner read the file, but the collector may run as another user
+            os.replace(tmp, self.path) #Readers never see a partially written file
+        except BaseException:
+            try:
+                os.unlink(tmp) #Do not leave temporary files behind, as a write is attempted every interval
+            except OSError:
+                pass
+            raise
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.write()
+            except OSError as e:
+                print("Could not write metrics to ", self.path, ": ", e)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join(2)
+        try:
+            self.write() #Final state
+        except OSError:
+            pass
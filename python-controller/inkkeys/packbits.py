@@ -0,0 +1,109 @@
+#PackBits run-length encoding of packed image data. Icons and labels are mostly white, so most rows shrink to a couple
+#of bytes. The encoded data is a sequence of packets, each starting with a header byte n:
+#
+#   0 to 127    n+1 literal bytes follow
+#   129 to 255  the next byte is repeated 257-n times
+#   128         no operation
+#
+#Each row is encoded on its own, so a row always ends with a packet. This lets the PacedWriter find the row boundaries
+#in the encoded data (see rowEnds()) to keep the credit handshake, which acknowledges each row written to the display.
+#Firmware that reports "RLE 1" in its info block accepts this as a display command with the encoded length as fifth
+#field ("D x y w h n") and decodes it byte by byte while writing the rows.
+
+import re
+
+runPattern = re.compile(rb"(.)\1{2,}", re.DOTALL) #Runs of at least 3 equal bytes, shorter ones are cheaper as literals
+
+def packLiteral(out, data):
+    for i in range(0, len(data), 128):
+        part = data[i:i+128]
+        out.append(len(part) - 1)
+        out += part
+
+def packRun(out, value, n):
+    while n >= 2:
+        k = min(n, 128)
+        out.append(257 - k)
+        out.append(value)
+        n -= k
+    if n == 1:
+        out.append(0)
+        out.append(value)
+
+def packRow(out, row):
+    start = 0
+    for m in runPattern.finditer(row):
+        packLiteral(out, row[start:m.start()])
+        packRun(out, row[m.start()], m.end() - m.start())
+        start = m.end()
+    packLiteral(out, row[start:])
+
+#Encodes packed image data with rowBytes per row
+def packRows(data, rowBytes):
+    out = bytearray()
+    for offset in range(0, len(data), rowBytes):
+        packRow(out, data[offset:offset+rowBytes])
+    return bytes(out)
+
+def unpack(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        if n < 128:
+            out += data[i+1:i+n+2]
+            i += n + 2
+        elif n > 128:
+            out += data[i+1:i+2] * (257 - n)
+            i += 2
+        else:
+            i += 1
+    return bytes(out)
+
+#Offsets in the encoded data at which each decoded row is complete
+def rowEnds(data, rowBytes):
+    ends = []
+    decoded = 0
+    i = 0
+    while i < len(data):
+        n = data[i]
+        if n < 128:
+            decoded += n + 1
+            i += n + 2
+        elif n > 128:
+            decoded += 257 - n
+            i += 2
+        else:
+            i += 1
+        while decoded >= rowBytes:
+            ends.append(min(i, len(data)))
+            decoded -= rowBytes
+    if decoded > 0:
+        ends.append(len(data))
+    return ends
+
+#Longest possible encoding of a row, i.e. a literal with a header byte for every 128 bytes
+def maxPackedRow(rowBytes):
+    return rowBytes + (rowBytes + 127)//128
+
+
+#Decodes one byte at a time like the firmware does while receiving
+class PackBitsDecoder:
+    def __init__(self):
+        self.literal = 0    #Literal bytes still to come in the current packet
+        self.repeat = 0     #Number of times the next byte is repeated
+
+    #Returns the decoded bytes resulting from the byte c
+    def feed(self, c):
+        if self.literal > 0:
+            self.literal -= 1
+            return bytes((c,))
+        if self.repeat > 0:
+            n = self.repeat
+            self.repeat = 0
+            return bytes((c,)) * n
+        if c < 128:
+            self.literal = c + 1
+        elif c > 128:
+            self.repeat = 257 - c
+        return b""
@@ -17,6 +17,8 @@ class CommandCode(Enum):
     LED = "L"
     REFRESH = "R"
     INFO = "I"
+    CREDIT = "C"
+    FRAMES = "B"
 
 class RefreshTypeCode(Enum):
     PARTIAL = "p"
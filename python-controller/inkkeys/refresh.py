@@ -0,0 +1,99 @@
+#Coalescing display refreshs. Modes and callbacks only report that the display needs a refresh and continue right away.
+#A background thread then refreshes the display once for all requests that arrived within a short debounce window or
+#while the previous refresh was still in progress.
+
+import threading
+import time
+import traceback
+from .latency import currentEvent
+
+class RefreshScheduler:
+    debounce = 0.05     #Seconds to wait for further requests before starting a refresh
+    maxDelay = 0.5      #A steady stream of requests does not delay a refresh longer than this
+
+    def __init__(self, device):
+        self.device = device
+        self.condition = threading.Condition()
+        self.pending = False        #A refresh has been requested but not started yet
+        self.pendingFull = False    #At least one of the pending requests asked for a full refresh
+        self.inFlight = False       #A refresh is currently running
+        self.firstRequest = 0
+        self.lastRequest = 0
+        self.origin = None          #Key event of the first pending request, so the latency includes the refresh
+        self.thread = None
+        self.running = False
+
+        #Statistics
+        self.requests = 0
+        self.refreshes = 0
+
+    #Marks the display as dirty and returns immediately
+    def request(self, fullRefresh=False):
+        with self.condition:
+            self.requests += 1
+            if not self.pending:
+                self.firstRequest = time.time()
+                self.origin = None
+            if self.origin == None:
+                self.origin = currentEvent.get()
+            self.pending = True
+            self.pendingFull = self.pendingFull or fullRefresh
+            self.lastRequest = time.time()
+            if not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, name="inkkeys-refresh", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                #Wait for more requests, so quick successions of changes end up in one refresh
+                remaining = min(self.lastRequest + self.debounce, self.firstRequest + self.maxDelay) - time.time()
+                while self.running and remaining > 0:
+                    self.condition.wait(remaining)
+                    remaining = min(self.lastRequest + self.debounce, self.firstRequest + self.maxDelay) - time.time()
+                if not self.running:
+                    return
+                fullRefresh = self.pendingFull
+                origin = self.origin
+                self.pending = False
+                self.pendingFull = False
+                self.origin = None
+                self.inFlight = True
+            token = currentEvent.set(origin) #The refresh commands are sent on behalf of the key event that requested it
+            try:
+                self.device.updateDisplay(fullRefresh)
+                self.refreshes += 1
+            except Exception:
+                print("Display refresh failed:")
+                traceback.print_exc()
+            finally:
+                currentEvent.reset(token)
+                with self.condition:
+                    self.inFlight = False
+                    self.condition.notify_all()
+
+    #Blocks until all requested refreshs have been done. Returns False if this did not happen within timeout seconds.
+    def wait(self, timeout=None):
+        deadline = None if timeout == None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.inFlight:
+                remaining = None if deadline == None else deadline - time.time()
+                if remaining != None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    #Drops pending requests and stops the background thread
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending = False
+            self.pendingFull = False
+            self.origin = None
+            self.condition.notify_all()
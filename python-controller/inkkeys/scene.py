@@ -0,0 +1,47 @@
+#Precompiled "scenes" hold the static setup of a mode (title, icons, labels and key assignments) as ready-to-send
+#commands. They are created once with Device.compileScene() and can then be shown with Device.playScene(), which
+#queues the precompiled assignments and display commands as one payload each instead of rendering and sending
+#everything piece by piece. If the display content of all its areas is known, only the differences are sent.
+
+from .protocol import *
+from .frames import encodeCommand
+
+class Scene:
+    def __init__(self, dispW, dispH, assignments, images, framed=False, compressed=False):
+        self.dispW = dispW
+        self.dispH = dispH
+        self.framed = framed                    #Commands are encoded as binary frames (see frames.py)
+        self.compressed = compressed            #Image data is PackBits encoded where that is shorter (see packbits.py)
+        self.assignments = tuple(assignments)   #Tuples of (KeyCode value, assign command)
+        self.images = tuple(images)             #Tuples of (x, y, w, h, packed data, list of encoded display commands)
+        self.assignData = b"".join(encodeCommand(command, framed) for key, command in self.assignments) #All assign commands
+        self.blob = b"".join(b"".join(image[5]) for image in self.images) #All display commands, written by one PacedWriter.writeImage()
+
+    #Scenes are rendered for a specific display size and protocol
+    def fits(self, device):
+        return self.dispW == device.dispW and self.dispH == device.dispH and self.framed == device.framing and self.compressed == device.compressing
+
+    def __setattr__(self, name, value):
+        if hasattr(self, "blob"):
+            raise AttributeError("Scenes cannot be modified.")
+        super().__setattr__(name, value)
+
+
+#Collects assignments and images while a scene is compiled instead of sending them to the device
+class SceneRecorder:
+    def __init__(self, device):
+        self.device = device
+        self.assignments = {}
+        self.images = []
+
+    def assign(self, key, command):
+        self.assignments.pop(key, None) #Keep the order of the last assignment
+        self.assignments[key] = command
+
+    def image(self, x, y, w, h, data):
+        #Images entirely covered by a later image would be overwritten anyway
+        self.images = [i for i in self.images if not (i[0] >= x and i[1] >= y and i[0] + i[2] <= x + w and i[1] + i[3] <= y + h)]
+        self.images.append((x, y, w, h, data, self.device.encodeImageChunks(x, y, w, h, data)))
+
+    def compile(self):
+        return Scene(self.device.dispW, self.device.dispH, self.assignments.items(), self.images, self.device.framing, self.device.compressing)
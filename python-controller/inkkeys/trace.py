@@ -0,0 +1,156 @@
+#Records what the controller is doing in the Chrome trace event format, which can be opened in chrome://tracing or
+#https://ui.perfetto.dev. Spans show up per thread, so a frame of the main loop that took too long can be traced down
+#to the call that caused it. Callbacks of other libraries (OBS, MQTT) are recorded as asynchronous spans, which are
+#shown on their own tracks.
+#
+#Tracing is disabled by default and a span is then hardly more than a function call. Example:
+#   tracer.enable()
+#   with tracer.span("animate", "loop"):
+#       mode.animate(device)
+#   tracer.save("trace.json")
+
+import os
+import json
+import itertools
+import threading
+import time
+
+#Span that does nothing while tracing is disabled
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_nullSpan = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        end = self.tracer.now()
+        event = {"name": self.name, "cat": self.category, "ph": "X", "ts": self.start, "dur": end - self.start, "pid": self.tracer.pid, "tid": threading.get_ident()}
+        if excType != None:
+            self.args = dict(self.args, error=excType.__name__)
+        if len(self.args) > 0:
+            event["args"] = self.args
+        self.tracer.add(event)
+        return False
+
+
+class _AsyncSpan:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.id = self.tracer.begin(self.name, self.category, **self.args)
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.tracer.end(self.id, self.name, self.category)
+        return False
+
+
+class Tracer:
+    maxEvents = 1000000 #Further events are dropped, so a forgotten trace cannot fill up the memory
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.ids = itertools.count(1)
+        self.threads = set()    #Threads whose name has been recorded
+        self.dropped = 0
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    #Microseconds on a monotonic clock, as used by the trace format
+    def now(self):
+        return time.perf_counter_ns() / 1000
+
+    def add(self, event):
+        with self.lock:
+            if len(self.events) >= self.maxEvents:
+                self.dropped += 1
+                return
+            tid = event["tid"]
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": threading.current_thread().name}})
+            self.events.append(event)
+
+    #Context manager recording the time of a with block on the current thread
+    def span(self, name, category="", **args):
+        if not self.enabled:
+            return _nullSpan
+        return _Span(self, name, category, args)
+
+    #Context manager for an asynchronous span, i.e. a callback of another library, which is shown on a track of its own
+    def asyncSpan(self, name, category="", **args):
+        if not self.enabled:
+            return _nullSpan
+        return _AsyncSpan(self, name, category, args)
+
+    #Records a span on the current thread that has already ended, duration is in seconds
+    def complete(self, name, category, duration, **args):
+        if not self.enabled:
+            return
+        end = self.now()
+        event = {"name": name, "cat": category, "ph": "X", "ts": end - duration*1000000, "dur": duration*1000000, "pid": self.pid, "tid": threading.get_ident()}
+        if len(args) > 0:
+            event["args"] = args
+        self.add(event)
+
+    #Starts an asynchronous span that may end on another thread and returns the id to pass to end()
+    def begin(self, name, category="", **args):
+        if not self.enabled:
+            return None
+        id = next(self.ids)
+        event = {"name": name, "cat": category, "ph": "b", "id": id, "ts": self.now(), "pid": self.pid, "tid": threading.get_ident()}
+        if len(args) > 0:
+            event["args"] = args
+        self.add(event)
+        return id
+
+    def end(self, id, name, category=""):
+        if id == None:
+            return
+        self.add({"name": name, "cat": category, "ph": "e", "id": id, "ts": self.now(), "pid": self.pid, "tid": threading.get_ident()})
+
+    #Marks a point in time, e.g. a received key event
+    def instant(self, name, category="", **args):
+        if not self.enabled:
+            return
+        event = {"name": name, "cat": category, "ph": "i", "s": "t", "ts": self.now(), "pid": self.pid, "tid": threading.get_ident()}
+        if len(args) > 0:
+            event["args"] = args
+        self.add(event)
+
+    #Writes everything recorded so far as JSON
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+            dropped = self.dropped
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"droppedEvents": dropped}}, f)
+        print("Trace with " + str(len(events)) + " events written to " + path + (" (" + str(dropped) + " events dropped)" if dropped > 0 else ""))
+
+tracer = Tracer() #Default tracer used by Device and the controller
@@ -0,0 +1,246 @@
+#Prioritized writes to the serial port. Commands are queued in three classes and a background thread always sends the
+#most urgent one next: control commands (assignments, info, refresh), then LED frames, then image data. Images are
+#queued as several display commands of a few rows each, so a key assignment or LED frame only waits for the chunk
+#that is currently being written instead of a full screen of image data. Only the latest LED frame is kept, older
+#frames that have not been sent yet are dropped. Image data is written by a PacedWriter, which only lets as much data
+#ahead as the firmware can take, so the operating system does not buffer image data ahead of urgent commands either.
+
+import threading
+import time
+import serial
+from collections import deque
+from .trace import tracer
+from .frames import splitImageCommands, commandCode
+from .packbits import rowEnds, maxPackedRow
+
+class TransmitScheduler:
+    CONTROL = 0
+    LED = 1
+    IMAGE = 2
+
+    def __init__(self, write, writeImage=None):
+        self.write = write          #Function that actually writes bytes to the port
+        self.writeImage = writeImage if writeImage != None else write #Function that writes a display command with its image data
+        self.condition = threading.Condition()
+        self.control = deque()      #Entries of (data, origin)
+        self.led = None             #Only the latest LED frame is sent
+        self.images = deque()
+        self.writtenCallback = None #Called as writtenCallback(origin, priority) after data with an origin has been written
+        self.busy = False           #A write is in progress
+        self.error = None           #Exception raised by a write, which stops the scheduler
+        self.thread = None
+        self.running = False
+
+        #Statistics
+        self.bytesSent = [0, 0, 0]  #By priority class
+        self.commandsSent = [0, 0, 0]
+        self.ledFramesDropped = 0
+
+    def checkError(self):
+        if self.error != None:
+            raise serial.SerialException(self.error)
+
+    #Queues data in one of the priority classes. For IMAGE, data can also be a list of complete commands, which may be interleaved with more urgent ones. The origin (e.g. the key event that caused the command) is handed to writtenCallback once the data has been written.
+    def send(self, priority, data, origin=None):
+        with self.condition:
+            self.checkError()
+            if priority == self.CONTROL:
+                self.control.append((data, origin))
+            elif priority == self.LED:
+                if self.led != None:
+                    self.ledFramesDropped += 1
+                    origin = origin if origin != None else self.led[1] #The new frame also shows what the dropped one was sent for
+                self.led = (data, origin)
+            elif isinstance(data, list):
+                self.images.extend((part, origin) for part in data)
+            else:
+                self.images.append((data, origin))
+            if not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, name="inkkeys-transmit", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def next(self):
+        if len(self.control) > 0:
+            return (self.CONTROL,) + self.control.popleft()
+        if self.led != None:
+            data, origin = self.led
+            self.led = None
+            return self.LED, data, origin
+        if len(self.images) > 0:
+            return (self.IMAGE,) + self.images.popleft()
+        return None, None, None
+
+    def pending(self):
+        return len(self.control) > 0 or self.led != None or len(self.images) > 0
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending():
+                    self.condition.wait()
+                if not self.running:
+                    return
+                priority, data, origin = self.next()
+                self.busy = True
+            try:
+                with tracer.span("write " + commandCode(data), "serial", priority=priority, bytes=len(data)):
+                    if priority == self.IMAGE:
+                        self.writeImage(data)
+                    else:
+                        self.write(data)
+                self.bytesSent[priority] += len(data)
+                self.commandsSent[priority] += 1
+                if origin != None and self.writtenCallback != None:
+                    self.writtenCallback(origin, priority)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.running = False
+                    self.clear()
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def clear(self):
+        self.control.clear()
+        self.led = None
+        self.images.clear()
+
+    #Blocks until everything queued so far has been written. Returns False if this did not happen within timeout seconds.
+    def flush(self, timeout=None):
+        deadline = None if timeout == None else time.time() + timeout
+        with self.condition:
+            while self.pending() or self.busy:
+                self.checkError()
+                remaining = None if deadline == None else deadline - time.time()
+                if remaining != None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.checkError()
+        return True
+
+    #Drops everything that has not been sent yet and stops the background thread
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.clear()
+            self.condition.notify_all()
+        if self.thread != None and self.thread != threading.current_thread():
+            self.thread.join(2)
+
+    def stats(self):
+        names = ("control", "led", "image")
+        return {"bytesSent": dict(zip(names, self.bytesSent)), "commandsSent": dict(zip(names, self.commandsSent)), "ledFramesDropped": self.ledFramesDropped}
+
+
+#Writes display commands with their image data in portions the firmware can keep up with. The firmware reads one byte
+#per loop() and writes each complete row to the display, so image data is paced by rows:
+#- With credits (firmware reports "CREDIT 1" and has been sent "C 1"), the firmware acknowledges every row it has
+#  written with a "c" line and at most windowBytes of image data are sent ahead of these acknowledgements.
+#- Without credits, the data is written in slices of whole rows of up to windowBytes and the port is drained after each.
+class PacedWriter:
+    windowBytes = 256       #Image data in flight, matching the 256 byte receive buffer of the firmware
+    creditTimeout = 1.0     #Seconds to wait for an acknowledgement before giving up on the credit handshake
+
+    def __init__(self, write, drain=None):
+        self.write = write
+        self.drain = drain          #Function that waits until the port has transmitted everything
+        self.condition = threading.Condition()
+        self.credits = False
+        self.outstanding = 0        #Rows sent but not yet acknowledged
+
+        #Statistics
+        self.bytesWritten = 0
+        self.busyTime = 0.0         #Seconds spent in writeImage
+        self.creditWaitTime = 0.0   #Seconds spent waiting for acknowledgements
+        self.creditTimeouts = 0
+        self.lastRate = None        #Bytes per second of the last display command
+
+    def enableCredits(self, enabled=True):
+        with self.condition:
+            self.credits = enabled
+            self.outstanding = 0
+            self.condition.notify_all()
+
+    #Called for each "c" line from the device
+    def acknowledge(self):
+        with self.condition:
+            if self.outstanding > 0:
+                self.outstanding -= 1
+            self.condition.notify_all()
+
+    #Waits until the device has room for at least one more row and returns the number of rows that may be sent
+    def waitForCredits(self, windowRows):
+        start = time.perf_counter()
+        waited = False
+        with self.condition:
+            deadline = time.time() + self.creditTimeout
+            while self.credits and self.outstanding >= windowRows:
+                waited = True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print("The device did not acknowledge image data in time. Disabling credits.")
+                    self.creditTimeouts += 1
+                    self.credits = False
+                    self.outstanding = 0
+                    break
+                self.condition.wait(remaining)
+            credits = self.credits
+            rows = windowRows - self.outstanding
+        t = time.perf_counter() - start
+        self.creditWaitTime += t
+        if waited:
+            tracer.complete("credit wait", "serial", t)
+        return rows if credits else None
+
+    #Writes one display command or several in a row, with the header of each sent along with its first rows
+    def writeImage(self, commands):
+        start = time.perf_counter()
+        for header, width, data, packed in splitImageCommands(commands): #Text or framed headers
+            self.writeRows(header, width, data, packed)
+        t = time.perf_counter() - start
+        self.bytesWritten += len(commands)
+        self.busyTime += t
+        if t > 0:
+            self.lastRate = len(commands) / t
+
+    def writeRows(self, header, width, data, packed):
+        rowBytes = max(1, (width + 7)//8)
+        if packed:
+            #Rows of PackBits encoded data differ in length, so the window has to allow for the longest possible row
+            ends = rowEnds(data, rowBytes)
+            windowRows = max(1, self.windowBytes // maxPackedRow(rowBytes))
+        else:
+            ends = list(range(rowBytes, len(data), rowBytes)) + [len(data)] if len(data) > 0 else []
+            windowRows = max(1, self.windowBytes // rowBytes)
+        if len(ends) == 0:
+            self.write(header)
+        offset = 0
+        row = 0
+        while row < len(ends):
+            rows = self.waitForCredits(windowRows) if self.credits else None
+            if rows == None:
+                #No handshake, so we can only make sure that the previous slice has left the port
+                n = min(windowRows, len(ends) - row)
+                part = data[offset:ends[row+n-1]]
+                self.write(header + part if offset == 0 else part)
+                if self.drain != None:
+                    self.drain()
+            else:
+                n = min(rows, len(ends) - row)
+                part = data[offset:ends[row+n-1]]
+                with self.condition:
+                    self.outstanding += n
+                self.write(header + part if offset == 0 else part)
+            offset += len(part)
+            row += n
+
+    #Average bytes per second achieved while writing image data
+    def rate(self):
+        return self.bytesWritten / self.busyTime if self.busyTime > 0 else None
+
+    def stats(self):
+        return {"credits": self.credits, "bytesWritten": self.bytesWritten, "busyTime": self.busyTime, "rate": self.rate(), "lastRate": self.lastRate, "creditWaitTime": self.creditWaitTime, "creditTimeouts": self.creditTimeouts}
@@ -0,0 +1,82 @@
+#Timers for the main loop. Instead of waking up 30 times per second, the loop sleeps until the next timer is due or
+#until another thread calls wake() (a key event, a new context or changed LEDs). Timers are kept in a heap, so finding
+#the next one is cheap even with many of them.
+#
+#A timer function returns the number of seconds until it should run again or False (or None) if it is done. This is
+#the same convention as the poll() and animate() functions of the modes.
+
+import heapq
+import itertools
+import threading
+import time
+
+class LoopScheduler:
+    def __init__(self):
+        self.heap = []              #Entries of [deadline, sequence number, function], function is None if cancelled
+        self.counter = itertools.count()
+        self.wakeup = threading.Event()
+        self.started = time.time()
+        self.wokenAt = self.started #When runOnce() stopped waiting the last time, i.e. the start of the current iteration
+
+        #Statistics
+        self.wakeups = 0
+
+    #Runs function after delay seconds and returns a handle for cancel()
+    def schedule(self, delay, function):
+        entry = [time.time() + delay, next(self.counter), function]
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def cancel(self, handle):
+        if handle != None:
+            handle[2] = None
+
+    def isScheduled(self, handle):
+        return handle != None and handle[2] != None
+
+    #Can be called from any thread to let runOnce() return early
+    def wake(self):
+        self.wakeup.set()
+
+    #Seconds until the next timer is due (None if there is none)
+    def timeout(self):
+        while len(self.heap) > 0 and self.heap[0][2] == None:
+            heapq.heappop(self.heap)
+        if len(self.heap) == 0:
+            return None
+        return max(0, self.heap[0][0] - time.time())
+
+    #Waits for the next timer or a call to wake() (but no longer than maxWait seconds) and runs all timers that are due
+    def runOnce(self, maxWait=None):
+        timeout = self.timeout()
+        if maxWait != None:
+            timeout = maxWait if timeout == None else min(timeout, maxWait)
+        if timeout == None or timeout > 0:
+            self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        self.wakeups += 1
+        now = time.time()
+        self.wokenAt = now
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        for entry in due:
+            if entry[2] == None:
+                continue #Cancelled
+            interval = entry[2]()
+            if entry[2] == None or interval == None or interval is False:
+                entry[2] = None #Done or cancelled while running
+                continue
+            #Reuse the entry, so the handle stays valid while the timer repeats
+            entry[0] = time.time() + interval
+            entry[1] = next(self.counter)
+            heapq.heappush(self.heap, entry)
+
+    #Average wakeups per second since the last reset
+    def wakeupsPerSecond(self):
+        t = time.time() - self.started
+        return self.wakeups / t if t > 0 else 0
+
+    def resetStats(self):
+        self.wakeups = 0
+        self.started = time.time()
@@ -0,0 +1,78 @@
+#Decides which mode to use for the active window and the running processes. The modes are given as in controller.py:
+#a list of dicts with the mode and optionally a "process" name or a compiled "activeWindow" pattern, and the first
+#matching entry wins. All window patterns are combined into a single regular expression with one named group per
+#entry, so a window is matched in one pass instead of trying each pattern. Decisions are remembered for each window
+#until the set of processes changes.
+
+import re
+
+class ModeResolver:
+    maxCacheSize = 256      #Windows remembered per version of the process list
+
+    def __init__(self, modes):
+        self.modes = modes
+        self.processes = [(i, entry["process"]) for i, entry in enumerate(modes) if "process" in entry]
+        self.unconditional = next((i for i, entry in enumerate(modes) if not ("process" in entry or "activeWindow" in entry)), None)
+        self.windowPatterns = [(i, entry["activeWindow"]) for i, entry in enumerate(modes) if "activeWindow" in entry]
+        self.combined = self.combinePatterns(self.windowPatterns)
+        self.cache = {}
+        self.cacheVersion = None
+
+        #Statistics
+        self.lookups = 0
+        self.hits = 0
+
+    #Returns a single pattern matching any of the given patterns or None if they cannot be combined (different flags, back references...). Group "m<i>" matches for entry i.
+    @staticmethod
+    def combinePatterns(patterns):
+        if len(patterns) == 0:
+            return None
+        flags = {p.flags for i, p in patterns}
+        if len(flags) > 1:
+            return None
+        for i, p in patterns:
+            if re.search(r"\\[1-9]|\(\?P=", p.pattern): #Back references would refer to different groups in the combined pattern
+                return None
+        try:
+            return re.compile("|".join("(?P<m" + str(i) + ">" + p.pattern + ")" for i, p in patterns), flags.pop())
+        except re.error:
+            return None
+
+    #Index of the first entry with a pattern matching the window, or None
+    def matchWindow(self, window):
+        if self.combined != None:
+            #Alternatives are tried in order, so the first matching group is the first matching entry
+            m = self.combined.match(window)
+            return int(m.lastgroup[1:]) if m != None else None
+        for i, p in self.windowPatterns:
+            if p.match(window):
+                return i
+        return None
+
+    def evaluate(self, window, processes):
+        candidates = [] #Indices of the first matching entry of each kind, the lowest one wins
+        for i, process in self.processes:
+            if process in processes:
+                candidates.append(i)
+                break
+        windowMatch = self.matchWindow(window)
+        if windowMatch != None:
+            candidates.append(windowMatch)
+        if self.unconditional != None:
+            candidates.append(self.unconditional)
+        return self.modes[min(candidates)] if len(candidates) > 0 else None
+
+    #Returns the entry of the mode to use or None if no mode matches. processVersion has to change whenever the set of processes changes.
+    def resolve(self, window, processes, processVersion):
+        self.lookups += 1
+        if processVersion != self.cacheVersion:
+            self.cache = {}
+            self.cacheVersion = processVersion
+        elif window in self.cache:
+            self.hits += 1
+            return self.cache[window]
+        if len(self.cache) >= self.maxCacheSize:
+            self.cache = {}
+        entry = self.evaluate(window, processes)
+        self.cache[window] = entry
+        return entry
@@ -6,18 +6,20 @@
 #- poll
 #Called periodically and typically used to poll a state which you need to monitor. At the end you have to return an interval in seconds before the function is to be called again - otherwise it is not called a second time
 #- animate
-#Called up to 30 times per second, used for LED animation
+#Used for LED animation. Like poll, it returns the interval in seconds before it should be called again (1/30 for a smooth animation) or False if nothing is animated. It is called again when the mode is activated, after key events and whenever LEDs are set.
 #- deactivate
 #Called when the mode becomes inactive. Used to clean up callback functions and images on the screen that are outside commonly overwritten areas.
 
 #To avoid multiple screen refreshs, the modules usually do not clean-up the display when being deactivvated. Instead, each module is supposed to set at least the area corresponding to each button (even if it needs to be set to white if unused).
 
+#Refreshs are requested with device.requestRefresh(), which returns immediately. The device combines requests that arrive in quick succession (or while a refresh is still running) into a single refresh.
+
 from inkkeys import *
+from inkkeys.trace import tracer
 import time
 from threading import Timer
 from math import ceil, floor
 from PIL import Image, ImageDraw, ImageFont
-from colorsys import hsv_to_rgb
 
 #Optional libraries you might want to remove if you do not require them.
 import pulsectl                                  # Get volume level in Linux, pip3 install pulsectl
@@ -29,8 +31,10 @@ from obswebsocket import obsws, requests, events # Control OBS. This requires th
         ############# and you should get used to the real shortcuts as it is much more efficient to stay on the keyboard all the time.
 
 class ModeBlender:
+    scene = None    #The entire setup of this mode is static, so it is compiled into a scene once and then sent in one go (see setup)
 
-    def activate(self, device):
+    #Static content of this mode. This is not sent directly, but compiled into a scene by device.compileScene() in activate.
+    def setup(self, device):
         device.sendTextFor("title", "Blender", inverted=True) #Title
 
         #Button1 (Jog dial press)
@@ -83,13 +87,17 @@ class ModeBlender:
         device.assignKey(KeyCode.SW9_PRESS, []) #Not used, set to nothing.
         device.assignKey(KeyCode.SW9_RELEASE, [])
 
-        device.updateDisplay()
+    def activate(self, device):
+        if self.scene == None or not self.scene.fits(device):
+            self.scene = device.compileScene(self.setup)
+        device.playScene(self.scene)
+        device.requestRefresh()
 
     def poll(self, device):
         return False    # No polling in this example
 
     def animate(self, device):
-        device.fadeLeds() #No LED animation is used in this mode, but we call "fadeLeds" anyway to fade colors that have been set in another mode before switching
+        return device.fadeLeds() #No LED animation is used in this mode, but we call "fadeLeds" anyway to fade colors that have been set in another mode before switching
 
     def deactivate(self, device):
         pass            # Nothing to clean up in this example
@@ -103,8 +111,10 @@ class ModeBlender:
 
 class ModeGimp:
     jogFunction = ""    #Keeps track of the currently selected function of the jog dial
+    scene = None        #Compiled static part of this mode (title, buttons 2 to 9), see setup
 
-    def activate(self, device):
+    #Static content of this mode, compiled into a scene by device.compileScene() in activate. The jog dial is set up separately as its function can be changed.
+    def setup(self, device):
         device.sendTextFor("title", "Gimp", inverted=True)  #Title
 
         #Button2 (top left)
@@ -147,10 +157,14 @@ class ModeGimp:
         device.assignKey(KeyCode.SW9_PRESS, []) #Not used, set to nothing.
         device.assignKey(KeyCode.SW9_RELEASE, [])
 
+    def activate(self, device):
+        if self.scene == None or not self.scene.fits(device):
+            self.scene = device.compileScene(self.setup)
+        device.playScene(self.scene)
 
         self.jogFunction = ""
 
-        #This toggles the jog function and sets up key assignments and the label for the jog dial. It calls "updateDiplay()" if update is not explicitly set to False (for example if you need to update more parts of the display before updating it.)
+        #This toggles the jog function and sets up key assignments and the label for the jog dial. It requests a display refresh if update is not explicitly set to False (for example if you need to update more parts of the display before updating it.)
         def toggleJogFunction(update=True):
             if self.jogFunction == "size":  #Tool opacity in GIMP
                 device.clearCallback(KeyCode.JOG)
@@ -159,7 +173,7 @@ class ModeGimp:
                 device.assignKey(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_PERIOD), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.RELEASE)])
                 self.jogFunction = "opacity"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
             else:                            #Tool size in GIMP
                 device.clearCallback(KeyCode.JOG)
                 device.sendTextFor(1, "Tool size")
@@ -167,7 +181,7 @@ class ModeGimp:
                 device.assignKey(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_RIGHT_BRACE)])
                 self.jogFunction = "size"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
 
 
         #Button 1 / jog dial press
@@ -175,13 +189,13 @@ class ModeGimp:
         device.assignKey(KeyCode.SW1_PRESS, [])                       #We do not send a key stroke when the dial is pressed, instead we use the callback.
         device.assignKey(KeyCode.SW1_RELEASE, [])                     #We still need to overwrite the assignment to clear previously set assignments.
         toggleJogFunction(False)    #We call toggleJogFunction to initially set the label and assignment
-        device.updateDisplay()      #Everything has been sent to the display. Time to refresh it.
+        device.requestRefresh()      #Everything has been sent to the display. Time to refresh it.
 
     def poll(self, device):
         return False #Nothing to poll
 
     def animate(self, device):
-        device.fadeLeds() #No LED animation is used in this mode, but we call "fadeLeds" anyway to fade colors that have been set in another mode before switching
+        return device.fadeLeds() #No LED animation is used in this mode, but we call "fadeLeds" anyway to fade colors that have been set in another mode before switching
 
     def deactivate(self, device):
         device.clearCallbacks() #Remove our callbacks if we switch to a different mode
@@ -270,7 +284,7 @@ class ModeFallback:
                 d = ImageDraw.Draw(img)
                 d.text((0, x-x8), text, font=font, fill=0)
                 device.sendImage(x8, (device.dispH-w)//2, img.transpose(Image.ROTATE_90))
-                device.updateDisplay(True)
+                device.requestRefresh(True)
 
         device.registerCallback(toggleDemo, KeyCode.SW8_PRESS)
         device.sendIconFor(8, "icons/emoji-sunglasses.png", centered=(not self.demoActive))
@@ -288,8 +302,7 @@ class ModeFallback:
                         vol = sink.volume.value_flat
                 off = 0x00ff00
                 on = 0xff0000
-                leds = [on if vol > i/(device.nLeds-1) else off for i in range(device.nLeds)]
-                device.setLeds(leds)
+                device.setLeds(levelMeter(device.nLeds, vol, on, off))
 
         self.jogFunction = ""
 
@@ -301,7 +314,7 @@ class ModeFallback:
                 device.assignKey(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT)])
                 self.jogFunction = "arrow"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
             elif self.jogFunction == "arrow":
                 device.sendTextFor(1, "Volume")
                 device.registerCallback(showVolume, KeyCode.JOG)
@@ -309,7 +322,7 @@ class ModeFallback:
                 device.assignKey(KeyCode.JOG_CCW, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_VOL_DOWN)])
                 self.jogFunction = "volume"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
             else:
                 device.clearCallback(KeyCode.JOG)
                 device.sendTextFor(1, "Mouse Wheel")
@@ -317,7 +330,7 @@ class ModeFallback:
                 device.assignKey(KeyCode.JOG_CCW, [event(DeviceCode.MOUSE, MouseAxisCode.MOUSE_WHEEL, -1)])
                 self.jogFunction = "wheel"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
 
         device.registerCallback(toggleJogFunction, KeyCode.JOG_PRESS)
         device.assignKey(KeyCode.SW1_PRESS, [])
@@ -328,7 +341,7 @@ class ModeFallback:
 
         ### All set, let's update the display ###
 
-        device.updateDisplay()
+        device.requestRefresh()
 
     def poll(self, device):
         if not self.demoActive:
@@ -349,19 +362,14 @@ class ModeFallback:
         else:
             device.sendIconFor(4, "icons/lightbulb-off.png", centered=(not self.demoActive))
         if update:
-            device.updateDisplay()
+            device.requestRefresh()
 
     def animate(self, device):
         if self.demoActive: #In demo mode, we animate the LEDs here
-
-            def rgbTupleToInt(rgb):
-                return (int(rgb[0]*255) << 16) | (int(rgb[1]*255) << 8) | int(rgb[2]*255)
-
-            t = time.time()
-            leds = [rgbTupleToInt(hsv_to_rgb(t + i/device.nLeds, 1, 1)) for i in range(device.nLeds)]
-            device.setLeds(leds)
+            device.setLeds(hueCycle(device.nLeds, time.time()))
+            return 1/30
         else:               #If not in demo mode, we call "fadeLeds" to create a fade animation for any color set anywhere in this mode
-            device.fadeLeds()
+            return device.fadeLeds()
 
     def deactivate(self, device):
         device.clearCallbacks() #Clear our callbacks if we switch to a different mode
@@ -395,13 +403,15 @@ class ModeOBS:
 
     #Switch to scene with name "name"
     def setScene(self, name):
-        self.ws.call(requests.SetCurrentScene(name))
+        with tracer.asyncSpan("obs SetCurrentScene", "obs", scene=name):
+            self.ws.call(requests.SetCurrentScene(name))
 
     #Toggle source visibility as defined in a state (see states above)
     def toggleState(self, state):
         visible = not state["current"]
-        for item in state["items"]:
-            self.ws.call(requests.SetSceneItemProperties(item[1], scene_name=item[0], visible=visible))
+        with tracer.asyncSpan("obs SetSceneItemProperties", "obs", visible=visible):
+            for item in state["items"]:
+                self.ws.call(requests.SetSceneItemProperties(item[1], scene_name=item[0], visible=visible))
 
     #Generates a callback function which in turn calls "setScene" with the fixed scene "name" without requiring a parameter
     def getSetSceneCallback(self, name):
@@ -411,7 +421,7 @@ class ModeOBS:
     def getToggleStateCallback(self, state):
         return lambda: self.toggleState(state)
 
-    #Updates the buttons associated with scenes. Unless "init" is set to true, it only updates changed parts of the display and returns True if anything has changed so that the calling function should call updateDisplay()
+    #Updates the buttons associated with scenes. Unless "init" is set to true, it only updates changed parts of the display and returns True if anything has changed so that the calling function should request a refresh
     def updateSceneButtons(self, device, newScene, init=False):
         if self.currentScene == newScene:
             return False
@@ -423,7 +433,7 @@ class ModeOBS:
         self.currentScene = newScene
         return True
 
-    #Updates the buttons associated with states. Unless "init" is set to true, it only updates changed parts of the display and returns True if anything has changed so that the calling function should call updateDisplay()
+    #Updates the buttons associated with states. Unless "init" is set to true, it only updates changed parts of the display and returns True if anything has changed so that the calling function should request a refresh
     def updateStateButtons(self, device, scene, item, visible, init=False):
         anyUpdate = False
         for state in self.states:
@@ -451,22 +461,25 @@ class ModeOBS:
 
         #Callback if the scene changes
         def on_scene(message):
-            if self.updateSceneButtons(device, message.getSceneName()):
-                device.updateDisplay() #Only update if parts of the display actually changed
-            self.updateLED(device)
+            with tracer.asyncSpan("obs SwitchScenes", "obs", scene=message.getSceneName()):
+                if self.updateSceneButtons(device, message.getSceneName()):
+                    device.requestRefresh() #Only update if parts of the display actually changed
+                self.updateLED(device)
 
         #Callback if the visibility of a source changes
         def on_visibility_changed(message):
-            if self.updateStateButtons(device, message.getSceneName(), message.getItemName(), message.getItemVisible()):
-                device.updateDisplay() #Only update if parts of the display actually changed
-            self.updateLED(device)
+            with tracer.asyncSpan("obs SceneItemVisibilityChanged", "obs", item=message.getItemName()):
+                if self.updateStateButtons(device, message.getSceneName(), message.getItemName(), message.getItemVisible()):
+                    device.requestRefresh() #Only update if parts of the display actually changed
+                self.updateLED(device)
 
         #Register callbacks to OBS
         self.ws.register(on_exit, events.Exiting)
         self.ws.register(on_scene, events.SwitchScenes)
         self.ws.register(on_visibility_changed, events.SceneItemVisibilityChanged)
 
-        self.ws.connect()
+        with tracer.asyncSpan("obs connect", "obs"):
+            self.ws.connect()
 
         device.sendTextFor("title", "OBS", inverted=True) #Title
 
@@ -484,10 +497,12 @@ class ModeOBS:
         ### Button 6: Order!
 
         def stopOrder():
-            self.ws.call(requests.SetSceneItemProperties("Order", visible=False))
+            with tracer.asyncSpan("obs SetSceneItemProperties", "obs", item="Order", visible=False):
+                self.ws.call(requests.SetSceneItemProperties("Order", visible=False))
 
         def playOrder():
-            self.ws.call(requests.SetSceneItemProperties("Order", visible=True))
+            with tracer.asyncSpan("obs SetSceneItemProperties", "obs", item="Order", visible=True):
+                self.ws.call(requests.SetSceneItemProperties("Order", visible=True))
             Timer(3, stopOrder).start()
 
 
@@ -507,7 +522,8 @@ class ModeOBS:
 
 
         ### Get current state and initialize buttons accordingly ###
-        current = self.ws.call(requests.GetSceneList())
+        with tracer.asyncSpan("obs GetSceneList", "obs"):
+            current = self.ws.call(requests.GetSceneList())
         for scene in current.getScenes():
             for item in scene["sources"]:
                 for state in self.states:
@@ -518,14 +534,14 @@ class ModeOBS:
         self.currentScene = None
         self.updateSceneButtons(device, current.getCurrentScene(), init=True)
         self.updateStateButtons(device, None, None, True, init=True)
-        device.updateDisplay()
+        device.requestRefresh()
         self.updateLED(device)
 
     def poll(self, device):
         return False    #No polling required
 
     def animate(self, device):
-        pass    #In this mode we want permanent LED illumination. Do not fade or animate otherwise.
+        return False    #In this mode we want permanent LED illumination. Do not fade or animate otherwise.
 
     def deactivate(self, device):
         device.clearCallbacks() #Clear our callbacks if we switch to a different mode
@@ -6,6 +6,7 @@
 
 import paho.mqtt.client as mqtt
 import json
+from inkkeys.trace import tracer
 
 class InkkeysMqtt:
     client = None
@@ -25,23 +26,25 @@ class InkkeysMqtt:
         self.client = mqtt.Client("inkkeys")
 
         def on_message(client, userdata, message):
-            if message.topic == self.plugTopic:
-                state = json.loads(str(message.payload.decode("utf-8")))
-                self.lightOn = state["state"] != "OFF"
-                if self.debug:
-                    print("Light: " + str(self.lightOn))
-            elif message.topic == self.co2Topic:
-                state = json.loads(str(message.payload.decode("utf-8")))
-                self.co2 = state["co2"]
-                if self.debug:
-                    print("CO2: " + str(self.co2))
+            with tracer.asyncSpan("mqtt message", "mqtt", topic=message.topic):
+                if message.topic == self.plugTopic:
+                    state = json.loads(str(message.payload.decode("utf-8")))
+                    self.lightOn = state["state"] != "OFF"
+                    if self.debug:
+                        print("Light: " + str(self.lightOn))
+                elif message.topic == self.co2Topic:
+                    state = json.loads(str(message.payload.decode("utf-8")))
+                    self.co2 = state["co2"]
+                    if self.debug:
+                        print("CO2: " + str(self.co2))
 
         self.client.on_message = on_message
 
     def connect(self):
         if self.server == None:
             return
-        self.client.connect(self.server)
+        with tracer.asyncSpan("mqtt connect", "mqtt", server=self.server):
+            self.client.connect(self.server)
         self.client.loop_start()
         self.client.subscribe(self.plugTopic)
         self.client.subscribe(self.co2Topic)
@@ -56,7 +59,8 @@ class InkkeysMqtt:
     def setLight(self, state):
         if self.server == None:
             return
-        self.client.publish(self.plugTopic + "/set",'{"state":' + ('"ON"' if state else '"OFF"') + '}')
+        with tracer.asyncSpan("mqtt publish", "mqtt", topic=self.plugTopic + "/set"):
+            self.client.publish(self.plugTopic + "/set",'{"state":' + ('"ON"' if state else '"OFF"') + '}')
 
     def getLight(self):
         if self.server == None:
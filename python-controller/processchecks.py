@@ -1,11 +1,12 @@
+import os
 import sys
 import psutil
 
 if sys.platform in ['linux', 'linux2']:
     import Xlib
     import Xlib.display
-    display = Xlib.display.Display()
-    root = display.screen().root
+    display = None #Connected on first use, so importing this module does not require an X server
+    root = None
 elif sys.platform in ['Windows', 'win32', 'cygwin']:
     import win32gui
 elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
@@ -13,7 +14,127 @@ elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
 else:
     print("Unknown platform: " + sys.platform)
 
+#Keeps track of the running processes by watching the PIDs in /proc (Linux only). Only the names of new PIDs are read,
+#so an update costs time proportional to the number of started and stopped processes instead of all processes.
+#A process that calls exec (like a launcher becoming obs) keeps its PID and a PID can be reused between two updates, so
+#each update also rechecks the name and start time of a share of the known PIDs. Such changes are therefore only noticed
+#within 2*recheckRounds updates, as the PID may just have been rechecked in the current round.
+class ProcWatcher:
+    recheckRounds = 10      #Every known PID is rechecked once within this number of updates
+
+    def __init__(self, procRoot="/proc"):
+        self.procRoot = procRoot
+        self.pids = {}          #Tuples of (process name, start time) by PID
+        self.recheckPending = [] #PIDs that have not been rechecked in the current round
+        self.counts = {}        #Number of processes by name
+        self.version = 0        #Incremented whenever the set of names changes
+        self.snapshot = frozenset()
+        self.snapshotVersion = 0
+
+    @staticmethod
+    def available(procRoot="/proc"):
+        return os.path.isfile(os.path.join(procRoot, "self", "comm")) or os.path.isfile(os.path.join(procRoot, "1", "comm"))
+
+    #Returns the name of a process like psutil does: comm is truncated to 15 characters, so the full name is taken from the command line if it matches
+    def readName(self, pid):
+        try:
+            with open(os.path.join(self.procRoot, pid, "comm"), "rb") as f:
+                name = f.read().decode(errors="replace").rstrip("\n")
+        except OSError:
+            return None #Already gone or not accessible
+        if len(name) >= 15:
+            try:
+                with open(os.path.join(self.procRoot, pid, "cmdline"), "rb") as f:
+                    cmd = os.path.basename(f.read().split(b"\0")[0].decode(errors="replace"))
+                if cmd.startswith(name):
+                    return cmd
+            except OSError:
+                pass
+        return name
+
+    #Returns comm and the start time (field 22) from the stat file of a process or None if it is gone
+    def readStat(self, pid):
+        try:
+            with open(os.path.join(self.procRoot, pid, "stat"), "rb") as f:
+                stat = f.read().decode(errors="replace")
+        except OSError:
+            return None
+        end = stat.rfind(")") #comm may contain spaces and parentheses
+        fields = stat[end+2:].split(" ")
+        return (stat[stat.find("(")+1:end], fields[19] if len(fields) > 19 else None)
+
+    #Returns True if the set of names has changed
+    def add(self, pid, name, startTime):
+        self.pids[pid] = (name, startTime)
+        if name == None:
+            return False
+        self.counts[name] = self.counts.get(name, 0) + 1
+        return self.counts[name] == 1
+
+    def remove(self, pid):
+        name, startTime = self.pids.pop(pid)
+        if name == None:
+            return False
+        self.counts[name] -= 1
+        if self.counts[name] == 0:
+            del self.counts[name]
+            return True
+        return False
+
+    #Reads the name of a new PID, or of a known PID whose stat shows that it is a different process or program now
+    def readProcess(self, pid):
+        stat = self.readStat(pid)
+        return self.readName(pid), stat[1] if stat != None else None
+
+    #Returns True if the set of names has changed because the PID now belongs to a different process or program
+    def recheck(self, pid):
+        stat = self.readStat(pid)
+        if stat == None:
+            return False #Gone, removed by the next update
+        name, startTime = self.pids[pid]
+        comm, newStartTime = stat
+        if newStartTime == startTime and (name == None or name[:15] == comm[:15]):
+            return False
+        changed = self.remove(pid)
+        name, startTime = self.readProcess(pid)
+        return self.add(pid, name, startTime) or changed
+
+    #Scans /proc for started and stopped processes. Returns True if the set of names has changed.
+    def update(self):
+        current = {entry for entry in os.listdir(self.procRoot) if entry.isdigit()}
+        known = self.pids.keys()
+        changed = False
+        for pid in known - current:
+            changed = self.remove(pid) or changed
+        if len(self.recheckPending) == 0:
+            self.recheckPending = list(self.pids)
+        for i in range(min(len(self.recheckPending), -(-len(self.pids) // self.recheckRounds))):
+            pid = self.recheckPending.pop()
+            if pid in self.pids:
+                changed = self.recheck(pid) or changed
+        for pid in current - known:
+            name, startTime = self.readProcess(pid)
+            changed = self.add(pid, name, startTime) or changed
+        if changed:
+            self.version += 1
+        return changed
+
+    def __contains__(self, name):
+        return name in self.counts
+
+    #Returns the set of process names, which is only copied again if it has changed
+    def names(self):
+        if self.snapshotVersion != self.version:
+            self.snapshot = frozenset(self.counts)
+            self.snapshotVersion = self.version
+        return self.snapshot
+
+processWatcher = ProcWatcher() if sys.platform in ['linux', 'linux2'] and ProcWatcher.available() else None
+
 def getActiveProcesses():
+    if processWatcher != None:
+        processWatcher.update()
+        return processWatcher.names()
     return {p.name() for p in psutil.process_iter(["name"])}
 
 # Adapted from Martin Thoma on stackoverflow
@@ -22,6 +143,10 @@ def getActiveWindow():
     active_window_name = None
     try:
         if sys.platform in ['linux', 'linux2']:
+            global display, root
+            if display == None:
+                display = Xlib.display.Display()
+                root = display.screen().root
             windowID = root.get_full_property(display.intern_atom('_NET_ACTIVE_WINDOW'), Xlib.X.AnyPropertyType).value[0]
             window = display.create_resource_object('window', windowID)
             return window.get_wm_class()[0]
@@ -0,0 +1,143 @@
+#Sources for the currently focused window. Instead of asking for the active window over and over again, a source runs in
+#the background and reports focus changes as they happen:
+#
+#- X11FocusSource (Linux) subscribes to PropertyNotify events of _NET_ACTIVE_WINDOW on the root window.
+#- PollingFocusSource asks processchecks.getActiveWindow() periodically (Windows, macOS or without X11).
+#- FakeFocusSource is set manually, for tests and benchmarks.
+#
+#Each source keeps the last window (the window class on Linux) in "window" and increments "version" whenever it
+#changes. Functions passed to addListener are called with the new window from the thread of the source.
+
+import os
+import select
+import sys
+import threading
+import traceback
+
+class FocusSource:
+    def __init__(self):
+        self.window = None
+        self.version = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    #Called by the backends with the currently focused window
+    def publish(self, window):
+        with self.lock:
+            if window == self.window:
+                return
+            self.window = window
+            self.version += 1
+        for listener in self.listeners:
+            try:
+                listener(window)
+            except Exception:
+                print("Error in focus listener:")
+                traceback.print_exc()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FakeFocusSource(FocusSource):
+    def setWindow(self, window):
+        self.publish(window)
+
+
+class PollingFocusSource(FocusSource):
+    def __init__(self, getWindow=None, interval=0.5):
+        super().__init__()
+        if getWindow == None:
+            from processchecks import getActiveWindow
+            getWindow = getActiveWindow
+        self.getWindow = getWindow
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="inkkeys-focus", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            window = self.getWindow()
+            if window != None: #Sometimes getting the active window fails (or no window has the focus), then keep the last one
+                self.publish(window)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join(2)
+
+
+class X11FocusSource(FocusSource):
+    timeout = 0.5   #Seconds between checks if the source has been stopped
+
+    def __init__(self, displayName=None):
+        super().__init__()
+        import Xlib.display
+        self.display = Xlib.display.Display(displayName) #Own connection, Xlib connections must not be shared between threads
+        self.root = self.display.screen().root
+        self.activeAtom = self.display.intern_atom("_NET_ACTIVE_WINDOW")
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        import Xlib.X
+        self.root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self.display.flush()
+        self.publish(self.lookup())
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="inkkeys-focus", daemon=True)
+        self.thread.start()
+
+    def lookup(self):
+        import Xlib.X, Xlib.error
+        try:
+            active = self.root.get_full_property(self.activeAtom, Xlib.X.AnyPropertyType)
+            if active == None or len(active.value) == 0 or active.value[0] == 0:
+                return None
+            window = self.display.create_resource_object("window", active.value[0])
+            wmClass = window.get_wm_class()
+            return wmClass[0] if wmClass != None else None
+        except Xlib.error.XError: #The window might already be gone
+            return None
+
+    def run(self):
+        import Xlib.X
+        while self.running:
+            changed = False
+            while self.display.pending_events() > 0:
+                event = self.display.next_event()
+                if event.type == Xlib.X.PropertyNotify and event.atom == self.activeAtom:
+                    changed = True
+            if changed:
+                window = self.lookup()
+                if window != None:
+                    self.publish(window)
+            select.select([self.display], [], [], self.timeout)
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join(2)
+        self.display.close()
+
+
+#Returns the best source for this platform: X11 events on Linux, polling otherwise or if X11 is not available
+def createFocusSource():
+    if sys.platform in ['linux', 'linux2'] and os.environ.get("DISPLAY"):
+        try:
+            return X11FocusSource()
+        except Exception as e:
+            print("Cannot watch X11 focus events, polling instead: ", e)
+    return PollingFocusSource()